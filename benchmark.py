@@ -0,0 +1,541 @@
+#!/usr/bin/env python
+"""
+MCP M3U8视频下载服务器性能测试脚本
+
+在子进程中启动一个本地HLS源站，提供合成的点播、直播和字节范围播放列表（明文或AES-128加密），
+可配置片段大小、延迟、单连接带宽、错误率和卡顿。脚本直接调用analyze_m3u8和download_m3u8_video，
+记录每个场景的下载速度、每秒片段数、片段耗时p50/p99、内存峰值和临时目录占用峰值，
+以及stdio模式的冷启动耗时和常驻内存，结果保存为JSON，可与之前的结果对比以发现性能退化。
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import shutil
+import asyncio
+import hashlib
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+
+# 每个场景的参数：
+#   kind: vod（点播）、live（直播，录制max_duration秒）或byterange（所有片段在同一个文件中）
+#   segments: 片段数（直播为播放列表窗口内的片段数）
+#   segment_kb: 每个片段的大小（KB）
+#   encrypted: 是否AES-128加密
+#   latency_ms: 每个请求的首字节延迟（毫秒）
+#   bandwidth_kbps: 单个连接的带宽上限（KB/s），0表示不限
+#   error_rate: 片段请求返回503的概率
+#   stall_rate, stall_seconds: 片段传输到一半时卡住的概率和时长（秒）
+#   segment_duration: 每个片段的时长（秒）
+#   max_duration: 直播录制的时长（秒）
+SCENARIO_DEFAULTS = {
+    "kind": "vod",
+    "segments": 100,
+    "segment_kb": 256,
+    "encrypted": False,
+    "latency_ms": 20,
+    "bandwidth_kbps": 0,
+    "error_rate": 0.0,
+    "stall_rate": 0.0,
+    "stall_seconds": 0.0,
+    "segment_duration": 4.0,
+    "max_duration": 0,
+}
+
+SCENARIOS = {
+    "vod-plain": {"segments": 200},
+    "vod-aes": {"segments": 200, "encrypted": True},
+    "vod-large-segments": {"segments": 8, "segment_kb": 24 * 1024, "encrypted": True, "bandwidth_kbps": 8 * 1024},
+    "byterange": {"kind": "byterange", "segments": 300, "segment_kb": 64},
+    "vod-lossy": {"segments": 300, "segment_kb": 128, "error_rate": 0.05, "stall_rate": 0.02, "stall_seconds": 3.0},
+    "live": {"kind": "live", "segments": 6, "segment_duration": 0.5, "max_duration": 5},
+}
+
+# 源站每次发送的数据块大小
+ORIGIN_CHUNK_SIZE = 64 * 1024
+
+def scenario_config(name):
+    return SCENARIO_DEFAULTS | SCENARIOS[name]
+
+def segment_plain(name, index, size):
+    """第index个片段的明文内容，由场景名和序号决定，各片段互不相同"""
+    block = hashlib.sha256(f"{name}/{index}".encode()).digest()
+    return (block * (size // len(block) + 1))[:size]
+
+def segment_key(name):
+    return hashlib.md5(f"key/{name}".encode()).digest()
+
+def segment_body(name, index, config):
+    """源站实际返回的片段内容；加密时使用媒体序列号作为IV（播放列表中不给出IV）"""
+    from Crypto.Cipher import AES
+    plain = segment_plain(name, index, config["segment_kb"] * 1024)
+    if not config["encrypted"]:
+        return plain
+    padding = 16 - len(plain) % 16
+    return AES.new(segment_key(name), AES.MODE_CBC, iv=index.to_bytes(16, 'big')).encrypt(plain + bytes([padding]) * padding)
+
+def expected_digest(name, config):
+    """点播和字节范围场景下载结果的SHA1"""
+    digest = hashlib.sha1()
+    for index in range(config["segments"]):
+        digest.update(segment_plain(name, index, config["segment_kb"] * 1024))
+    return digest.hexdigest()
+
+# ---------------------------------------------------------------- 本地HLS源站
+
+def build_origin(started_at):
+    """创建源站的aiohttp应用，路径为 /<场景名>/index.m3u8、/<场景名>/seg<序号>.ts、/<场景名>/all.ts 和 /<场景名>/key.bin"""
+    from aiohttp import web
+
+    # 字节范围场景的整个文件，以及每个片段在文件中的 (偏移, 长度)
+    packed = {}
+
+    def packed_file(name, config):
+        if name not in packed:
+            bodies = [segment_body(name, index, config) for index in range(config["segments"])]
+            ranges = []
+            offset = 0
+            for body in bodies:
+                ranges.append((offset, len(body)))
+                offset += len(body)
+            packed[name] = (b''.join(bodies), ranges)
+        return packed[name]
+
+    def playlist(name, config):
+        duration = config["segment_duration"]
+        lines = ['#EXTM3U', '#EXT-X-VERSION:4', f'#EXT-X-TARGETDURATION:{max(int(duration + 0.999), 1)}']
+        if config["kind"] == "live":
+            current = int((time.time() - started_at) / duration)
+            first = max(current - config["segments"] + 1, 0)
+            indexes = range(first, current + 1)
+        else:
+            first = 0
+            indexes = range(config["segments"])
+        lines.append(f'#EXT-X-MEDIA-SEQUENCE:{first}')
+        if config["encrypted"]:
+            lines.append('#EXT-X-KEY:METHOD=AES-128,URI="key.bin"')
+        if config["kind"] == "byterange":
+            _, ranges = packed_file(name, config)
+        for index in indexes:
+            lines.append(f'#EXTINF:{duration:.3f},')
+            if config["kind"] == "byterange":
+                offset, length = ranges[index]
+                lines += [f'#EXT-X-BYTERANGE:{length}@{offset}', 'all.ts']
+            else:
+                lines.append(f'seg{index}.ts')
+        if config["kind"] != "live":
+            lines.append('#EXT-X-ENDLIST')
+        return '\n'.join(lines) + '\n'
+
+    async def send(request, body, config):
+        """按Range返回body，模拟延迟、错误、单连接带宽上限和传输中途的卡顿"""
+        await asyncio.sleep(config["latency_ms"] / 1000)
+        if config["error_rate"] and random.random() < config["error_rate"]:
+            return web.Response(status=503)
+
+        start, end, status = 0, len(body) - 1, 200
+        headers = {'Accept-Ranges': 'bytes', 'Content-Type': 'video/mp2t'}
+        range_header = request.headers.get('Range')
+        if range_header:
+            first, _, last = range_header.partition('=')[2].partition('-')
+            start = int(first)
+            end = min(int(last), len(body) - 1) if last else len(body) - 1
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{end}/{len(body)}'
+        headers['Content-Length'] = str(end - start + 1)
+        if request.method == 'HEAD':
+            return web.Response(status=status, headers=headers)
+
+        response = web.StreamResponse(status=status, headers=headers)
+        rate = config["bandwidth_kbps"] * 1024
+        stall_at = None
+        if config["stall_rate"] and random.random() < config["stall_rate"]:
+            stall_at = start + (end - start) // 2
+        sent = 0
+        began = time.monotonic()
+        try:
+            # 发送响应头时客户端也可能已经断开，同样属于正常取消
+            await response.prepare(request)
+            for offset in range(start, end + 1, ORIGIN_CHUNK_SIZE):
+                if stall_at is not None and offset >= stall_at:
+                    await asyncio.sleep(config["stall_seconds"])
+                    stall_at = None
+                chunk = body[offset:min(offset + ORIGIN_CHUNK_SIZE, end + 1)]
+                await response.write(chunk)
+                sent += len(chunk)
+                if rate:
+                    await asyncio.sleep(max(began + sent / rate - time.monotonic(), 0))
+            await response.write_eof()
+        except ConnectionError:
+            # 客户端取消了请求（对冲请求落败、拆分为Range子请求等）
+            pass
+        return response
+
+    def config_for(request):
+        name = request.match_info['name']
+        if name not in SCENARIOS:
+            raise web.HTTPNotFound()
+        return name, scenario_config(name)
+
+    async def index(request):
+        name, config = config_for(request)
+        return web.Response(text=playlist(name, config), content_type='application/vnd.apple.mpegurl')
+
+    async def segment(request):
+        name, config = config_for(request)
+        return await send(request, segment_body(name, int(request.match_info['index']), config), config)
+
+    async def packed_segment(request):
+        name, config = config_for(request)
+        body, _ = packed_file(name, config)
+        return await send(request, body, config)
+
+    async def key(request):
+        name, _ = config_for(request)
+        return web.Response(body=segment_key(name))
+
+    app = web.Application()
+    app.add_routes([
+        web.get('/{name}/index.m3u8', index),
+        web.get(r'/{name}/seg{index:\d+}.ts', segment),
+        web.get('/{name}/all.ts', packed_segment),
+        web.get('/{name}/key.bin', key),
+    ])
+    return app
+
+def run_origin(port, ready):
+    """源站子进程入口，源站与被测进程分开，不影响其内存和CPU的测量"""
+    from aiohttp import web
+
+    # 固定随机种子，每次运行注入的错误和卡顿相同
+    random.seed(0)
+
+    async def serve():
+        runner = web.AppRunner(build_origin(time.time()), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        ready.set()
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+# ---------------------------------------------------------------- 资源采样
+
+def current_rss():
+    """当前进程的常驻内存（字节），无法获取时返回None"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # 没有/proc时只能取到进程启动以来的峰值；macOS的单位是字节，其他系统是KB
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+class ResourceSampler:
+    """在后台线程中定期采样内存和临时目录占用，记录峰值"""
+
+    def __init__(self, temp_dir, interval=0.05):
+        self.temp_dir = temp_dir
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_disk = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        rss = current_rss()
+        if rss is not None:
+            self.peak_rss = max(self.peak_rss, rss)
+        self.peak_disk = max(self.peak_disk, directory_size(self.temp_dir))
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._sample()
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+# ---------------------------------------------------------------- 测试流程
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+async def run_scenario(server, name, base_url, output_dir, processes, max_retries):
+    """运行一个场景，返回指标"""
+    config = scenario_config(name)
+    url = f"{base_url}/{name}/index.m3u8"
+    output_path = os.path.join(output_dir, f"{name}.mp4")
+    live = config["kind"] == "live"
+    metrics = {"params": config}
+
+    started = time.perf_counter()
+    analysis = await server.analyze_m3u8(url)
+    metrics["analyze_s"] = round(time.perf_counter() - started, 3)
+    if analysis.startswith("分析失败"):
+        metrics["error"] = analysis
+        return metrics
+
+    rss_before = current_rss()
+    with ResourceSampler(server.TEMP_DIR) as sampler:
+        result = await server.download_m3u8_video(url, output_path, processes, max_retries, wait=True,
+                                                  live=live, max_duration=config["max_duration"])
+    job = server.scheduler.get(server.make_job_id(url, output_path))
+
+    elapsed = job.elapsed()
+    downloaded = job.segments_done - job.segments_resumed
+    times = list(job.segment_times)
+    p50 = server.percentile(times, 50)
+    p99 = server.percentile(times, 99)
+    metrics |= {
+        "ok": job.status == server.JOB_COMPLETED,
+        "elapsed_s": round(elapsed, 3),
+        "segments": downloaded,
+        "bytes": job.bytes_done,
+        "mb_per_s": round(job.bytes_done / (1024 * 1024) / elapsed, 2) if elapsed else None,
+        "segments_per_s": round(downloaded / elapsed, 1) if elapsed else None,
+        "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+        "p99_ms": round(p99 * 1000, 1) if p99 is not None else None,
+        "retries": job.retries,
+        "hedges_fired": job.hedges_fired,
+        "rss_before_mb": round(rss_before / (1024 * 1024), 1) if rss_before else None,
+        "peak_rss_mb": round(sampler.peak_rss / (1024 * 1024), 1) if sampler.peak_rss else None,
+        "peak_temp_disk_mb": round(sampler.peak_disk / (1024 * 1024), 1),
+    }
+    if not metrics["ok"]:
+        metrics["error"] = result
+    elif not live:
+        # 直播录制的片段范围取决于开始时间，只校验点播和字节范围场景的内容
+        metrics["verified"] = file_digest(output_path) == expected_digest(name, config)
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    return metrics
+
+# ---------------------------------------------------------------- 冷启动
+
+# 在新的解释器中导入下载引擎（stdio模式启动时加载的全部内容），输出导入耗时、导入后的常驻内存，
+# 以及启动时加载了哪些与下载无关或可以推迟的模块：fastapi只有mcp_server.py需要；
+# uvicorn、starlette和sse_starlette由MCP SDK（FastMCP及其底层Server）本身导入，stdio模式同样会加载
+STARTUP_PROBE = """
+import json, os, sys, time
+started = time.perf_counter()
+import m3u8_core
+elapsed = time.perf_counter() - started
+with open('/proc/self/statm') as f:
+    rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+print(json.dumps({"import_s": elapsed, "rss": rss,
+                  "eager_modules": [m for m in ("fastapi", "uvicorn", "starlette", "sse_starlette",
+                                                "aiohttp.client", "Crypto.Cipher._mode_cbc", "tqdm.std",
+                                                "prometheus_client")
+                                    if m in sys.modules and not type(sys.modules[m]).__name__.startswith("_Lazy")]}))
+"""
+
+async def measure_startup(workdir, repeat=3):
+    """
+    stdio模式的冷启动：导入下载引擎的耗时和常驻内存，以及从启动run_server.py到MCP客户端列出工具的耗时，
+    各运行repeat次取中位数。没有/proc的系统上不测量内存
+    """
+    from mcp import ClientSession, StdioServerParameters
+    from mcp.client.stdio import stdio_client
+
+    root = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=root)
+    probes = []
+    ready_times = []
+    for _ in range(repeat):
+        completed = subprocess.run([sys.executable, '-c', STARTUP_PROBE], capture_output=True, text=True,
+                                   cwd=workdir, env=env, timeout=60)
+        if completed.returncode == 0:
+            probes.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+
+        started = time.perf_counter()
+        params = StdioServerParameters(command=sys.executable, args=[os.path.join(root, 'run_server.py')],
+                                       cwd=workdir, env=env)
+        with open(os.devnull, 'w') as devnull:
+            async with stdio_client(params, errlog=devnull) as (read_stream, write_stream):
+                async with ClientSession(read_stream, write_stream) as session:
+                    await session.initialize()
+                    await session.list_tools()
+                    ready_times.append(time.perf_counter() - started)
+
+    probes.sort(key=lambda probe: probe["import_s"])
+    ready_times.sort()
+    median = probes[len(probes) // 2] if probes else {}
+    return {
+        "import_ms": round(median["import_s"] * 1000, 1) if median else None,
+        "rss_mb": round(median["rss"] / (1024 * 1024), 1) if median else None,
+        "tools_ready_ms": round(ready_times[len(ready_times) // 2] * 1000, 1),
+        "eager_modules": median.get("eager_modules"),
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def print_results(results, baseline=None):
+    columns = [("mb_per_s", "MB/s"), ("segments_per_s", "片段/s"), ("p50_ms", "p50(ms)"), ("p99_ms", "p99(ms)"),
+               ("peak_rss_mb", "内存峰值(MB)"), ("peak_temp_disk_mb", "临时目录峰值(MB)")]
+    for name, metrics in results["scenarios"].items():
+        if "error" in metrics:
+            print(f"{name}: 失败 - {metrics['error'].splitlines()[0]}")
+            continue
+        parts = []
+        old = (baseline or {}).get("scenarios", {}).get(name, {})
+        for key, title in columns:
+            value = metrics.get(key)
+            text = f"{title} {value}"
+            if isinstance(value, (int, float)) and isinstance(old.get(key), (int, float)) and old[key]:
+                text += f" ({(value - old[key]) / old[key]:+.0%})"
+            parts.append(text)
+        verified = {True: "，内容校验通过", False: "，内容校验失败"}.get(metrics.get("verified"), "")
+        print(f"{name}: " + ", ".join(parts) + verified)
+
+    startup = results.get("startup")
+    if startup:
+        old = (baseline or {}).get("startup", {})
+        parts = []
+        for key, title in [("import_ms", "导入(ms)"), ("rss_mb", "常驻内存(MB)"), ("tools_ready_ms", "启动到列出工具(ms)")]:
+            value = startup.get(key)
+            text = f"{title} {value}"
+            if isinstance(value, (int, float)) and isinstance(old.get(key), (int, float)) and old[key]:
+                text += f" ({(value - old[key]) / old[key]:+.0%})"
+            parts.append(text)
+        if startup.get("eager_modules"):
+            parts.append(f"启动时加载了 {', '.join(startup['eager_modules'])}")
+        print("stdio冷启动: " + ", ".join(parts))
+
+async def main():
+    parser = argparse.ArgumentParser(description='MCP M3U8视频下载服务器性能测试')
+    parser.add_argument('--scenarios', default=",".join(SCENARIOS),
+                        help=f'要运行的场景，逗号分隔，可选: {", ".join(SCENARIOS)}')
+    parser.add_argument('--processes', type=int, default=0, help='单个任务同时进行的片段请求数上限，0表示自动调整')
+    parser.add_argument('--max-retries', type=int, default=3, help='失败片段的最大重试次数')
+    parser.add_argument('--repeat', type=int, default=1, help='每个场景运行的次数，取下载耗时居中的一次')
+    parser.add_argument('--output', help='结果JSON的保存路径，默认为 benchmarks/<时间>-<版本>.json')
+    parser.add_argument('--compare', help='与之前保存的结果JSON对比')
+    parser.add_argument('--skip-startup', action='store_true', help='不测量stdio模式的冷启动')
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"未知的场景: {', '.join(unknown)}")
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    # 工作目录和清单放在临时目录中，测试结束后删除；必须在导入m3u8_core之前设置
+    workdir = tempfile.mkdtemp(prefix='m3u8-benchmark-')
+    os.environ["TEMP_DIR"] = os.path.join(workdir, "ts_files")
+    os.environ["DATA_DIR"] = os.path.join(workdir, "data")
+    import m3u8_core as server
+
+    # 在运行中的事件循环里fork会把循环状态带进子进程，源站用spawn方式启动
+    context = multiprocessing.get_context('spawn')
+    port = free_port()
+    ready = context.Event()
+    origin = context.Process(target=run_origin, args=(port, ready), daemon=True)
+    origin.start()
+    try:
+        if not ready.wait(30):
+            raise RuntimeError("本地源站启动失败")
+        base_url = f"http://127.0.0.1:{port}"
+        output_dir = os.path.join(workdir, "out")
+        os.makedirs(output_dir, exist_ok=True)
+
+        results = {
+            "created_at": time.strftime('%Y-%m-%dT%H:%M:%S'),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "settings": {
+                "processes": args.processes,
+                "max_retries": args.max_retries,
+                "max_concurrent_requests": server.scheduler.max_requests,
+                "max_requests_per_host": server.scheduler.max_requests_per_host,
+                "range_split_mb": server.RANGE_SPLIT_BYTES / (1024 * 1024),
+                "range_split_parts": server.RANGE_SPLIT_PARTS,
+                "hedge_percentile": server.HEDGE_PERCENTILE,
+                "repeat": args.repeat,
+            },
+            "scenarios": {},
+        }
+        for name in names:
+            runs = []
+            for attempt in range(max(args.repeat, 1)):
+                print(f"运行场景 {name} ({attempt + 1}/{max(args.repeat, 1)}) ...")
+                runs.append(await run_scenario(server, name, base_url, output_dir, args.processes, args.max_retries))
+            # 有失败时记录失败的一次，否则取耗时的中位数对应的一次，减少偶然波动
+            failed = [metrics for metrics in runs if "error" in metrics or metrics.get("verified") is False]
+            runs.sort(key=lambda metrics: metrics.get("elapsed_s") or 0)
+            results["scenarios"][name] = failed[0] if failed else runs[len(runs) // 2]
+        if not args.skip_startup:
+            print("测量stdio模式的冷启动 ...")
+            results["startup"] = await measure_startup(workdir, max(args.repeat, 3))
+    finally:
+        await server.http_pool.close()
+        origin.terminate()
+        origin.join()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = args.output or os.path.join("benchmarks", f"{time.strftime('%Y%m%d-%H%M%S')}-{results['revision'] or 'unknown'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, mode='w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+    print()
+    print_results(results, baseline)
+    print(f"\n结果已保存到: {output}")
+    if any("error" in metrics or metrics.get("verified") is False for metrics in results["scenarios"].values()):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("\n测试已取消")
+        sys.exit(0)
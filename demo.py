@@ -8,14 +8,14 @@ import os
 import asyncio
 import argparse
 import sys
-from mcp_server import analyze_m3u8, download_m3u8_video, check_download_status, clean_temp_files, server_name, server_description
+from m3u8_core import analyze_m3u8, download_m3u8_video, check_download_status, clean_temp_files, http_pool, server_name, server_description
 
 async def main():
     # 解析命令行参数
     parser = argparse.ArgumentParser(description=f'{server_name}: {server_description}')
     parser.add_argument('--url', help='m3u8文件的URL地址')
     parser.add_argument('--output', default='output.mp4', help='输出mp4文件的本地保存路径')
-    parser.add_argument('--processes', type=int, default=4, help='并行下载的进程数')
+    parser.add_argument('--processes', type=int, default=0, help='同时进行的片段请求数上限，0表示自动调整')
     parser.add_argument('--analyze', action='store_true', help='仅分析m3u8文件，不下载')
     parser.add_argument('--clean', action='store_true', help='清理临时文件')
     parser.add_argument('--status', action='store_true', help='检查下载状态')
@@ -48,7 +48,7 @@ async def main():
     # 下载视频
     print(f"正在从 {args.url} 下载视频...")
     print(f"输出文件: {args.output}")
-    print(f"并行进程数: {args.processes}")
+    print(f"并发请求数: {args.processes}")
     
     # 确保输出目录存在
     output_dir = os.path.dirname(os.path.abspath(args.output))
@@ -56,12 +56,18 @@ async def main():
         os.makedirs(output_dir, exist_ok=True)
     
     # 执行下载
-    result = await download_m3u8_video(args.url, args.output, args.processes)
+    result = await download_m3u8_video(args.url, args.output, args.processes, wait=True)
     print(result)
 
+async def run():
+    try:
+        await main()
+    finally:
+        await http_pool.close()
+
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        asyncio.run(run())
     except KeyboardInterrupt:
         print("\n下载已取消")
         sys.exit(0) 
\ No newline at end of file
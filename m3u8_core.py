@@ -0,0 +1,3714 @@
+import os
+import re
+import sys
+import asyncio
+import shutil
+import time
+import json
+import logging
+import importlib.util
+import uuid
+import random
+import tempfile
+import hashlib
+import threading
+import bisect
+import heapq
+import itertools
+import errno
+import contextlib
+import functools
+from urllib.parse import urlsplit, urljoin, parse_qsl, urlencode
+from collections import OrderedDict, deque
+
+from mcp.server import FastMCP
+from mcp.server.fastmcp import Context
+
+# 按需导入：返回的模块在首次访问其属性时才真正加载。stdio模式下客户端启动服务、列出工具时
+# 不需要HTTP客户端、AES和进度条，这些依赖推迟到第一次下载或分析时才导入
+def lazy_import(name):
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+aiohttp = lazy_import("aiohttp")
+AES = lazy_import("Crypto.Cipher.AES")
+tqdm = lazy_import("tqdm")
+
+# 下载过程的日志。FastMCP已按FASTMCP_LOG_LEVEL（默认INFO）把日志配置为输出到stderr，
+# stdio模式下不会混入stdout上的MCP协议消息
+logger = logging.getLogger(__name__)
+
+# 创建MCP服务器
+server_name = "MCP M3U8 Video Server"
+server_description = "一个用于下载、解密和合并m3u8视频的服务器"
+
+# 创建MCP服务器
+mcp = FastMCP(
+    name=server_name,
+    instructions=server_description
+)
+
+# 临时文件夹路径，每个下载任务在其中拥有独立的工作目录
+TEMP_DIR = os.environ.get("TEMP_DIR", "ts_files/")
+# 数据存储目录
+DATA_DIR = os.environ.get("DATA_DIR", "data/")
+
+# 断点续传清单目录
+MANIFEST_DIR = os.path.join(DATA_DIR, "manifests")
+# 性能追踪文件目录
+TRACE_DIR = os.path.join(DATA_DIR, "traces")
+# 以上目录都在第一次使用时创建，导入本模块不会在磁盘上留下任何东西
+
+# 通用请求头
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept': '*/*',
+    'Accept-Encoding': 'gzip, deflate',
+    'Connection': 'keep-alive'
+}
+
+# 请求超时（aiohttp.ClientTimeout的参数）：连接和读取各10秒（与之前requests的timeout=10语义一致）
+REQUEST_TIMEOUT = dict(total=None, sock_connect=10, sock_read=10)
+
+# 需要重试的HTTP状态码
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+class HttpPool:
+    """
+    进程内共享的HTTP连接池，所有工具调用和下载任务共用一个ClientSession
+    
+    连接保持keep-alive并在请求之间复用（复用的TLS连接不需要再次握手），DNS解析结果缓存ttl_dns_cache秒；
+    limit为连接总数上限，limit_per_host为单个源站的连接数上限。会话在首次使用时于当前事件循环中创建。
+    """
+    
+    def __init__(self, limit, limit_per_host, keepalive_timeout=30, ttl_dns_cache=300):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.ttl_dns_cache = ttl_dns_cache
+        self._session = None
+        self._loop = None
+        self.requests = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+    
+    def session(self):
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit, limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout, ttl_dns_cache=self.ttl_dns_cache,
+            )
+            trace = aiohttp.TraceConfig()
+            trace.on_request_start.append(self._on_request_start)
+            trace.on_connection_create_end.append(self._on_connection_create)
+            trace.on_connection_reuseconn.append(self._on_connection_reuse)
+            self._session = aiohttp.ClientSession(connector=connector, headers=HEADERS,
+                                                  timeout=aiohttp.ClientTimeout(**REQUEST_TIMEOUT), trace_configs=[trace])
+            self._loop = loop
+        return self._session
+    
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+    
+    async def _on_request_start(self, session, context, params):
+        self.requests += 1
+    
+    async def _on_connection_create(self, session, context, params):
+        self.connections_created += 1
+    
+    async def _on_connection_reuse(self, session, context, params):
+        self.connections_reused += 1
+    
+    @staticmethod
+    def _open_connections(connector):
+        """
+        连接器中使用中和空闲的连接数。aiohttp没有公开这两个数字，只能读取连接器的内部状态，
+        内部结构与预期不符（aiohttp版本变化）时返回None
+        """
+        try:
+            in_use = len(connector._acquired)
+            idle = sum(len(conns) for conns in connector._conns.values())
+        except (AttributeError, TypeError):
+            return None
+        return in_use, idle
+    
+    def stats(self):
+        """连接池统计信息"""
+        connector = self._session.connector if self._session is not None and not self._session.closed else None
+        counts = self._open_connections(connector) if connector else (0, 0)
+        connections = self.connections_created + self.connections_reused
+        return {
+            "连接数上限": f"{self.limit}（单源站 {self.limit_per_host}）",
+            "打开的连接": f"{sum(counts)}（使用中 {counts[0]}，空闲 {counts[1]}）" if counts else "未知",
+            "请求数": self.requests,
+            "新建连接": self.connections_created,
+            "复用连接": self.connections_reused,
+            "复用率": f"{self.connections_reused / connections:.1%}" if connections else "无",
+        }
+
+# 带重试机制的GET请求，返回响应内容
+async def fetch_bytes(session, url, retries=3, backoff_factor=0.3, headers=None):
+    for attempt in range(retries + 1):
+        try:
+            async with session.get(url, headers=headers) as response:
+                if response.status in RETRY_STATUS_CODES and attempt < retries:
+                    raise aiohttp.ClientResponseError(
+                        response.request_info, response.history,
+                        status=response.status, message=response.reason or ""
+                    )
+                response.raise_for_status()
+                return await response.read()
+        except aiohttp.ClientResponseError as e:
+            if e.status not in RETRY_STATUS_CODES or attempt >= retries:
+                raise
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt >= retries:
+                raise
+        await asyncio.sleep(backoff_factor * (2 ** attempt))
+
+class HlsKey:
+    """#EXT-X-KEY 描述的一个密钥，iv为播放列表中显式给出的IV（没有时为None）"""
+    __slots__ = ('method', 'uri', 'iv')
+    
+    def __init__(self, method, uri, iv=None):
+        self.method = method
+        self.uri = uri
+        self.iv = iv
+
+class InitSection:
+    """
+    #EXT-X-MAP 描述的媒体初始化片段（fMP4/CMAF的ftyp和moov），输出文件中位于使用它的片段之前
+    
+    byterange、key、iv的含义与Segment相同，key为#EXT-X-MAP之前最近的#EXT-X-KEY
+    """
+    __slots__ = ('url', 'byterange', 'key', 'iv')
+    
+    def __init__(self, url, byterange=None, key=None, iv=None):
+        self.url = url
+        self.byterange = byterange
+        self.key = key
+        self.iv = iv
+    
+    @property
+    def ident(self):
+        """标识同一个初始化片段，重新解析播放列表（续传、直播轮询）后仍然相同"""
+        return (self.url, self.byterange)
+
+class Segment:
+    """
+    媒体播放列表中的一个片段
+    
+    byterange为 (起始偏移, 长度)，不是字节范围片段时为None；
+    key为该片段使用的HlsKey，未加密时为None；iv为解密该片段实际使用的IV；
+    init为该片段使用的InitSection，没有#EXT-X-MAP时为None。
+    """
+    __slots__ = ('url', 'duration', 'byterange', 'key', 'iv', 'init')
+    
+    def __init__(self, url, duration, byterange=None, key=None, iv=None, init=None):
+        self.url = url
+        self.duration = duration
+        self.byterange = byterange
+        self.key = key
+        self.iv = iv
+        self.init = init
+
+# 片段及其初始化片段使用的密钥，返回 {URI: HlsKey}，按首次出现顺序排列
+def segment_keys(segments):
+    keys = {}
+    for segment in segments:
+        for key in (segment.init.key if segment.init else None, segment.key):
+            if key is not None and key.uri not in keys:
+                keys[key.uri] = key
+    return keys
+
+class MediaPlaylist:
+    """解析后的媒体播放列表"""
+    
+    def __init__(self):
+        self.segments = []
+        self.media_sequence = 0
+        self.target_duration = None
+        self.endlist = False
+        # 裁剪出的播放列表中第一个片段在原播放列表中的开始时间（秒）
+        self.time_offset = 0.0
+        self._offsets = None
+    
+    @property
+    def keys(self):
+        """按首次出现顺序排列的不同密钥（按URI去重），包括初始化片段使用的密钥"""
+        return list(segment_keys(self.segments).values())
+    
+    @property
+    def duration(self):
+        return self.offsets[-1]
+    
+    @property
+    def offsets(self):
+        """按#EXTINF累加的前缀和：offsets[i]为第i个片段的开始时间（秒），最后一项为总时长；片段不变时只计算一次"""
+        if self._offsets is None or len(self._offsets) != len(self.segments) + 1:
+            self._offsets = list(itertools.accumulate((segment.duration for segment in self.segments), initial=0.0))
+        return self._offsets
+    
+    def segment_range(self, start=0, end=0):
+        """
+        覆盖时间区间[start, end]（秒）的片段下标范围 (first, last)，不包含last；end为0时到结尾。
+        在前缀和上二分查找，区间的两端向外扩展到片段边界
+        """
+        offsets = self.offsets
+        count = len(self.segments)
+        # 包含start的片段：开始时间不晚于start的最后一个片段
+        first = min(bisect.bisect_right(offsets, start) - 1, count) if start > 0 else 0
+        # 开始时间早于end的片段都需要
+        last = min(bisect.bisect_left(offsets, end), count) if end else count
+        return first, max(first, last)
+    
+    def clip(self, start=0, end=0):
+        """只包含覆盖[start, end]的片段的播放列表，媒体序列号随之后移"""
+        first, last = self.segment_range(start, end)
+        if first == last:
+            range_text = f"{start:g}-{end:g} 秒内" if end else f"{start:g} 秒之后"
+            raise Exception(f"{range_text}没有片段（总时长 {self.duration:.1f} 秒）")
+        clipped = MediaPlaylist()
+        clipped.segments = self.segments[first:last]
+        clipped.media_sequence = self.media_sequence + first
+        clipped.target_duration = self.target_duration
+        clipped.endlist = self.endlist
+        clipped.time_offset = self.time_offset + self.offsets[first]
+        return clipped
+
+# 匹配属性列表中的一个 NAME=VALUE，VALUE可以是带引号的字符串（其中可能包含逗号）
+ATTRIBUTE_PATTERN = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+# #EXTINF开头的时长（秒）
+EXTINF_DURATION_PATTERN = re.compile(r'\s*-?(?:\d+\.?\d*|\.\d+)')
+
+# 解析 #EXT-X-KEY 等标签的属性列表，属性顺序任意
+def parse_attribute_list(text):
+    return {name: value.strip('"') for name, value in ATTRIBUTE_PATTERN.findall(text)}
+
+class MediaPlaylistParser:
+    """
+    逐行增量解析媒体播放列表，每遇到一个片段URI立即返回对应的Segment，不需要先拿到完整文本
+    
+    相对路径的片段URI直接拼接在播放列表所在目录之后，只有绝对路径、带协议或包含./..的URI才调用urljoin
+    """
+    
+    def __init__(self, m3u8_url):
+        self.m3u8_url = m3u8_url
+        self.playlist = MediaPlaylist()
+        self._base_url = urljoin(m3u8_url, '.')
+        self._key = None
+        self._map = None
+        self._duration = 0.0
+        self._byterange = None
+        # 每个资源上一个字节范围的结束位置，用于省略了@offset的 #EXT-X-BYTERANGE
+        self._range_ends = {}
+    
+    def resolve(self, uri):
+        if ':' in uri or uri.startswith(('/', '.', '?')) or '/.' in uri:
+            return urljoin(self.m3u8_url, uri)
+        return self._base_url + uri
+    
+    def feed(self, line):
+        """解析一行，是片段URI时返回新的Segment，否则返回None"""
+        line = line.strip()
+        if not line:
+            return None
+        playlist = self.playlist
+        
+        if line.startswith('#'):
+            tag, _, value = line.partition(':')
+            if tag == '#EXTINF':
+                # 时长之后可能是标题或IPTV常见的属性（如 -1 tvg-id="..."），只取开头的数字，负数或缺失时为0
+                match = EXTINF_DURATION_PATTERN.match(value)
+                self._duration = max(float(match.group()), 0.0) if match else 0.0
+            elif tag == '#EXT-X-BYTERANGE':
+                length, _, offset = value.partition('@')
+                self._byterange = (int(offset) if offset else None, int(length))
+            elif tag == '#EXT-X-KEY':
+                attrs = parse_attribute_list(value)
+                method = attrs.get('METHOD', 'NONE')
+                if method == 'NONE':
+                    self._key = None
+                elif 'URI' not in attrs:
+                    raise Exception('解析加密信息失败')
+                else:
+                    iv = attrs.get('IV')
+                    iv = bytes.fromhex(iv[2:].rjust(32, '0')) if iv else None
+                    self._key = HlsKey(method, self.resolve(attrs['URI']), iv)
+            elif tag == '#EXT-X-MAP':
+                attrs = parse_attribute_list(value)
+                if 'URI' not in attrs:
+                    raise Exception('解析初始化片段(#EXT-X-MAP)失败: 缺少URI')
+                byterange = None
+                if attrs.get('BYTERANGE'):
+                    length, _, offset = attrs['BYTERANGE'].partition('@')
+                    byterange = (int(offset or 0), int(length))
+                key = self._key
+                iv = None
+                if key is not None:
+                    # 没有显式IV时使用它之后第一个片段的媒体序列号
+                    iv = key.iv or (playlist.media_sequence + len(playlist.segments)).to_bytes(16, 'big')
+                self._map = InitSection(self.resolve(attrs['URI']), byterange, key, iv)
+            elif tag == '#EXT-X-MEDIA-SEQUENCE':
+                playlist.media_sequence = int(value)
+            elif tag == '#EXT-X-TARGETDURATION':
+                playlist.target_duration = float(value)
+            elif tag == '#EXT-X-ENDLIST':
+                playlist.endlist = True
+            elif tag == '#EXT-X-STREAM-INF':
+                raise Exception('这是主播放列表(master playlist)，请使用其中某个清晰度的m3u8地址')
+            return None
+        
+        # 非注释行是片段URI，相对路径相对于播放列表地址
+        ts_url = self.resolve(line)
+        byterange = self._byterange
+        if byterange is not None:
+            offset = byterange[0] if byterange[0] is not None else self._range_ends.get(ts_url, 0)
+            byterange = (offset, byterange[1])
+            self._range_ends[ts_url] = offset + byterange[1]
+        
+        key = self._key
+        iv = None
+        if key is not None:
+            # 没有显式IV时，使用片段的媒体序列号作为IV（大端128位）
+            iv = key.iv or (playlist.media_sequence + len(playlist.segments)).to_bytes(16, 'big')
+        
+        segment = Segment(ts_url, self._duration, byterange, key, iv, self._map)
+        playlist.segments.append(segment)
+        self._duration = 0.0
+        self._byterange = None
+        return segment
+    
+    def finish(self):
+        """所有行都已解析，返回完整的MediaPlaylist"""
+        if not self.playlist.segments:
+            raise Exception('未找到任何ts文件链接')
+        return self.playlist
+
+# 解析m3u8文本内容，返回MediaPlaylist
+def parse_m3u8_text(m3u8_text, m3u8_url):
+    parser = MediaPlaylistParser(m3u8_url)
+    for line in m3u8_text.splitlines():
+        parser.feed(line)
+    return parser.finish()
+
+class Variant:
+    """
+    主播放列表中的一个清晰度（#EXT-X-STREAM-INF），bandwidth和average_bandwidth单位为bit/s；
+    audio和subtitles为其使用的音频、字幕组（#EXT-X-MEDIA的GROUP-ID）
+    """
+    __slots__ = ('url', 'bandwidth', 'average_bandwidth', 'resolution', 'codecs', 'audio', 'subtitles')
+    
+    def __init__(self, url, bandwidth=0, average_bandwidth=None, resolution=None, codecs=None, audio=None, subtitles=None):
+        self.url = url
+        self.bandwidth = bandwidth
+        self.average_bandwidth = average_bandwidth
+        self.resolution = resolution
+        self.codecs = codecs
+        self.audio = audio
+        self.subtitles = subtitles
+    
+    @property
+    def pixels(self):
+        width, _, height = (self.resolution or '').partition('x')
+        return int(width) * int(height) if width.isdigit() and height.isdigit() else 0
+    
+    def describe(self):
+        parts = [self.resolution or "未知分辨率", f"{self.bandwidth / 1000:.0f}kbps"]
+        if self.codecs:
+            parts.append(self.codecs)
+        return " ".join(parts)
+
+class AlternateMedia:
+    """主播放列表中的一路备选音频或字幕（#EXT-X-MEDIA），uri为None时该媒体已包含在清晰度的播放列表中"""
+    __slots__ = ('type', 'group_id', 'name', 'language', 'default', 'autoselect', 'uri')
+    
+    def __init__(self, type, group_id, name, language=None, default=False, autoselect=False, uri=None):
+        self.type = type
+        self.group_id = group_id
+        self.name = name
+        self.language = language
+        self.default = default
+        self.autoselect = autoselect
+        self.uri = uri
+    
+    def describe(self):
+        return f"{self.name}" + (f"({self.language})" if self.language else "") + ("，默认" if self.default else "")
+
+class MasterPlaylist:
+    """解析后的主播放列表，variants按带宽从高到低排列，media为所有#EXT-X-MEDIA"""
+    
+    def __init__(self, variants, media=()):
+        self.variants = sorted(variants, key=lambda v: v.bandwidth, reverse=True)
+        self.media = list(media)
+    
+    def group(self, media_type, group_id):
+        """某个音频或字幕组中带URI的媒体"""
+        return [m for m in self.media if m.type == media_type and m.group_id == group_id and m.uri]
+
+# 解析主播放列表，返回MasterPlaylist
+def parse_master_playlist(m3u8_text, m3u8_url):
+    variants = []
+    media = []
+    attrs = None
+    for line in m3u8_text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-STREAM-INF:'):
+            attrs = parse_attribute_list(line.partition(':')[2])
+        elif line.startswith('#EXT-X-MEDIA:'):
+            media_attrs = parse_attribute_list(line.partition(':')[2])
+            media.append(AlternateMedia(
+                media_attrs.get('TYPE'),
+                media_attrs.get('GROUP-ID'),
+                media_attrs.get('NAME', ''),
+                language=media_attrs.get('LANGUAGE'),
+                default=media_attrs.get('DEFAULT') == 'YES',
+                autoselect=media_attrs.get('AUTOSELECT') == 'YES',
+                uri=urljoin(m3u8_url, media_attrs['URI']) if 'URI' in media_attrs else None,
+            ))
+        elif line and not line.startswith('#') and attrs is not None:
+            variants.append(Variant(
+                urljoin(m3u8_url, line),
+                bandwidth=int(attrs.get('BANDWIDTH', 0)),
+                average_bandwidth=int(attrs['AVERAGE-BANDWIDTH']) if 'AVERAGE-BANDWIDTH' in attrs else None,
+                resolution=attrs.get('RESOLUTION'),
+                codecs=attrs.get('CODECS'),
+                audio=attrs.get('AUDIO'),
+                subtitles=attrs.get('SUBTITLES'),
+            ))
+            attrs = None
+    if not variants:
+        raise Exception('主播放列表中没有找到任何清晰度')
+    return MasterPlaylist(variants, media)
+
+# 清晰度选择策略：bandwidth为带宽最高，resolution为分辨率最高（相同时取带宽高的）
+VARIANT_POLICIES = ("bandwidth", "resolution")
+
+# 按策略从主播放列表中选择清晰度；max_bandwidth（bit/s）不为0时只在不超过该带宽的清晰度中选择，
+# 都超过时选择带宽最低的
+def select_variant(master, policy="bandwidth", max_bandwidth=0):
+    if policy not in VARIANT_POLICIES:
+        raise Exception(f"不支持的清晰度选择策略: {policy}，可选: {', '.join(VARIANT_POLICIES)}")
+    candidates = [v for v in master.variants if not max_bandwidth or v.bandwidth <= max_bandwidth]
+    if not candidates:
+        return master.variants[-1]
+    if policy == "resolution":
+        return max(candidates, key=lambda v: (v.pixels, v.bandwidth))
+    return max(candidates, key=lambda v: v.bandwidth)
+
+# 主播放列表中随清晰度一起下载的备选媒体：default为默认音频和默认字幕，all为清晰度所属组中的全部音频和字幕，
+# video为只下载清晰度本身
+RENDITION_MODES = ("default", "all", "video")
+
+# 按mode从清晰度所属的音频组和字幕组中选择随其下载的#EXT-X-MEDIA，返回AlternateMedia列表（不含清晰度本身）
+def select_media(master, variant, mode="default"):
+    if mode not in RENDITION_MODES:
+        raise Exception(f"不支持的媒体选择方式: {mode}，可选: {', '.join(RENDITION_MODES)}")
+    if mode == "video":
+        return []
+    selected = []
+    for media_type, group_id in (("AUDIO", variant.audio), ("SUBTITLES", variant.subtitles)):
+        group = master.group(media_type, group_id) if group_id else []
+        if mode == "all":
+            selected += group
+        elif media_type == "AUDIO" and group:
+            # 音频总是需要一路：没有默认音频时取第一路
+            selected.append(next((m for m in group if m.default), group[0]))
+        else:
+            selected += [m for m in group if m.default]
+    return selected
+
+class PlaylistCache:
+    """
+    进程内的播放列表缓存，按URL保存原始文本和解析后的播放列表（MasterPlaylist或MediaPlaylist），供各个工具和任务共用
+    
+    缓存在ttl秒内直接使用；过期后带If-None-Match/If-Modified-Since重新验证，源站返回304时
+    继续使用已解析的结果。直播播放列表（没有ENDLIST）的有效期不超过其目标时长。
+    超过max_entries个URL时按最近最少使用（LRU）淘汰，max_entries为0时不缓存。
+    同一URL的并发请求合并为一次。响应体边接收边逐行解析，媒体播放列表的片段可以在接收完毕之前交给调用方。
+    """
+    
+    def __init__(self, max_entries=128, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        # URL -> {"text", "playlist", "etag", "last_modified", "expires"}，最久未访问的在最前面
+        self._entries = OrderedDict()
+        # URL -> 正在进行的请求任务，以及等待该任务的调用方数量
+        self._pending = {}
+        self._waiters = {}
+    
+    async def get(self, session, url, max_age=None, on_segments=None):
+        """
+        返回 (播放列表文本, MasterPlaylist或MediaPlaylist)。max_age为0时必须向源站重新验证（直播录制轮询时使用）
+        
+        on_segments为协程函数，确实向源站请求并接收到新的媒体播放列表时，每收到一批数据就以其中解析出的片段调用一次；
+        命中缓存、源站返回304或合并到其他调用方已发出的请求时不调用
+        """
+        entry = self._entries.get(url)
+        if entry is not None and max_age != 0 and time.monotonic() < entry["expires"]:
+            self._entries.move_to_end(url)
+            self.hits += 1
+            return entry["text"], entry["playlist"]
+        
+        pending = self._pending.get(url)
+        if pending is None:
+            pending = self._pending[url] = asyncio.ensure_future(self._fetch(session, url, entry, on_segments))
+            pending.add_done_callback(functools.partial(self._fetch_done, url))
+        self._waiters[url] = self._waiters.get(url, 0) + 1
+        try:
+            entry = await asyncio.shield(pending)
+        finally:
+            self._waiters[url] -= 1
+            # 等待的调用方都已取消时，请求的结果没有人使用，取消请求
+            if not self._waiters[url]:
+                del self._waiters[url]
+                pending.cancel()
+        return entry["text"], entry["playlist"]
+    
+    def _fetch_done(self, url, pending):
+        self._pending.pop(url, None)
+        # 请求失败时可能已经没有调用方在等待，在这里取出异常，避免"Task exception was never retrieved"
+        if not pending.cancelled():
+            pending.exception()
+    
+    async def _fetch(self, session, url, entry, on_segments=None):
+        headers = {}
+        if entry is not None:
+            if entry["etag"]:
+                headers['If-None-Match'] = entry["etag"]
+            if entry["last_modified"]:
+                headers['If-Modified-Since'] = entry["last_modified"]
+        async with open_response(session, url, headers) as response:
+            if response.status == 304 and entry is not None:
+                self.revalidated += 1
+            else:
+                self.misses += 1
+                text, playlist = await self._receive(response, url, on_segments)
+                entry = {
+                    "text": text,
+                    "playlist": playlist,
+                    "etag": response.headers.get('ETag'),
+                    "last_modified": response.headers.get('Last-Modified'),
+                }
+        ttl = self.ttl
+        playlist = entry["playlist"]
+        if isinstance(playlist, MediaPlaylist) and not playlist.endlist:
+            ttl = min(ttl, playlist.target_duration or 0)
+        entry["expires"] = time.monotonic() + ttl
+        if self.max_entries > 0:
+            self._entries[url] = entry
+            self._entries.move_to_end(url)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+    
+    @staticmethod
+    async def _receive(response, url, on_segments):
+        """边接收边逐行解析响应体，返回 (文本, 播放列表)；出现#EXT-X-STREAM-INF时按主播放列表解析全文"""
+        chunks = []
+        parser = MediaPlaylistParser(url)
+        master = False
+        rest = b''
+        async for data in response.content.iter_any():
+            chunks.append(data)
+            lines = (rest + data).split(b'\n')
+            rest = lines.pop()
+            if master:
+                continue
+            segments = []
+            for line in lines:
+                line = line.decode('utf-8', errors='replace').strip()
+                if line.startswith('#EXT-X-STREAM-INF'):
+                    master = True
+                    break
+                segment = parser.feed(line)
+                if segment is not None:
+                    segments.append(segment)
+            if segments and on_segments is not None:
+                await on_segments(segments)
+        
+        text = b''.join(chunks).decode('utf-8', errors='replace')
+        if master:
+            return text, parse_master_playlist(text, url)
+        segment = parser.feed(rest.decode('utf-8', errors='replace'))
+        if segment is not None and on_segments is not None:
+            await on_segments([segment])
+        return text, parser.finish()
+    
+    async def get_media(self, session, url, max_age=None, on_segments=None):
+        """与get相同，但要求是媒体播放列表"""
+        text, playlist = await self.get(session, url, max_age, on_segments)
+        if isinstance(playlist, MasterPlaylist):
+            raise Exception('这是主播放列表(master playlist)，请使用其中某个清晰度的m3u8地址')
+        return text, playlist
+    
+    def stats(self):
+        lookups = self.hits + self.revalidated + self.misses
+        return {
+            "播放列表数": f"{len(self._entries)} / {self.max_entries}",
+            "命中": self.hits,
+            "重新验证(304)": self.revalidated,
+            "未命中": self.misses,
+            "命中率": f"{(self.hits + self.revalidated) / lookups:.1%}" if lookups else "无",
+        }
+
+# 同一文件上相邻的字节范围片段合并为一个Range请求，单个请求的上限
+COALESCE_MAX_BYTES = 4 * 1024 * 1024
+COALESCE_MAX_SEGMENTS = 8
+
+# 把片段分组为请求，返回 (起始序号, 结束序号) 列表（不含结束序号）
+# 普通片段各自一个请求；同一文件上首尾相接的字节范围片段合并为一个请求
+def plan_requests(segments, start_index=0):
+    groups = []
+    group_start = start_index
+    for i in range(start_index + 1, len(segments) + 1):
+        if i < len(segments):
+            first, last, segment = segments[group_start], segments[i - 1], segments[i]
+            if (segment.byterange and last.byterange and segment.url == last.url
+                    and segment.byterange[0] == last.byterange[0] + last.byterange[1]
+                    and i - group_start < COALESCE_MAX_SEGMENTS
+                    and segment.byterange[0] + segment.byterange[1] - first.byterange[0] <= COALESCE_MAX_BYTES):
+                continue
+        groups.append((group_start, i))
+        group_start = i
+    return groups
+
+# 获取密钥（HlsKey列表，已按URI去重），每个不同的URI只请求一次，返回 {URI: 密钥}
+async def fetch_keys(session, keys):
+    for key in keys:
+        if key.method != 'AES-128':
+            raise Exception(f"不支持的加密方法: {key.method}，目前仅支持AES-128")
+    contents = await asyncio.gather(*(fetch_bytes(session, key.uri) for key in keys))
+    return {key.uri: content for key, content in zip(keys, contents)}
+
+# 获取初始化片段（InitSection）并解密，keys为 {URI: 密钥}，返回其内容
+async def fetch_init_section(session, init, keys):
+    headers = None
+    if init.byterange:
+        offset, length = init.byterange
+        headers = {'Range': f"bytes={offset}-{offset + length - 1}"}
+    data = await fetch_bytes(session, init.url, headers=headers)
+    if init.byterange and len(data) != length:
+        # 源站忽略了Range请求，从整个文件中截取
+        if len(data) < offset + length:
+            raise Exception(f"初始化片段不完整: {init.url} 只有{len(data)}字节")
+        data = data[offset:offset + length]
+    decryptor = SegmentDecryptor(keys[init.key.uri] if init.key else None, init.iv)
+    return decryptor.feed(data) + decryptor.finish()
+
+# 估算大小时同时进行的HEAD请求数
+PROBE_CONCURRENCY = 16
+
+class SizeEstimate:
+    """下载大小的估算结果（字节），low和high为估算范围（95%置信区间），method为估算方法"""
+    __slots__ = ('size', 'low', 'high', 'method')
+    
+    def __init__(self, size, low, high, method):
+        self.size = size
+        self.low = low
+        self.high = high
+        self.method = method
+    
+    def describe(self):
+        mb = 1024 * 1024
+        if self.high - self.low < mb * 0.01:
+            return f"{self.size / mb:.2f}（{self.method}）"
+        return f"{self.size / mb:.2f}（{self.low / mb:.2f} ~ {self.high / mb:.2f}，{self.method}）"
+
+# 获取片段的大小：优先使用HEAD请求的Content-Length，源站不支持HEAD时请求第一个字节，
+# 从Content-Range中读取总大小；无法获取时返回None
+async def probe_size(session, url):
+    try:
+        async with session.head(url, allow_redirects=True) as response:
+            if response.status < 400 and response.content_length is not None \
+                    and 'Content-Encoding' not in response.headers:
+                return response.content_length
+        async with session.get(url, headers={'Range': 'bytes=0-0'}) as response:
+            total = response.headers.get('Content-Range', '').rpartition('/')[2]
+            if response.status == 206 and total.isdigit():
+                return int(total)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        pass
+    return None
+
+# 估算媒体播放列表的下载大小，返回SizeEstimate，无法估算时返回None
+# 字节范围播放列表直接累加各片段的长度；否则对均匀分布的sample个片段（0为不采样）并发请求大小，
+# 按 大小/时长 的比例推算全部片段，并给出置信区间；都不可用时按bandwidth（bit/s）和总时长估算
+async def estimate_size(session, playlist, sample=10, bandwidth=None, peak_bandwidth=None):
+    segments = playlist.segments
+    if all(segment.byterange for segment in segments):
+        size = sum(segment.byterange[1] for segment in segments)
+        return SizeEstimate(size, size, size, "字节范围")
+    
+    count = len(segments)
+    if sample > 0:
+        k = min(sample, count)
+        indexes = sorted({round(i * (count - 1) / (k - 1)) for i in range(k)}) if k > 1 else [0]
+        semaphore = asyncio.Semaphore(PROBE_CONCURRENCY)
+        
+        async def probe(index):
+            async with semaphore:
+                return await probe_size(session, segments[index].url)
+        
+        sizes = await asyncio.gather(*(probe(i) for i in indexes))
+        probed = [(size, segments[i].duration) for i, size in zip(indexes, sizes) if size is not None]
+        if len(probed) == count:
+            size = sum(size for size, _ in probed)
+            return SizeEstimate(size, size, size, f"HEAD请求全部 {count} 个片段")
+        if probed:
+            total_duration = playlist.duration
+            durations = sum(d for _, d in probed)
+            if total_duration > 0 and durations > 0:
+                # 比率估计：每秒字节数 × 总时长
+                rate = sum(size for size, _ in probed) / durations
+                size = rate * total_duration
+                residuals = [size_i - rate * d for size_i, d in probed]
+            else:
+                rate = sum(size for size, _ in probed) / len(probed)
+                size = rate * count
+                residuals = [size_i - rate for size_i, _ in probed]
+            n = len(probed)
+            if n > 1:
+                variance = sum(r * r for r in residuals) / (n - 1)
+                margin = 1.96 * count * (variance * (1 - n / count) / n) ** 0.5
+            else:
+                margin = size * 0.5
+            return SizeEstimate(size, max(size - margin, 0), size + margin, f"HEAD采样 {n}/{count} 个片段")
+    
+    if bandwidth and playlist.duration:
+        size = bandwidth * playlist.duration / 8
+        high = max(peak_bandwidth or bandwidth, bandwidth) * playlist.duration / 8
+        return SizeEstimate(size, size, high, "BANDWIDTH × 总时长")
+    return None
+
+# 流式读取时每次处理的数据块大小
+STREAM_CHUNK_SIZE = 64 * 1024
+# 每个片段在内存中缓冲的上限，超出部分写入任务工作目录中的临时文件
+SEGMENT_SPOOL_BYTES = 1024 * 1024
+
+class SegmentDecryptor:
+    """
+    流式AES-128-CBC解密器
+    
+    密文分块送入feed，CBC的链接状态在块之间保持；最后一个16字节块暂不输出，
+    在finish时解密并去掉PKCS7填充。key为None时原样输出。
+    """
+    
+    def __init__(self, key, iv):
+        self._cipher = AES.new(key, AES.MODE_CBC, iv=iv) if key else None
+        self._pending = b''
+    
+    def feed(self, data):
+        if self._cipher is None:
+            return data
+        if self._pending:
+            data = self._pending + data
+        # 只解密完整的块，并始终保留最后一个块，它可能包含填充
+        usable = len(data) - len(data) % 16
+        if usable == len(data):
+            usable -= 16
+        if usable <= 0:
+            self._pending = data
+            return b''
+        self._pending = data[usable:]
+        return self._cipher.decrypt(data[:usable])
+    
+    def finish(self):
+        if self._cipher is None or not self._pending:
+            return b''
+        if len(self._pending) != 16:
+            raise Exception("密文长度不是16字节的整数倍")
+        last = self._cipher.decrypt(self._pending)
+        self._pending = b''
+        padding = last[-1]
+        if 1 <= padding <= 16 and last[-padding:] == bytes([padding]) * padding:
+            return last[:-padding]
+        return last
+
+# 从HTTP响应中截取 [skip, skip + length) 的数据块，length为None时一直读到结束
+async def iter_response(response, skip=0, length=None):
+    async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+        if skip:
+            if len(chunk) <= skip:
+                skip -= len(chunk)
+                continue
+            chunk = chunk[skip:]
+            skip = 0
+        if length is not None:
+            chunk = chunk[:length]
+            length -= len(chunk)
+        yield chunk
+        if length == 0:
+            break
+
+# 分块读取本地文件中 [offset, offset + length) 的内容，length为None时一直读到文件末尾
+async def iter_file(path, offset=0, length=None):
+    with open(path, mode='rb') as f:
+        f.seek(offset)
+        while length is None or length > 0:
+            chunk = await asyncio.to_thread(f.read, STREAM_CHUNK_SIZE if length is None else min(STREAM_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            if length is not None:
+                length -= len(chunk)
+            yield chunk
+
+# 打开GET请求的响应，连接失败或返回可重试的状态码时按fetch_bytes相同的策略重试
+@contextlib.asynccontextmanager
+async def open_response(session, url, headers=None, retries=3, backoff_factor=0.3):
+    for attempt in range(retries + 1):
+        try:
+            response = await session.get(url, headers=headers)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt >= retries:
+                raise
+        else:
+            if response.status in RETRY_STATUS_CODES and attempt < retries:
+                response.release()
+            else:
+                try:
+                    response.raise_for_status()
+                    yield response
+                finally:
+                    response.release()
+                return
+        await asyncio.sleep(backoff_factor * (2 ** attempt))
+
+# 源站忽略Range请求、对字节范围片段返回整个文件时，把整个文件下载到任务工作目录，返回文件路径。
+# 同一文件的各组片段都从这个文件中截取，整个文件只下载一次
+async def fetch_whole_file(session, job, url):
+    path = os.path.join(job.workspace, f"{hashlib.sha1(url.encode('utf-8')).hexdigest()[:12]}.whole")
+    with job.span("下载整个文件", "segment", "整个文件", url=url) as span:
+        with open(path, mode='wb') as f:
+            async with open_response(session, url) as response:
+                async for chunk in iter_response(response):
+                    f.write(chunk)
+            span["bytes"] = f.tell()
+    return path
+
+# 一次请求的数据量达到RANGE_SPLIT_MB且源站支持Range时，拆分为至多RANGE_SPLIT_PARTS个并行的Range子请求，
+# 按顺序拼接后再解密，突破单个连接的速度限制。RANGE_SPLIT_PARTS为1时不拆分。
+# 每个子请求与普通请求一样占用一个请求名额，名额不足时少拆分或不拆分
+RANGE_SPLIT_BYTES = int(float(os.environ.get("RANGE_SPLIT_MB", "16")) * 1024 * 1024)
+RANGE_SPLIT_PARTS = max(int(os.environ.get("RANGE_SPLIT_PARTS", "4")), 1)
+
+# 不等待地为Range子请求占用至多count个请求名额（任务自身的上限，以及调度器的全局和单源站并发限制），
+# 返回占用的数目。原请求已经占着名额，子请求如果排队等待，可能与其他占着名额的原请求互相等待
+async def reserve_range_slots(job, url, count):
+    reserved = 0
+    while reserved < count and not job.request_slots.locked():
+        if not scheduler.try_request_slot(url):
+            break
+        # 没有被占满时不会等待
+        await job.request_slots.acquire()
+        reserved += 1
+    return reserved
+
+# 归还reserve_range_slots占用的一个名额；task为使用该名额的子请求，其测量数据sample反馈给源站的并发控制器
+def release_range_slot(job, url, sample, task=None):
+    job.request_slots.release()
+    cancelled = task is None or task.cancelled()
+    scheduler.release_request_slot(url, sample, None if cancelled else task.exception(), cancelled)
+
+# 用Range子请求下载 [start, start+size) 到缓冲文件，首字节延迟记录在sample中（数据量计入原请求）
+async def fetch_range(session, job, url, start, size, sample):
+    spool = tempfile.SpooledTemporaryFile(SEGMENT_SPOOL_BYTES, dir=job.workspace)
+    try:
+        started = time.monotonic()
+        async with open_response(session, url, {'Range': f'bytes={start}-{start + size - 1}'}) as response:
+            sample.latency = time.monotonic() - started
+            if response.status != 206:
+                raise Exception(f"源站没有返回请求的字节范围: HTTP {response.status}")
+            async for chunk in iter_response(response, 0, size):
+                spool.write(chunk)
+        if spool.tell() != size:
+            raise Exception(f"字节范围 {start}-{start + size - 1} 不完整: 只收到{spool.tell()}字节")
+        spool.seek(0)
+        return spool
+    except BaseException:
+        spool.close()
+        raise
+
+# 读取一次请求的数据流。数据量足够大、源站支持Range且有空闲的请求名额时，原响应只读取第一部分，
+# 其余部分同时用Range子请求下载，按顺序输出
+async def iter_ranges(session, job, url, response, byterange=None):
+    if byterange:
+        offset, length = byterange
+        ranged = response.status == 206
+    else:
+        offset, length = 0, response.content_length
+        ranged = (response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+                  and 'Content-Encoding' not in response.headers)
+    reserved = 0
+    if ranged and length is not None and RANGE_SPLIT_PARTS >= 2 and length >= RANGE_SPLIT_BYTES:
+        reserved = await reserve_range_slots(job, url, RANGE_SPLIT_PARTS - 1)
+    if not reserved:
+        async for chunk in iter_response(response):
+            yield chunk
+        return
+    
+    part_size = -(-length // (reserved + 1))
+    tasks = []
+    for start in range(part_size, length, part_size):
+        sample = RequestSample()
+        task = asyncio.create_task(fetch_range(session, job, url, offset + start, min(part_size, length - start), sample))
+        # 子请求结束（包括还没开始就被取消）时归还名额
+        task.add_done_callback(functools.partial(release_range_slot, job, url, sample))
+        tasks.append(task)
+    for _ in range(reserved - len(tasks)):
+        release_range_slot(job, url, RequestSample())
+    try:
+        received = 0
+        async for chunk in iter_response(response, 0, part_size):
+            received += len(chunk)
+            yield chunk
+        if received != part_size:
+            raise Exception(f"响应不完整: 第一部分只收到{received}字节")
+        for task in tasks:
+            spool = await task
+            try:
+                while chunk := spool.read(STREAM_CHUNK_SIZE):
+                    yield chunk
+            finally:
+                spool.close()
+    finally:
+        for task in tasks:
+            task.cancel()
+        for result in await asyncio.gather(*tasks, return_exceptions=True):
+            if not isinstance(result, BaseException):
+                result.close()
+
+# 把一次请求的数据流按字节范围拆分到各个片段，边接收边解密，
+# 解密后的内容写入各片段的缓冲文件（小于SEGMENT_SPOOL_BYTES时只在内存中）。返回解密所用的时间（秒）
+async def decrypt_stream(chunks, segments, keys, spools, cache_file=None):
+    decryptors = [SegmentDecryptor(keys[s.key.uri] if s.key else None, s.iv) for s in segments]
+    k = 0
+    remaining = segments[0].byterange[1] if segments[0].byterange else None
+    decrypt_time = 0.0
+    async for chunk in chunks:
+        if cache_file is not None:
+            cache_file.write(chunk)
+        while chunk and k < len(segments):
+            if remaining is None:
+                piece, chunk = chunk, b''
+            else:
+                piece, chunk = chunk[:remaining], chunk[remaining:]
+                remaining -= len(piece)
+            t = time.perf_counter()
+            data = decryptors[k].feed(piece)
+            tail = decryptors[k].finish() if remaining == 0 else b''
+            decrypt_time += time.perf_counter() - t
+            spools[k].write(data)
+            if remaining == 0:
+                spools[k].write(tail)
+                k += 1
+                remaining = segments[k].byterange[1] if k < len(segments) else None
+    if remaining is None and k < len(segments):
+        t = time.perf_counter()
+        tail = decryptors[k].finish()
+        decrypt_time += time.perf_counter() - t
+        spools[k].write(tail)
+        k += 1
+    if k < len(segments):
+        raise Exception(f"字节范围不完整: 还缺少{remaining}字节")
+    return decrypt_time
+
+# 片段请求失败后重试的退避时间：第n次重试前等待 RETRY_BACKOFF_BASE * 2^(n-1) 秒（不超过RETRY_BACKOFF_MAX），
+# 再乘以0.5~1之间的随机系数，避免同时失败的大量片段在同一时刻重试
+RETRY_BACKOFF_BASE = 0.3
+RETRY_BACKOFF_MAX = 10.0
+
+def retry_delay(attempt):
+    delay = min(RETRY_BACKOFF_BASE * (2 ** (attempt - 1)), RETRY_BACKOFF_MAX)
+    return delay * random.uniform(0.5, 1.0)
+
+# 对冲请求：一组片段的请求发出后（排队等待请求名额的时间不算），耗时超过本任务已完成请求耗时的
+# HEDGE_PERCENTILE分位数时，再发出一个相同的请求，采用先完成的结果并取消另一个。0为关闭；
+# 已完成的请求少于HEDGE_MIN_SAMPLES个时不对冲，等待中的请求每隔HEDGE_RECHECK秒按新的样本重新计算阈值。
+# HEDGE_HOSTS可以为对冲请求指定备用源站，格式为 "源站=备用源站,源站2=备用源站2"
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", "0"))
+HEDGE_MIN_SAMPLES = int(os.environ.get("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_RECHECK = 0.25
+HEDGE_HOSTS = dict(item.strip().split("=", 1) for item in os.environ.get("HEDGE_HOSTS", "").split(",") if "=" in item)
+# 用于计算分位数的最近请求耗时数
+SEGMENT_TIME_WINDOW = 1000
+
+def percentile(values, p):
+    """values中第p百分位的值（最近秩法），values为空时返回None"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(len(ordered) * p / 100 + 0.5) - 1))]
+
+# Prometheus监控指标（/metrics），片段级指标都按源站（host）区分
+# 请求耗时的分桶（秒）；解密和写入是本地操作，使用更细的分桶
+REQUEST_TIME_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+LOCAL_TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+class NullMetric:
+    """register_metrics()之前使用的占位指标，记录操作什么也不做"""
+    
+    def labels(self, *values):
+        return self
+    
+    def inc(self, amount=1):
+        pass
+    
+    def observe(self, amount):
+        pass
+
+# stdio模式没有/metrics端点，指标保持为占位对象，也不导入prometheus_client；
+# HTTP/SSE服务启动时调用register_metrics()换成真正的Prometheus指标
+SEGMENT_FIRST_BYTE_SECONDS = SEGMENT_FETCH_SECONDS = SEGMENT_DECRYPT_SECONDS = NullMetric()
+SEGMENT_WRITE_SECONDS = DOWNLOADED_BYTES = SEGMENT_CACHE_HITS = NullMetric()
+SEGMENT_RETRIES = SEGMENT_FAILURES = NullMetric()
+
+def register_metrics():
+    """创建片段级Prometheus指标并注册调度器指标，重复调用时不做任何事"""
+    global SEGMENT_FIRST_BYTE_SECONDS, SEGMENT_FETCH_SECONDS, SEGMENT_DECRYPT_SECONDS, SEGMENT_WRITE_SECONDS
+    global DOWNLOADED_BYTES, SEGMENT_CACHE_HITS, SEGMENT_RETRIES, SEGMENT_FAILURES
+    if not isinstance(SEGMENT_RETRIES, NullMetric):
+        return
+    from prometheus_client import Counter, Histogram, REGISTRY
+    
+    SEGMENT_FIRST_BYTE_SECONDS = Histogram(
+        "m3u8_segment_first_byte_seconds", "片段请求的首字节延迟", ["host"], buckets=REQUEST_TIME_BUCKETS)
+    SEGMENT_FETCH_SECONDS = Histogram(
+        "m3u8_segment_fetch_seconds", "片段请求从发出到接收并解密完毕的耗时", ["host"], buckets=REQUEST_TIME_BUCKETS)
+    SEGMENT_DECRYPT_SECONDS = Histogram(
+        "m3u8_segment_decrypt_seconds", "每次片段请求中解密所用的时间", ["host"], buckets=LOCAL_TIME_BUCKETS)
+    SEGMENT_WRITE_SECONDS = Histogram(
+        "m3u8_segment_write_seconds", "每个片段追加到输出文件的耗时", ["host"], buckets=LOCAL_TIME_BUCKETS)
+    DOWNLOADED_BYTES = Counter(
+        "m3u8_downloaded_bytes", "从源站下载的片段数据量（解密后，不含片段缓存命中）", ["host"])
+    SEGMENT_CACHE_HITS = Counter(
+        "m3u8_segment_cache_hits", "命中片段缓存的请求数", ["host"])
+    SEGMENT_RETRIES = Counter(
+        "m3u8_segment_retries", "片段请求失败后的重试次数", ["host", "error_class"])
+    SEGMENT_FAILURES = Counter(
+        "m3u8_segment_failures", "重试后仍然失败的片段请求数", ["host", "error_class"])
+    REGISTRY.register(SchedulerCollector(scheduler))
+
+# 片段下载结果状态
+SEGMENT_OK = "ok"
+SEGMENT_CACHED = "cached"
+SEGMENT_FAILED = "failed"
+SEGMENT_SKIPPED = "skipped"
+
+class SegmentResult:
+    """
+    一组片段（一次请求）的下载结果
+    
+    index为第一个片段的序号，count为片段数，attempts为请求次数（包括重试），
+    error为最后一次失败的异常，成功时为None。
+    """
+    __slots__ = ('index', 'url', 'count', 'attempts', 'status', 'error')
+    
+    def __init__(self, index, url, count=1):
+        self.index = index
+        self.url = url
+        self.count = count
+        self.attempts = 0
+        self.status = None
+        self.error = None
+    
+    @property
+    def error_class(self):
+        return type(self.error).__name__ if self.error is not None else None
+    
+    def describe(self):
+        """失败原因的可读描述"""
+        indexes = f"#{self.index}" if self.count == 1 else f"#{self.index}-{self.index + self.count - 1}"
+        kind = "下载失败" if isinstance(self.error, (aiohttp.ClientError, asyncio.TimeoutError)) else "处理失败"
+        return f"{kind}: 片段{indexes} {self.url}, 尝试{self.attempts}次, 错误: {self.error_class}: {self.error}"
+
+# 下载并解密一组片段（一次请求），受任务自身的请求数上限以及调度器的全局和单源站并发限制；
+# 启用片段缓存时优先从本地读取；源站忽略Range请求时，字节范围片段从只下载一次的整个文件中截取。返回 (每个片段的缓冲文件列表（已定位到末尾）, 是否命中片段缓存)，失败时抛出异常；
+# host不为空时向该源站请求（对冲请求使用的备用源站），片段缓存仍按原地址查找；
+# 开启追踪时在track轨道上记录排队和下载区间；issued不为None时，在占到请求名额、真正发出请求时设置为发出的时间
+async def process_one_url(session, job, segments, keys, host=None, track=None, issued=None):
+    ts_url = segments[0].url
+    request_url = urlsplit(ts_url)._replace(netloc=host).geturl() if host else ts_url
+    byterange = None
+    headers = None
+    if segments[0].byterange:
+        start = segments[0].byterange[0]
+        end = segments[-1].byterange[0] + segments[-1].byterange[1]
+        byterange = (start, end - start)
+        headers = {'Range': f'bytes={start}-{end - 1}'}
+    
+    host = urlsplit(request_url).netloc
+    spools = [tempfile.SpooledTemporaryFile(SEGMENT_SPOOL_BYTES, dir=job.workspace) for _ in segments]
+    cache_file = None
+    completed = False
+    try:
+        cached_path = segment_cache.lookup(ts_url, byterange) if segment_cache.enabled else None
+        if cached_path:
+            with job.span("读取片段缓存", "segment", track, url=ts_url):
+                decrypt_time = await decrypt_stream(iter_file(cached_path), segments, keys, spools)
+            SEGMENT_CACHE_HITS.labels(host).inc()
+            SEGMENT_DECRYPT_SECONDS.labels(host).observe(decrypt_time)
+        elif byterange and ts_url in job.whole_files:
+            # 已知源站对该文件忽略Range请求，不再单独请求，等整个文件下载完后截取
+            with job.span("截取整个文件", "segment", track, url=ts_url):
+                path = await asyncio.shield(job.whole_files[ts_url])
+                decrypt_time = await decrypt_stream(iter_file(path, *byterange), segments, keys, spools)
+            SEGMENT_DECRYPT_SECONDS.labels(host).observe(decrypt_time)
+            DOWNLOADED_BYTES.labels(host).inc(sum(spool.tell() for spool in spools))
+        else:
+            job.hosts.add(host)
+            queued = time.monotonic()
+            async with job.request_slots, scheduler.request_slot(request_url, job) as sample:
+                started = time.monotonic()
+                if issued is not None and not issued.done():
+                    issued.set_result(started)
+                if job.trace is not None:
+                    job.trace.add("排队", "segment", track, queued, started, {"url": request_url})
+                with job.span("下载", "segment", track, url=request_url, segments=len(segments)) as span:
+                    # 限流和服务端错误不在这里重试，交给并发控制器降低并发后由上层重试
+                    async with open_response(session, request_url, headers, retries=0) as response:
+                        sample.latency = time.monotonic() - started
+                        if byterange and response.status != 206:
+                            # 源站忽略了Range请求，返回了整个文件：每组片段各自读取会重复下载文件的前面部分，
+                            # 改为整个文件只下载一次，本组和之后的各组都从中截取
+                            whole = job.whole_files.get(ts_url)
+                            if whole is None:
+                                whole = job.whole_files[ts_url] = asyncio.ensure_future(
+                                    fetch_whole_file(session, job, request_url))
+                                # 下载失败时移除，重试的片段重新检测
+                                whole.add_done_callback(
+                                    lambda task: task.cancelled() or task.exception() is None
+                                    or job.whole_files.pop(ts_url, None))
+                            response.release()
+                            chunks = iter_file(await asyncio.shield(whole), *byterange)
+                        else:
+                            if segment_cache.enabled:
+                                cache_key, cache_file = segment_cache.open_writer(ts_url, byterange)
+                            chunks = iter_ranges(session, job, request_url, response, byterange)
+                        async with contextlib.aclosing(chunks):
+                            decrypt_time = await decrypt_stream(chunks, segments, keys, spools, cache_file)
+                    sample.nbytes = sum(spool.tell() for spool in spools)
+                    span |= {"bytes": sample.nbytes, "first_byte_ms": round(sample.latency * 1000, 1),
+                             "decrypt_ms": round(decrypt_time * 1000, 1)}
+                elapsed = time.monotonic() - started
+                job.request_time += elapsed
+                job.record_request_time(elapsed)
+            SEGMENT_FIRST_BYTE_SECONDS.labels(host).observe(sample.latency)
+            SEGMENT_FETCH_SECONDS.labels(host).observe(elapsed)
+            SEGMENT_DECRYPT_SECONDS.labels(host).observe(decrypt_time)
+            DOWNLOADED_BYTES.labels(host).inc(sample.nbytes)
+            if cache_file is not None:
+                segment_cache.commit(cache_key, cache_file)
+                cache_file = None
+        completed = True
+    finally:
+        if cache_file is not None:
+            segment_cache.discard(cache_file)
+        # 失败或被取消时释放缓冲文件
+        if not completed:
+            for spool in spools:
+                spool.close()
+    return spools, cached_path is not None
+
+class SegmentWriter:
+    """
+    按片段序号顺序流式写入输出文件
+    
+    下一个待写入的片段一到达就直接追加到文件末尾，乱序到达的片段暂存在重排缓冲区中。
+    只有序号落在 [next_index, next_index + window) 内的片段才允许开始下载，
+    因此缓冲区中最多只有window个片段，内存占用有上限。
+    
+    片段内容以缓冲文件（SpooledTemporaryFile）的形式提交，写入后关闭；提交None表示跳过该片段。
+    片段带有初始化片段（fMP4的#EXT-X-MAP）且与上一个写入的不同时，先写入初始化片段，
+    它计入该片段的大小和校验和；init为文件中已写入的最后一个初始化片段的ident。
+    续传时start_index为已写入的片段数，新片段追加在文件现有内容之后；
+    每写入一个片段会在写入线程中调用on_commit(index, size, sha1)；trace不为None时在track轨道上记录写入区间。
+    """
+    
+    def __init__(self, filename, window, start_index=0, on_commit=None, trace=None, track=None, init=None):
+        self.filename = filename
+        self.window = window
+        self.next_index = start_index
+        self.init = init
+        self.bytes_written = 0
+        self.aborted = False
+        self.on_commit = on_commit
+        self.trace = trace
+        self.track = track
+        self._buffer = {}
+        self._file = open(filename, mode='ab' if start_index else 'wb')
+        # 序号 -> 等待该序号进入写入窗口的Future。窗口每前进一格只唤醒刚进入窗口的序号的等待者
+        self._waiters = {}
+        self._flush_lock = asyncio.Lock()
+    
+    async def wait_for_slot(self, index):
+        """等待片段进入写入窗口，写入器已中止时返回False"""
+        if not self.aborted and index >= self.next_index + self.window:
+            waiter = self._waiters.get(index)
+            if waiter is None:
+                waiter = self._waiters[index] = asyncio.get_running_loop().create_future()
+            # 同一序号可能有多个等待者，其中一个被取消时不影响其他等待者
+            await asyncio.shield(waiter)
+        return not self.aborted
+    
+    async def write(self, index, spool, host="", init=None):
+        """
+        提交一个片段（host为片段的源站，用于写入耗时指标；init为其初始化片段的 (ident, 内容)），
+        并把从next_index开始连续的片段依次写入文件
+        """
+        if self.aborted:
+            if spool is not None:
+                spool.close()
+            return
+        self._buffer[index] = (spool, host, init)
+        # 只有提交next_index的片段负责写入；正在写入时由写入中的调用方接着写入这个片段，
+        # 其他片段提交后立即返回，不必等待前面的片段
+        if index != self.next_index or self._flush_lock.locked():
+            return
+        async with self._flush_lock:
+            while not self.aborted and self.next_index in self._buffer:
+                spool, host, init = self._buffer.pop(self.next_index)
+                if spool is not None:
+                    prefix = b''
+                    if init is not None and init[0] != self.init:
+                        self.init, prefix = init
+                    self.bytes_written += await asyncio.to_thread(
+                        self._copy_segment, self.next_index, spool, host, prefix)
+                self.next_index += 1
+                waiter = self._waiters.pop(self.next_index + self.window - 1, None)
+                if waiter is not None and not waiter.done():
+                    waiter.set_result(None)
+    
+    def _copy_segment(self, index, spool, host, prefix=b''):
+        """把prefix（初始化片段）和缓冲文件分块追加到输出文件，同时计算大小和校验和"""
+        started = time.monotonic()
+        digest = hashlib.sha1(prefix)
+        self._file.write(prefix)
+        size = len(prefix)
+        with spool:
+            spool.seek(0)
+            while True:
+                chunk = spool.read(SEGMENT_SPOOL_BYTES)
+                if not chunk:
+                    break
+                self._file.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+        finished = time.monotonic()
+        SEGMENT_WRITE_SECONDS.labels(host).observe(finished - started)
+        if self.trace is not None:
+            self.trace.add("写入", "write", self.track, started, finished, {"index": index, "bytes": size})
+        if self.on_commit:
+            self.on_commit(index, size, digest.hexdigest())
+        return size
+    
+    async def abort(self):
+        """中止写入，唤醒所有等待中的片段"""
+        self.aborted = True
+        for spool, _, _ in self._buffer.values():
+            if spool is not None:
+                spool.close()
+        self._buffer.clear()
+        for waiter in self._waiters.values():
+            if not waiter.done():
+                waiter.set_result(None)
+        self._waiters.clear()
+    
+    def close(self):
+        self._file.close()
+
+class SegmentManifest:
+    """
+    断点续传清单，保存在 DATA_DIR/manifests/<任务ID>.json（备选音频、字幕为 <任务ID>.<名称>.json）
+    
+    记录任务的播放列表、密钥以及每个片段的状态、大小和校验和。片段按顺序写入输出文件，
+    因此已完成的片段总是从0开始连续的一段；续传时逐段校验.part文件，只下载其余片段。
+    边接收播放列表边下载时，片段和密钥随解析逐批加入，播放列表接收完毕后才写入其文本，
+    在此之前中断的清单不能用于续传。
+    """
+    
+    # 两次保存之间的最小间隔（秒），避免每个片段都重写整个清单
+    SAVE_INTERVAL = 2.0
+    
+    def __init__(self, path, data):
+        self.path = path
+        self.data = data
+        self._last_save = 0.0
+        # mark_done在写入线程中调用，与事件循环中的extend互斥
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def create(cls, job, rendition, playlist_text, keys, segments):
+        data = {
+            "job_id": job.job_id,
+            "m3u8_url": rendition.url,
+            "output_path": os.path.abspath(rendition.output_path),
+            "playlist": playlist_text,
+            "keys": {uri: key.hex() for uri, key in keys.items()},
+            "clip": [job.start, job.end],
+            "segments": [{"url": segment.url, "state": "pending", "size": 0, "sha1": None} for segment in segments],
+        }
+        os.makedirs(MANIFEST_DIR, exist_ok=True)
+        manifest = cls(os.path.join(MANIFEST_DIR, f"{rendition.manifest_id(job)}.json"), data)
+        manifest.save(force=True)
+        return manifest
+    
+    @classmethod
+    def load(cls, job, rendition):
+        """读取任务中某一路媒体的清单，不存在或与任务不匹配时返回None"""
+        path = os.path.join(MANIFEST_DIR, f"{rendition.manifest_id(job)}.json")
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get("m3u8_url") != rendition.url or data.get("output_path") != os.path.abspath(rendition.output_path):
+            return None
+        if data.get("clip", [0, 0]) != [job.start, job.end]:
+            return None
+        if "keys" not in data or data.get("playlist") is None:
+            return None
+        return cls(path, data)
+    
+    @property
+    def segments(self):
+        return self.data["segments"]
+    
+    @property
+    def keys(self):
+        """{密钥URI: 密钥}"""
+        return {uri: bytes.fromhex(key) for uri, key in self.data["keys"].items()}
+    
+    def extend(self, segments, keys):
+        """加入新解析出的片段，keys为目前已获取的全部密钥"""
+        with self._lock:
+            self.data["keys"] = {uri: key.hex() for uri, key in keys.items()}
+            self.segments.extend({"url": segment.url, "state": "pending", "size": 0, "sha1": None} for segment in segments)
+    
+    def complete(self, playlist_text):
+        """播放列表已接收完毕，保存其文本"""
+        with self._lock:
+            self.data["playlist"] = playlist_text
+        self.save(force=True)
+    
+    def mark_done(self, index, size, sha1):
+        with self._lock:
+            segment = self.segments[index]
+            segment["state"] = "done"
+            segment["size"] = size
+            segment["sha1"] = sha1
+        self.save()
+    
+    def verify(self, part_path):
+        """
+        按清单逐段校验已写入的.part文件，截断到最后一个校验通过的片段，
+        返回可以复用的片段数
+        """
+        done = 0
+        offset = 0
+        with open(part_path, mode='r+b') as f:
+            for segment in self.segments:
+                if segment["state"] != "done":
+                    break
+                content = f.read(segment["size"])
+                if len(content) != segment["size"] or hashlib.sha1(content).hexdigest() != segment["sha1"]:
+                    break
+                done += 1
+                offset += segment["size"]
+            f.truncate(offset)
+        for segment in self.segments[done:]:
+            segment.update(state="pending", size=0, sha1=None)
+        self.save(force=True)
+        return done
+    
+    def save(self, force=False):
+        now = time.time()
+        if not force and now - self._last_save < self.SAVE_INTERVAL:
+            return
+        self._last_save = now
+        tmp_path = self.path + '.tmp'
+        with self._lock:
+            with open(tmp_path, mode='w', encoding='utf-8') as f:
+                json.dump(self.data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+    
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+class SegmentCache:
+    """
+    本地片段缓存，多个任务共享，保存在 DATA_DIR/segment_cache/
+    
+    以去掉易变查询参数（如auth_key）后的片段绝对URL作为键，缓存源站返回的原始内容（解密前），
+    总大小超过max_bytes时按最近最少使用（LRU）淘汰。max_bytes为0时不启用缓存。
+    缓存目录在第一次查找或写入时才创建并扫描，导入模块时不访问磁盘。
+    """
+    
+    def __init__(self, directory, max_bytes, ignore_params=()):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ignore_params = set(ignore_params)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_bytes = 0
+        # 缓存键 -> 文件大小，按访问顺序排列，最久未访问的在最前面；_loaded为是否已扫描缓存目录
+        self._entries = OrderedDict()
+        self._loaded = False
+    
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+    
+    def _load_index(self):
+        """第一次使用时扫描缓存目录，按修改时间恢复LRU顺序"""
+        if self._loaded:
+            return
+        self._loaded = True
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.endswith('.tmp'):
+                    os.remove(path)
+                    continue
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._entries[name] = size
+            self.total_bytes += size
+    
+    def cache_key(self, url, byterange=None):
+        """去掉易变查询参数后的URL（及字节范围）摘要"""
+        parts = urlsplit(url)
+        query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in self.ignore_params]
+        normalized = parts._replace(query=urlencode(query), fragment='').geturl()
+        if byterange:
+            normalized += f"#bytes={byterange[0]}-{byterange[0] + byterange[1] - 1}"
+        return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+    
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+    
+    def lookup(self, url, byterange=None):
+        """查找缓存的片段，命中时返回文件路径并更新访问顺序，未命中时返回None"""
+        self._load_index()
+        key = self.cache_key(url, byterange)
+        path = self._path(key)
+        if key not in self._entries:
+            self.misses += 1
+            return None
+        try:
+            # 更新修改时间，重启后仍能恢复LRU顺序
+            os.utime(path)
+        except OSError:
+            self.total_bytes -= self._entries.pop(key, 0)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return path
+    
+    def open_writer(self, url, byterange=None):
+        """打开一个临时文件用于写入源站返回的原始内容，写完后调用commit"""
+        self._load_index()
+        key = self.cache_key(url, byterange)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return key, open(f"{path}.{uuid.uuid4().hex[:8]}.tmp", mode='wb')
+    
+    def commit(self, key, f):
+        """把写完的临时文件加入缓存，超出容量时淘汰最久未访问的片段"""
+        f.close()
+        size = os.path.getsize(f.name)
+        if key in self._entries or size > self.max_bytes:
+            os.remove(f.name)
+            return
+        os.replace(f.name, self._path(key))
+        self._entries[key] = size
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes and self._entries:
+            old_key, old_size = self._entries.popitem(last=False)
+            self.total_bytes -= old_size
+            self.evictions += 1
+            try:
+                os.remove(self._path(old_key))
+            except OSError:
+                pass
+    
+    def discard(self, f):
+        """放弃未写完的临时文件"""
+        f.close()
+        try:
+            os.remove(f.name)
+        except OSError:
+            pass
+    
+    def stats(self):
+        if self.enabled:
+            self._load_index()
+        lookups = self.hits + self.misses
+        return {
+            "状态": "已启用" if self.enabled else "未启用（设置SEGMENT_CACHE_MB启用）",
+            "片段数": len(self._entries),
+            "占用(MB)": f"{self.total_bytes / (1024 * 1024):.2f} / {self.max_bytes / (1024 * 1024):.0f}",
+            "命中": self.hits,
+            "未命中": self.misses,
+            "命中率": f"{self.hits / lookups:.1%}" if lookups else "无",
+            "淘汰": self.evictions,
+        }
+
+# 将工作目录中完成的文件移动到输出路径，同一文件系统内只需重命名
+def move_to_output(src, dst):
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # 跨文件系统时只能复制
+        shutil.move(src, dst)
+
+# 检查磁盘空间
+def check_disk_space(path, required_space_mb=1000):
+    """检查指定路径是否有足够的磁盘空间"""
+    try:
+        total, used, free = shutil.disk_usage(os.path.dirname(os.path.abspath(path)))
+        free_mb = free / (1024 * 1024)  # 转换为MB
+        
+        if free_mb < required_space_mb:
+            return False, f"磁盘空间不足: 只有 {free_mb:.2f}MB 可用，需要至少 {required_space_mb:.0f}MB"
+        return True, f"磁盘空间充足: {free_mb:.2f}MB 可用"
+    except Exception as e:
+        return False, f"检查磁盘空间失败: {str(e)}"
+
+# 下载前检查磁盘空间时采样的片段数和采样的总时限（秒）；无法估算大小（如直播录制）时要求的空间（MB）
+DISK_CHECK_SAMPLE = 5
+DISK_CHECK_TIMEOUT = float(os.environ.get("DISK_CHECK_TIMEOUT", 3))
+DEFAULT_REQUIRED_SPACE_MB = 1000
+
+# 按估算的下载大小（取估算范围的上限并留5%余量）检查工作目录和输出目录的磁盘空间。
+# 字节范围播放列表直接累加长度；有清晰度的BANDWIDTH（variant）时按带宽估算，不发出HEAD请求；
+# 否则并发采样片段大小，超过DISK_CHECK_TIMEOUT时不再等待，按默认要求的空间检查。
+# 续传时只需要容纳剩余部分；工作目录与输出目录不在同一文件系统时，移动到输出路径还需要同样的空间
+async def check_job_disk_space(session, job, playlist, part_path, live=False, variant=None):
+    estimate = None
+    if not live:
+        bandwidth = variant and (variant.average_bandwidth or variant.bandwidth)
+        try:
+            estimate = await asyncio.wait_for(
+                estimate_size(session, playlist, 0 if bandwidth else DISK_CHECK_SAMPLE,
+                              bandwidth=bandwidth, peak_bandwidth=variant and variant.bandwidth),
+                DISK_CHECK_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+    if estimate is None:
+        required_mb = DEFAULT_REQUIRED_SPACE_MB
+    else:
+        required_mb = estimate.high * 1.05 / (1024 * 1024)
+    written_mb = os.path.getsize(part_path) / (1024 * 1024) if os.path.exists(part_path) else 0
+    
+    space_ok, space_msg = check_disk_space(part_path, max(required_mb - written_mb, 0))
+    if space_ok and os.stat(job.workspace).st_dev != os.stat(os.path.dirname(os.path.abspath(job.output_path))).st_dev:
+        space_ok, space_msg = check_disk_space(job.output_path, required_mb)
+    if not space_ok:
+        raise Exception(space_msg)
+    return estimate
+
+# 下载任务状态
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+# 批量任务结束时部分任务成功
+BATCH_PARTIAL = "partial"
+
+JOB_STATUS_NAMES = {
+    JOB_QUEUED: "排队中",
+    JOB_RUNNING: "下载中",
+    JOB_COMPLETED: "已完成",
+    JOB_FAILED: "失败",
+    JOB_CANCELLED: "已取消",
+}
+
+# 任务ID由m3u8地址和输出路径决定，重复提交同一任务时可以找到之前的工作目录和清单续传
+def make_job_id(m3u8_url, output_path):
+    return hashlib.sha1(f"{m3u8_url}\n{os.path.abspath(output_path)}".encode('utf-8')).hexdigest()[:12]
+
+# make_job_id生成的任务ID格式，按任务ID拼接文件路径前先校验，防止路径穿越
+JOB_ID_PATTERN = re.compile(r'[0-9a-f]{12}')
+
+# 单个任务最多记录的片段级追踪区间数，超出后只计数不记录（阶段区间照常记录）
+TRACE_MAX_SPANS = int(os.environ.get("TRACE_MAX_SPANS", 200000))
+
+class JobTrace:
+    """
+    下载任务的性能追踪：记录各阶段和每组片段的耗时区间，导出为Chrome trace格式（chrome://tracing、Perfetto）
+    
+    区间按轨道（track）分组显示，同一轨道上的区间不重叠或完全嵌套：各阶段在任务和各路媒体的轨道上；
+    每组片段从排队等待请求名额到下载完成（包括重试前的等待）占用一条片段轨道，轨道在片段之间复用；
+    写入输出文件在各路媒体的写入轨道上。时间取自time.monotonic()，写入线程中也可以记录。
+    """
+    
+    def __init__(self):
+        self.started = time.monotonic()
+        self.started_at = time.time()
+        # (名称, 类别, 轨道, 相对开始的秒数, 耗时, 参数)
+        self.spans = []
+        self.dropped = 0
+        self._free_lanes = []
+        self._lanes = 0
+        self._lock = threading.Lock()
+    
+    def add(self, name, category, track, start, end, args=None):
+        """记录一个区间，start和end为time.monotonic()的值"""
+        with self._lock:
+            if category == "segment" and len(self.spans) >= TRACE_MAX_SPANS:
+                self.dropped += 1
+                return
+            self.spans.append((name, category, track, start - self.started, end - start, args))
+    
+    @contextlib.contextmanager
+    def span(self, name, category, track, args=None):
+        """记录with块的耗时，块内可以向产生的参数字典中补充信息；块内抛出异常时记录异常类型"""
+        args = {} if args is None else args
+        start = time.monotonic()
+        try:
+            yield args
+        except BaseException as e:
+            args["error"] = type(e).__name__
+            raise
+        finally:
+            self.add(name, category, track, start, time.monotonic(), args)
+    
+    @contextlib.contextmanager
+    def lane(self):
+        """占用一条空闲的片段轨道，返回轨道名"""
+        if self._free_lanes:
+            lane = heapq.heappop(self._free_lanes)
+        else:
+            self._lanes += 1
+            lane = self._lanes
+        try:
+            yield f"片段请求 {lane:03d}"
+        finally:
+            heapq.heappush(self._free_lanes, lane)
+    
+    def to_chrome_trace(self, job):
+        """Chrome trace格式（JSON对象格式）的追踪数据，轨道按首次出现的顺序排列"""
+        with self._lock:
+            spans = list(self.spans)
+        tracks = {}
+        events = []
+        for name, category, track, start, duration, args in spans:
+            tid = tracks.setdefault(track, len(tracks) + 1)
+            events.append({"name": name, "cat": category, "ph": "X", "pid": 1, "tid": tid,
+                           "ts": round(start * 1e6, 1), "dur": round(duration * 1e6, 1), "args": args or {}})
+        metadata = [{"name": "process_name", "ph": "M", "pid": 1, "tid": 0, "args": {"name": f"下载任务 {job.job_id}"}}]
+        for track, tid in tracks.items():
+            metadata.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": track}})
+            metadata.append({"name": "thread_sort_index", "ph": "M", "pid": 1, "tid": tid, "args": {"sort_index": tid}})
+        return {
+            "traceEvents": metadata + events,
+            "displayTimeUnit": "ms",
+            "otherData": {
+                "job_id": job.job_id,
+                "m3u8_url": job.m3u8_url,
+                "output_path": job.output_path,
+                "status": job.status,
+                "started_at": self.started_at,
+                "dropped_spans": self.dropped,
+            },
+        }
+    
+    def export(self, job):
+        """导出到TRACE_DIR/<任务ID>.json，返回文件路径"""
+        os.makedirs(TRACE_DIR, exist_ok=True)
+        path = os.path.join(TRACE_DIR, f"{job.job_id}.json")
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_chrome_trace(job), f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        return path
+
+# 追踪数据的摘要：各类区间的次数、合计和最长耗时，以及最慢的top个区间（category不为空时只列出该类别的区间）
+def summarize_trace(data, top=10, category=""):
+    tracks = {e["tid"]: e["args"]["name"] for e in data["traceEvents"] if e["ph"] == "M" and e["name"] == "thread_name"}
+    spans = [e for e in data["traceEvents"] if e["ph"] == "X"]
+    info = data.get("otherData", {})
+    end = max((e["ts"] + e["dur"] for e in spans), default=0)
+    result = f"任务ID: {info.get('job_id')}\n" \
+             f"状态: {JOB_STATUS_NAMES.get(info.get('status'), info.get('status'))}\n" \
+             f"追踪时长: {end / 1e6:.2f}秒，共 {len(spans)} 个区间"
+    if info.get("dropped_spans"):
+        result += f"（超出上限未记录 {info['dropped_spans']} 个片段区间）"
+    
+    totals = {}
+    for e in spans:
+        total = totals.setdefault((e["cat"], e["name"]), [0, 0.0, 0.0])
+        total[0] += 1
+        total[1] += e["dur"]
+        total[2] = max(total[2], e["dur"])
+    result += "\n\n各类区间（片段区间并发进行，合计耗时可能超过追踪时长）:\n"
+    for (cat, name), (count, duration, longest) in sorted(totals.items(), key=lambda item: -item[1][1]):
+        result += f"{cat}/{name}: {count} 次，合计 {duration / 1e6:.2f}秒，" \
+                  f"平均 {duration / count / 1e3:.1f}ms，最长 {longest / 1e3:.1f}ms\n"
+    
+    slowest = sorted((e for e in spans if not category or e["cat"] == category), key=lambda e: -e["dur"])[:top]
+    result += f"\n最慢的 {len(slowest)} 个{category}区间:\n"
+    for e in slowest:
+        args = "，".join(f"{key}={value}" for key, value in e["args"].items())
+        result += f"{e['dur'] / 1e3:.1f}ms {e['cat']}/{e['name']} [{tracks.get(e['tid'], e['tid'])}] " \
+                  f"开始于 {e['ts'] / 1e6:.3f}秒" + (f"（{args}）" if args else "") + "\n"
+    return result
+
+class DownloadJob:
+    """一个后台下载任务及其进度信息"""
+    
+    def __init__(self, m3u8_url, output_path, processes, max_retries, live=False, max_duration=0,
+                 variant_policy="bandwidth", max_bandwidth=0, renditions="default", start=0, end=0, trace=False):
+        self.job_id = make_job_id(m3u8_url, output_path)
+        self.m3u8_url = m3u8_url
+        self.output_path = output_path
+        # 只下载覆盖[start, end]（秒，end为0时到结尾）的片段；clip_range为实际下载的时间范围（按片段边界）
+        self.start = start
+        self.end = end
+        self.clip_range = None
+        # 主播放列表：按variant_policy和max_bandwidth选择清晰度，按renditions选择同时下载的备选音频、字幕
+        self.variant_policy = variant_policy
+        self.max_bandwidth = max_bandwidth
+        self.rendition_mode = renditions
+        self.variant = None
+        self.renditions = []
+        # processes为0时不限制单个任务的请求数，完全由源站的自适应并发控制决定
+        self.adaptive = processes <= 0
+        self.processes = scheduler.max_requests_per_host if self.adaptive else processes
+        self.request_slots = asyncio.Semaphore(self.processes)
+        # 所有片段请求的实际耗时之和，除以任务耗时即平均并发请求数
+        self.request_time = 0.0
+        # 任务请求过的源站
+        self.hosts = set()
+        # 忽略Range请求的源站上整个文件的下载任务（返回工作目录中的文件路径），按片段URL索引
+        self.whole_files = {}
+        # 直播录制：持续轮询播放列表，直到ENDLIST、录制时长达到max_duration（秒，0为不限）或被停止
+        self.live = live
+        self.max_duration = max_duration
+        self.stop_requested = asyncio.Event()
+        self.stop_reason = None
+        self.recorded_duration = 0.0
+        self.segments_missed = 0
+        # 片段请求的重试次数，以及重试后仍然失败（直播录制中被跳过）的片段结果SegmentResult
+        self.retries = 0
+        self.failed_segments = []
+        # 最近成功请求从发出到接收完毕的耗时（秒，不含排队和片段缓存命中），用于计算对冲阈值；
+        # 发出的对冲请求数和先于原请求完成的次数
+        self.segment_times = deque(maxlen=SEGMENT_TIME_WINDOW)
+        self.requests_timed = 0
+        self._hedge_threshold = (None, None)
+        self.hedges_fired = 0
+        self.hedges_won = 0
+        self.max_retries = max_retries
+        self.status = JOB_QUEUED
+        self.segments_total = 0
+        self.segments_done = 0
+        self.segments_resumed = 0
+        self.bytes_done = 0
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.task = None
+        # 任务独立的工作目录，下载中的文件只写在这里，任务结束后整体删除
+        self.workspace = os.path.join(TEMP_DIR, self.job_id)
+        # 性能追踪，trace为False时不记录；任务结束后导出到trace_path
+        self.trace = JobTrace() if trace else None
+        self.trace_path = None
+    
+    @property
+    def finished(self):
+        return self.status in (JOB_COMPLETED, JOB_FAILED, JOB_CANCELLED)
+    
+    def elapsed(self):
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+    
+    def throughput(self):
+        """平均下载速度（字节/秒）"""
+        elapsed = self.elapsed()
+        return self.bytes_done / elapsed if elapsed > 0 else 0.0
+    
+    def eta(self):
+        """按已完成片段的平均耗时估算剩余秒数，无法估算时返回None"""
+        downloaded = self.segments_done - self.segments_resumed
+        if self.status != JOB_RUNNING or self.live or not downloaded or not self.segments_total:
+            return None
+        return self.elapsed() / downloaded * (self.segments_total - self.segments_done)
+    
+    def span(self, name, category, track, **args):
+        """记录一个追踪区间（见JobTrace.span），未开启追踪时不记录"""
+        if self.trace is None:
+            return contextlib.nullcontext(args)
+        return self.trace.span(name, category, track, args)
+    
+    def trace_lane(self):
+        """占用一条片段追踪轨道（见JobTrace.lane），未开启追踪时返回None"""
+        if self.trace is None:
+            return contextlib.nullcontext()
+        return self.trace.lane()
+    
+    def record_request_time(self, elapsed):
+        self.segment_times.append(elapsed)
+        self.requests_timed += 1
+    
+    def hedge_delay(self):
+        """请求发出后、发出对冲请求前等待的秒数，未启用对冲或样本不足时返回None；样本没有变化时不重新计算"""
+        if not HEDGE_PERCENTILE or len(self.segment_times) < HEDGE_MIN_SAMPLES:
+            return None
+        if self._hedge_threshold[0] != self.requests_timed:
+            self._hedge_threshold = (self.requests_timed, percentile(self.segment_times, HEDGE_PERCENTILE))
+        return self._hedge_threshold[1]
+    
+    def latency_report(self):
+        """最近请求耗时的p50/p99，以及对冲请求的发出和获胜次数"""
+        if not self.segment_times:
+            return None
+        text = f"p50 {percentile(self.segment_times, 50):.2f}s, p99 {percentile(self.segment_times, 99):.2f}s"
+        if HEDGE_PERCENTILE:
+            text += f", 对冲 {self.hedges_fired} 次, 获胜 {self.hedges_won} 次"
+        return text
+    
+    def average_concurrency(self):
+        """平均同时进行的片段请求数"""
+        elapsed = self.elapsed()
+        return self.request_time / elapsed if elapsed > 0 else 0.0
+    
+    def concurrency_report(self, max_points=12):
+        """任务期间各源站并发上限的变化，如 "4 → 5 → 2(3.1s)"，括号内为相对任务开始的时间"""
+        if self.started_at is None:
+            return {}
+        report = {}
+        for host in self.hosts:
+            limiter = scheduler.host_limiters[host]
+            points = [(t, limit) for t, limit in limiter.history_since(self.started_at)
+                      if self.finished_at is None or t <= self.finished_at]
+            text = " → ".join(f"{limit}({t - self.started_at:.1f}s)" for t, limit in points[-max_points:])
+            if len(points) > max_points:
+                text = "... → " + text
+            report[host] = text
+        return report
+    
+    async def wait(self):
+        """等待任务结束"""
+        await asyncio.shield(self.task)
+    
+    def progress(self):
+        """进度计数器的快照，由ProgressTracker采样生成进度事件"""
+        info = {
+            "job_id": self.job_id,
+            "status": self.status,
+            "segments_done": self.segments_done,
+            "segments_total": self.segments_total,
+            "bytes_done": self.bytes_done,
+            "retries": self.retries,
+        }
+        if self.live:
+            info["recorded_duration"] = round(self.recorded_duration, 1)
+        if self.finished:
+            info["result"] = self.result
+        return info
+    
+    def summary(self):
+        """单行任务概要"""
+        return f"{self.job_id} [{JOB_STATUS_NAMES[self.status]}] " \
+               f"{self.segments_done}/{self.segments_total} 片段 -> {self.output_path}"
+    
+    def describe(self):
+        """任务详细状态"""
+        eta = self.eta()
+        info = {
+            "任务ID": self.job_id,
+            "状态": JOB_STATUS_NAMES[self.status],
+            "m3u8地址": self.m3u8_url,
+            "输出文件": self.output_path,
+        }
+        if self.variant is not None:
+            info["清晰度"] = self.variant.describe()
+        if self.clip_range is not None:
+            info["时间范围(秒)"] = f"{self.clip_range[0]:.1f} - {self.clip_range[1]:.1f}"
+        for rendition in self.renditions[1:]:
+            info[rendition.title] = rendition.output_path
+        info |= {
+            "工作目录": self.workspace,
+            "片段进度": f"{self.segments_done}/{self.segments_total}",
+            "续传复用片段": self.segments_resumed,
+            "已下载(MB)": f"{self.bytes_done / (1024 * 1024):.2f}",
+            "下载速度(MB/s)": f"{self.throughput() / (1024 * 1024):.2f}",
+            "已用时间(秒)": f"{self.elapsed():.2f}",
+            "预计剩余(秒)": f"{eta:.1f}" if eta is not None else "未知",
+            "单任务请求数上限": "自动" if self.adaptive else self.processes,
+        }
+        if self.live:
+            info["录制时长(秒)"] = f"{self.recorded_duration:.1f}" + (f" / {self.max_duration:.0f}" if self.max_duration else "")
+            info["丢失片段"] = self.segments_missed
+        info["平均并发请求数"] = f"{self.average_concurrency():.1f}"
+        info["重试次数"] = self.retries
+        info["片段耗时"] = self.latency_report() or "无"
+        for host, text in self.concurrency_report().items():
+            info[f"并发上限变化({host})"] = text
+        if self.trace_path:
+            info["性能追踪文件"] = self.trace_path
+        result = "".join(f"{key}: {value}\n" for key, value in info.items())
+        for failure in self.failed_segments[:5]:
+            result += f"{failure.describe()}\n"
+        if len(self.failed_segments) > 5:
+            result += f"……另有 {len(self.failed_segments) - 5} 组片段失败\n"
+        if self.result:
+            result += f"结果: {self.result}\n"
+        return result
+
+class DownloadBatch:
+    """一批同时提交的下载任务，汇总各任务的进度和结果"""
+    
+    def __init__(self, jobs, rejected):
+        self.batch_id = uuid.uuid4().hex[:12]
+        self.jobs = jobs
+        # 未能提交的下载项：(m3u8地址, 输出路径, 原因)
+        self.rejected = rejected
+        self.created_at = time.time()
+    
+    @property
+    def finished(self):
+        return all(job.finished for job in self.jobs)
+    
+    @property
+    def status(self):
+        """
+        批量任务的汇总状态：未结束时为running；结束后全部成功为completed，没有一个成功为failed
+        （全部被取消时为cancelled），其余（包括有未能提交的下载项）为partial
+        """
+        if not self.finished:
+            return JOB_RUNNING
+        completed = sum(1 for job in self.jobs if job.status == JOB_COMPLETED)
+        if completed == len(self.jobs) and not self.rejected:
+            return JOB_COMPLETED
+        if completed == 0:
+            if self.jobs and all(job.status == JOB_CANCELLED for job in self.jobs):
+                return JOB_CANCELLED
+            return JOB_FAILED
+        return BATCH_PARTIAL
+    
+    async def wait(self):
+        """等待所有任务结束"""
+        await asyncio.gather(*(asyncio.shield(job.task) for job in self.jobs), return_exceptions=True)
+    
+    def progress(self):
+        """各任务进度计数器的合计，由ProgressTracker采样生成进度事件"""
+        counts = {}
+        for job in self.jobs:
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {
+            "batch_id": self.batch_id,
+            "status": self.status,
+            "jobs": counts,
+            "segments_done": sum(job.segments_done for job in self.jobs),
+            "segments_total": sum(job.segments_total for job in self.jobs),
+            "bytes_done": sum(job.bytes_done for job in self.jobs),
+            "retries": sum(job.retries for job in self.jobs),
+        }
+    
+    def describe(self):
+        """批量任务的汇总状态和每个任务的概要"""
+        counts = {}
+        for job in self.jobs:
+            counts[JOB_STATUS_NAMES[job.status]] = counts.get(JOB_STATUS_NAMES[job.status], 0) + 1
+        end = max(job.finished_at for job in self.jobs) if self.jobs and self.finished else time.time()
+        elapsed = end - self.created_at
+        bytes_done = sum(job.bytes_done for job in self.jobs)
+        info = {
+            "批量任务ID": self.batch_id,
+            "任务数": len(self.jobs),
+            "状态": "，".join(f"{name} {count}" for name, count in counts.items()) or "无",
+            "片段进度": f"{sum(job.segments_done for job in self.jobs)}/{sum(job.segments_total for job in self.jobs)}",
+            "已下载(MB)": f"{bytes_done / (1024 * 1024):.2f}",
+            "总下载速度(MB/s)": f"{bytes_done / (1024 * 1024) / elapsed:.2f}" if elapsed > 0 else "0.00",
+            "已用时间(秒)": f"{elapsed:.2f}",
+        }
+        result = "".join(f"{key}: {value}\n" for key, value in info.items())
+        for job in self.jobs:
+            result += job.summary()
+            if job.status in (JOB_FAILED, JOB_CANCELLED):
+                result += f" 原因: {job.result.splitlines()[0] if job.result else '未知'}"
+            result += "\n"
+        for url, output_path, reason in self.rejected:
+            result += f"未提交 {url} -> {output_path}: {reason}\n"
+        return result
+
+# 进度事件的最短间隔（秒）。进度按这个间隔从任务的计数器采样，与每秒完成的片段数无关
+PROGRESS_INTERVAL = float(os.environ.get("PROGRESS_INTERVAL", 1.0))
+
+class ProgressTracker:
+    """
+    按固定间隔对任务（DownloadJob或DownloadBatch）的进度计数器采样，生成进度事件
+    
+    两次采样之间的所有片段更新合并为一个事件，进度没有变化时不生成事件，任务结束时生成最后一个事件。
+    事件在计数器快照之外加上当前速度（字节/秒，最近几次采样的指数平滑值）和按当前片段速度估算的剩余秒数。
+    """
+    
+    # 速度的平滑系数，越大越接近最近一次采样
+    SMOOTHING = 0.3
+    
+    def __init__(self, source, interval=PROGRESS_INTERVAL):
+        self.source = source
+        self.interval = interval
+        self.rate = None
+        self._segment_rate = None
+        self._last = None
+    
+    async def events(self):
+        waiter = asyncio.ensure_future(self.source.wait())
+        try:
+            # 开始时立即生成一个事件，之后每个间隔采样一次
+            sampled_at = time.monotonic()
+            yield self._sample(0)
+            while not waiter.done():
+                await asyncio.wait([waiter], timeout=self.interval)
+                now = time.monotonic()
+                event = self._sample(now - sampled_at)
+                sampled_at = now
+                if event is not None:
+                    yield event
+        finally:
+            waiter.cancel()
+    
+    def _sample(self, elapsed):
+        snapshot = self.source.progress()
+        last = self._last
+        self._last = snapshot
+        if last is not None and elapsed > 0:
+            self.rate = self._smooth(self.rate, (snapshot["bytes_done"] - last["bytes_done"]) / elapsed)
+            self._segment_rate = self._smooth(
+                self._segment_rate, (snapshot["segments_done"] - last["segments_done"]) / elapsed)
+        if snapshot == last:
+            return None
+        remaining = snapshot["segments_total"] - snapshot["segments_done"]
+        live = "recorded_duration" in snapshot
+        eta = remaining / self._segment_rate if self._segment_rate and not live and snapshot["status"] == JOB_RUNNING else None
+        return snapshot | {
+            "rate": round(self.rate or 0.0),
+            "eta": round(eta, 1) if eta is not None else None,
+        }
+    
+    def _smooth(self, previous, value):
+        return value if previous is None else previous + self.SMOOTHING * (value - previous)
+
+# 进度事件的可读描述，用作MCP进度通知的消息
+def describe_progress(event):
+    text = f"片段 {event['segments_done']}/{event['segments_total']}，" \
+           f"已下载 {event['bytes_done'] / (1024 * 1024):.1f}MB，速度 {event['rate'] / (1024 * 1024):.2f}MB/s"
+    if "recorded_duration" in event:
+        text += f"，已录制 {event['recorded_duration']:.0f}秒"
+    if event["eta"] is not None:
+        text += f"，预计剩余 {event['eta']:.0f}秒"
+    if event["retries"]:
+        text += f"，重试 {event['retries']} 次"
+    return text
+
+# 等待任务（或批量任务）结束，期间通过MCP进度通知报告进度；
+# 客户端请求时没有提供progressToken时不发送通知，ctx为None（直接调用）时只等待
+async def wait_with_progress(source, ctx=None):
+    if ctx is None:
+        await source.wait()
+        return
+    async for event in ProgressTracker(source).events():
+        # 直播录制的总片段数会一直增加，不报告总数
+        total = None if "recorded_duration" in event else event["segments_total"] or None
+        await ctx.report_progress(event["segments_done"], total, describe_progress(event))
+
+# 表示源站限流的HTTP状态码
+THROTTLE_STATUS_CODES = (429, 503)
+
+class FairWaiters:
+    """
+    按所有者（下载任务）分组的等待队列
+    
+    唤醒时在所有者之间轮转，每个所有者依次唤醒一个等待者，排队请求多的任务不会挤占其他任务的名额。
+    """
+    
+    def __init__(self):
+        self._queues = OrderedDict()
+    
+    def __bool__(self):
+        return bool(self._queues)
+    
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues.values())
+    
+    def append(self, owner, waiter):
+        self._queues.setdefault(owner, deque()).append(waiter)
+    
+    def remove(self, owner, waiter):
+        queue = self._queues.get(owner)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del self._queues[owner]
+    
+    def popleft(self):
+        owner, queue = next(iter(self._queues.items()))
+        waiter = queue.popleft()
+        # 该所有者排到队尾，下一次唤醒轮到其他所有者
+        del self._queues[owner]
+        if queue:
+            self._queues[owner] = queue
+        return waiter
+
+class FairSemaphore:
+    """同时最多limit个名额的信号量，名额不足时按所有者轮流分配（见FairWaiters）"""
+    
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self._waiters = FairWaiters()
+    
+    async def acquire(self, owner=None):
+        while self.in_flight >= self.limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(owner, waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # 已被唤醒但随即取消，把名额让给下一个等待者
+                if waiter.done() and not waiter.cancelled():
+                    self._wake()
+                raise
+            finally:
+                self._waiters.remove(owner, waiter)
+        self.in_flight += 1
+    
+    def try_acquire(self):
+        """有空闲名额且没有等待者时立即占用并返回True，否则返回False"""
+        if self.in_flight >= self.limit or self._waiters:
+            return False
+        self.in_flight += 1
+        return True
+    
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+    
+    @property
+    def waiting(self):
+        return len(self._waiters)
+    
+    def _wake(self):
+        free = self.limit - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+class AdaptiveLimiter(FairSemaphore):
+    """
+    单个源站的AIMD自适应并发控制器
+    
+    每完成limit个请求（且至少间隔0.5秒）评估一次：期间被限流（429/503）或超时的请求超过5%时并发上限减半；
+    源站出错（其他5xx、连接断开等）的请求超过10%，或首字节延迟的中位数超过基线的2倍时降为3/4；
+    请求已占满上限时增加上限，但如果上次增加后吞吐量没有提升，则保持不变若干个周期再尝试。
+    首次降低之前上限按倍数增长（慢启动），之后每次加1。被取消的请求（如落败的对冲请求）不参与评估。
+    """
+    
+    # 增加并发后吞吐量没有提升时，暂停增长的评估周期数
+    HOLD_PERIODS = 4
+    # 一个评估周期内触发降低并发的限流和出错请求比例
+    CONGESTION_RATE = 0.05
+    ERROR_RATE = 0.1
+    
+    def __init__(self, initial, minimum, maximum):
+        super().__init__(min(max(initial, minimum), maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        # (时间, 并发上限) 的变化记录
+        self.history = deque([(time.time(), self.limit)], maxlen=1000)
+        self._base_latency = None
+        self._last_throughput = 0.0
+        self._slow_start = True
+        self._increased = False
+        self._hold = 0
+        self._reset_period()
+    
+    def _reset_period(self):
+        self._period_start = time.monotonic()
+        self._completed = 0
+        self._errors = 0
+        self._congestion = 0
+        self._bytes = 0
+        self._latencies = []
+        self._saturated = False
+    
+    async def acquire(self, owner=None):
+        await super().acquire(owner)
+        if self.in_flight >= self.limit:
+            self._saturated = True
+    
+    def try_acquire(self):
+        if not super().try_acquire():
+            return False
+        if self.in_flight >= self.limit:
+            self._saturated = True
+        return True
+    
+    def release(self, latency=None, nbytes=0, error=None, cancelled=False):
+        """
+        请求结束时调用：latency为首字节延迟（秒），error为请求失败时的异常；
+        cancelled为True时只归还名额，请求不计入吞吐量和错误率
+        """
+        self.in_flight -= 1
+        if not cancelled:
+            self._completed += 1
+            self._bytes += nbytes
+            if error is not None:
+                if is_server_error(error):
+                    self._errors += 1
+                if is_congestion_error(error):
+                    self._congestion += 1
+            elif latency is not None:
+                self._latencies.append(latency)
+            
+            elapsed = time.monotonic() - self._period_start
+            if self._completed >= self.limit and elapsed >= 0.5:
+                self._adjust(elapsed)
+        self._wake()
+    
+    def _adjust(self, elapsed):
+        throughput = self._bytes / elapsed
+        # 取中位数，少数卡住的请求不会被当成源站变慢（由对冲请求处理）
+        latency = percentile(self._latencies, 50)
+        if latency is not None:
+            self._base_latency = latency if self._base_latency is None else min(self._base_latency, latency)
+        
+        limit = self.limit
+        if self._congestion and self._congestion >= self._completed * self.CONGESTION_RATE:
+            limit = limit // 2
+            self._slow_start = False
+        elif self._errors and self._errors >= self._completed * self.ERROR_RATE:
+            limit = limit * 3 // 4
+            self._slow_start = False
+        elif latency is not None and latency > self._base_latency * 2:
+            limit = limit * 3 // 4
+            self._slow_start = False
+        elif self._saturated:
+            if self._increased and throughput <= self._last_throughput * 1.02:
+                # 上次增加并发后吞吐量没有提升，说明已接近源站或带宽的上限
+                self._hold = self.HOLD_PERIODS
+                self._slow_start = False
+            elif self._hold:
+                self._hold -= 1
+            else:
+                limit = limit * 2 if self._slow_start else limit + 1
+        limit = min(max(limit, self.minimum), self.maximum)
+        self._increased = limit > self.limit
+        
+        if limit != self.limit:
+            self.limit = limit
+            self.history.append((time.time(), limit))
+        self._last_throughput = throughput
+        self._reset_period()
+    
+    def history_since(self, since):
+        """since之后的并发上限变化，第一项为since时刻的上限"""
+        earlier = [limit for t, limit in self.history if t <= since]
+        points = [(since, earlier[-1] if earlier else self.history[0][1])]
+        for t, limit in self.history:
+            if t > since and limit != points[-1][1]:
+                points.append((t, limit))
+        return points
+
+# 是否是表示源站过载的错误：限流状态码或超时
+def is_congestion_error(error):
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in THROTTLE_STATUS_CODES
+    return isinstance(error, asyncio.TimeoutError)
+
+# 是否是源站或网络的错误：5xx、限流状态码、连接断开、传输中断和超时；
+# 404等请求本身的错误以及解密等本地错误与并发无关，不算
+def is_server_error(error):
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500 or error.status in THROTTLE_STATUS_CODES
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError))
+
+class RequestSample:
+    """一次片段请求的测量数据，由请求方填写，请求结束时交给AdaptiveLimiter"""
+    __slots__ = ('latency', 'nbytes')
+    
+    def __init__(self):
+        self.latency = None
+        self.nbytes = 0
+
+class JobScheduler:
+    """
+    后台下载任务调度器
+    
+    max_jobs限制同时运行的任务数，超出的任务排队等待；max_requests限制所有任务合计的片段请求并发数；
+    对同一源站的片段请求并发数由该源站的AdaptiveLimiter在 [1, max_requests_per_host] 内自动调整。
+    名额不足时在各个任务之间轮流分配，一个片段很多的任务不会让同时运行的其他任务一直排队。
+    """
+    
+    def __init__(self, max_jobs, max_requests, max_requests_per_host, initial_requests_per_host=4, max_finished_jobs=200):
+        self.max_requests = max_requests
+        self.max_requests_per_host = max_requests_per_host
+        self.initial_requests_per_host = initial_requests_per_host
+        self.max_finished_jobs = max_finished_jobs
+        self.jobs = {}
+        self.batches = {}
+        self._job_slots = asyncio.Semaphore(max_jobs)
+        self._request_slots = FairSemaphore(max_requests)
+        self.host_limiters = {}
+    
+    def host_limiter(self, url):
+        host = urlsplit(url).netloc
+        limiter = self.host_limiters.get(host)
+        if limiter is None:
+            limiter = self.host_limiters[host] = AdaptiveLimiter(
+                self.initial_requests_per_host, 1, self.max_requests_per_host
+            )
+        return limiter
+    
+    @contextlib.asynccontextmanager
+    async def request_slot(self, url, owner=None):
+        """
+        占用一个片段请求名额（按源站和全局两级限制），返回RequestSample供请求方填写测量数据，
+        请求结束后反馈给源站的并发控制器。名额不足时在各个owner（下载任务）之间轮流分配
+        """
+        limiter = self.host_limiter(url)
+        await limiter.acquire(owner)
+        sample = RequestSample()
+        error = None
+        cancelled = False
+        try:
+            await self._request_slots.acquire(owner)
+            try:
+                yield sample
+            finally:
+                self._request_slots.release()
+        except asyncio.CancelledError:
+            # 被取消的请求（落败的对冲请求、任务被取消）没有完成，不作为0字节的成功请求反馈
+            cancelled = True
+            raise
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            limiter.release(sample.latency, sample.nbytes, error, cancelled)
+    
+    def try_request_slot(self, url):
+        """不等待地占用一个片段请求名额（源站和全局两级），名额已满或有请求在排队时返回False；用完后调用release_request_slot"""
+        limiter = self.host_limiter(url)
+        if not limiter.try_acquire():
+            return False
+        if not self._request_slots.try_acquire():
+            limiter.release(cancelled=True)
+            return False
+        return True
+    
+    def release_request_slot(self, url, sample, error=None, cancelled=False):
+        """归还try_request_slot占用的名额，并把请求的测量数据反馈给源站的并发控制器"""
+        self._request_slots.release()
+        self.host_limiter(url).release(sample.latency, sample.nbytes, error, cancelled)
+    
+    def submit(self, job):
+        """提交任务并立即返回，任务在后台排队执行"""
+        self._prune()
+        self.jobs[job.job_id] = job
+        job.task = asyncio.create_task(self._run(job))
+        return job
+    
+    @property
+    def waiting_requests(self):
+        """已占用源站名额、正在等待全局名额的片段请求数"""
+        return self._request_slots.waiting
+    
+    def submit_batch(self, batch):
+        """登记批量任务，批量任务中的各个任务已经分别提交"""
+        self.batches[batch.batch_id] = batch
+        finished = [b for b in self.batches.values() if b.finished]
+        for b in finished[:max(len(finished) - self.max_finished_jobs, 0)]:
+            del self.batches[b.batch_id]
+        return batch
+    
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+    
+    def active_jobs(self):
+        return [job for job in self.jobs.values() if not job.finished]
+    
+    def find_active_output(self, output_path):
+        """查找正在写入同一输出文件的未结束任务"""
+        output_path = os.path.abspath(output_path)
+        for job in self.active_jobs():
+            if os.path.abspath(job.output_path) == output_path:
+                return job
+        return None
+    
+    def cancel(self, job_id):
+        """
+        取消排队中或下载中的任务，返回是否成功发出取消；
+        正在录制的直播任务会停止录制并保存已录制的内容
+        """
+        job = self.jobs.get(job_id)
+        if job is None or job.finished:
+            return False
+        if job.live and job.status == JOB_RUNNING:
+            job.stop_requested.set()
+        else:
+            job.task.cancel()
+        return True
+    
+    async def _run(self, job):
+        try:
+            async with self._job_slots:
+                job.status = JOB_RUNNING
+                job.started_at = time.time()
+                if job.trace is not None:
+                    job.trace.add("等待任务名额", "job", "任务", job.trace.started, time.monotonic())
+                with job.span("下载任务", "job", "任务"):
+                    job.result = await run_download_job(job)
+                job.status = JOB_COMPLETED
+        except asyncio.CancelledError:
+            job.status = JOB_CANCELLED
+            job.result = "任务已取消"
+        except Exception as e:
+            job.status = JOB_FAILED
+            job.result = str(e)
+        finally:
+            job.finished_at = time.time()
+            if job.trace is not None:
+                try:
+                    job.trace_path = await asyncio.to_thread(job.trace.export, job)
+                except Exception as e:
+                    logger.warning("导出性能追踪失败: %s", e)
+            # 未完成的任务保留工作目录和清单，再次提交同一任务时续传
+            if job.status == JOB_COMPLETED:
+                shutil.rmtree(job.workspace, ignore_errors=True)
+    
+    def _prune(self):
+        """只保留最近的max_finished_jobs个已结束任务"""
+        finished = [job for job in self.jobs.values() if job.finished]
+        for job in finished[:max(len(finished) - self.max_finished_jobs, 0)]:
+            del self.jobs[job.job_id]
+
+class SchedulerCollector:
+    """
+    抓取/metrics时从调度器读取的Prometheus指标：各状态的任务数、涉及各源站的未结束任务数，
+    以及各源站正在进行和排队中的片段请求数、当前的自适应并发上限
+    """
+    
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+    
+    def collect(self):
+        from prometheus_client.core import GaugeMetricFamily
+        
+        jobs = GaugeMetricFamily("m3u8_jobs", "各状态的下载任务数（已结束的任务只统计仍保留的记录）", labels=["status"])
+        counts = dict.fromkeys(JOB_STATUS_NAMES, 0)
+        for job in self.scheduler.jobs.values():
+            counts[job.status] += 1
+        for status, count in counts.items():
+            jobs.add_metric([status], count)
+        yield jobs
+        
+        active = GaugeMetricFamily("m3u8_active_jobs", "正在从该源站下载的未结束任务数", labels=["host"])
+        hosts = {}
+        for job in self.scheduler.active_jobs():
+            for host in job.hosts:
+                hosts[host] = hosts.get(host, 0) + 1
+        for host, count in hosts.items():
+            active.add_metric([host], count)
+        yield active
+        
+        in_flight = GaugeMetricFamily("m3u8_inflight_requests", "正在进行的片段请求数", labels=["host"])
+        waiting = GaugeMetricFamily("m3u8_queued_requests", "等待源站并发名额的片段请求数", labels=["host"])
+        limit = GaugeMetricFamily("m3u8_host_concurrency_limit", "源站当前的自适应并发上限", labels=["host"])
+        for host, limiter in list(self.scheduler.host_limiters.items()):
+            in_flight.add_metric([host], limiter.in_flight)
+            waiting.add_metric([host], limiter.waiting)
+            limit.add_metric([host], limiter.limit)
+        yield in_flight
+        yield waiting
+        yield limit
+
+# 全局任务调度器
+scheduler = JobScheduler(
+    max_jobs=int(os.environ.get("MAX_CONCURRENT_JOBS", 4)),
+    max_requests=int(os.environ.get("MAX_CONCURRENT_REQUESTS", 256)),
+    max_requests_per_host=int(os.environ.get("MAX_REQUESTS_PER_HOST", 32)),
+    initial_requests_per_host=int(os.environ.get("INITIAL_REQUESTS_PER_HOST", 4)),
+)
+
+# 所有工具调用和下载任务共用的HTTP连接池。单源站连接数上限需要容纳被拆分为Range子请求的片段
+http_pool = HttpPool(
+    limit=int(os.environ.get("HTTP_POOL_SIZE", scheduler.max_requests * RANGE_SPLIT_PARTS)),
+    limit_per_host=int(os.environ.get("HTTP_POOL_PER_HOST", scheduler.max_requests_per_host * RANGE_SPLIT_PARTS + 8)),
+    keepalive_timeout=float(os.environ.get("HTTP_KEEPALIVE_SECONDS", 30)),
+)
+
+# 所有工具调用和下载任务共用的播放列表缓存
+playlist_cache = PlaylistCache(
+    max_entries=int(os.environ.get("PLAYLIST_CACHE_SIZE", 128)),
+    ttl=float(os.environ.get("PLAYLIST_CACHE_TTL", 300)),
+)
+
+# 全局片段缓存，SEGMENT_CACHE_MB为0（默认）时不启用
+segment_cache = SegmentCache(
+    os.path.join(DATA_DIR, "segment_cache"),
+    max_bytes=int(os.environ.get("SEGMENT_CACHE_MB", 0)) * 1024 * 1024,
+    ignore_params=[p.strip() for p in os.environ.get("CACHE_IGNORE_PARAMS", "auth_key").split(',') if p.strip()],
+)
+
+# MCP提示模板数据
+PROMPTS = {
+    "download_video": {
+        "id": "download_video",
+        "name": "下载视频",
+        "description": "从m3u8链接下载视频的提示模板",
+        "content": "请帮我下载以下m3u8链接的视频：{url}，保存到{output_path}。"
+    },
+    "analyze_video": {
+        "id": "analyze_video",
+        "name": "分析视频",
+        "description": "分析m3u8视频的提示模板",
+        "content": "请分析以下m3u8链接的内容：{url}，并告诉我视频的基本信息。"
+    }
+}
+
+# MCP资源数据
+RESOURCES = {
+    "readme": {
+        "uri": "readme",
+        "content": """
+# MCP M3U8 视频下载服务
+
+这是一个用于下载、解密和合并m3u8视频的服务器，支持以下功能：
+
+1. 分析m3u8文件内容
+2. 在后台下载并解密m3u8视频
+3. 按任务查询下载进度、取消任务
+4. 清理临时文件
+
+## 使用方法
+
+1. 使用`analyze_m3u8`工具分析视频信息
+2. 使用`download_m3u8_video`工具提交下载任务，获得任务ID；多个链接可以用`download_m3u8_batch`一次提交
+3. 使用`check_download_status`工具按任务ID（或批量任务ID）查询进度，`cancel_download`工具取消任务
+4. 使用`clean_temp_files`工具清理临时文件
+        """
+    },
+    "usage_example": {
+        "uri": "usage_example",
+        "content": """
+# 使用示例
+
+以下是在n8n中使用MCP客户端连接到此服务器的示例：
+
+1. 在n8n中添加MCP客户端节点
+2. 选择SSE连接方式
+3. 设置SSE URL为`http://<host>:3001/sse`
+4. 如果配置了API密钥，添加Header: `X-API-Key: <your-api-key>`
+5. 选择操作（如Execute Tool）
+6. 选择要执行的工具（如analyze_m3u8）
+7. 设置参数并执行
+        """
+    }
+}
+
+# 注册MCP提示模板
+for prompt_id, prompt_data in PROMPTS.items():
+    # 为每个提示模板创建唯一的函数
+    def create_prompt_func(p_id):
+        @mcp.prompt(name=PROMPTS[p_id]["id"], description=PROMPTS[p_id]["description"])
+        def prompt_func():
+            """返回提示模板内容"""
+            return [{"role": "user", "content": PROMPTS[p_id]["content"]}]
+        return prompt_func
+    
+    # 立即执行函数以避免闭包问题
+    create_prompt_func(prompt_id)
+
+# 注册MCP资源
+for res_uri, res_data in RESOURCES.items():
+    # 为每个资源创建唯一的函数
+    def create_resource_func(uri):
+        @mcp.resource(uri=f"resource://{uri}", name=uri, description=uri)
+        def resource_func():
+            """返回资源内容"""
+            return RESOURCES[uri]["content"]
+        return resource_func
+    
+    # 立即执行函数以避免闭包问题
+    create_resource_func(res_uri)
+
+# 添加MCP工具：列出提示模板
+@mcp.tool()
+async def list_prompts() -> str:
+    """
+    列出所有可用的提示模板
+    
+    Returns:
+        提示模板列表信息
+    """
+    result = "可用提示模板：\n\n"
+    for prompt_id, prompt in PROMPTS.items():
+        result += f"ID: {prompt['id']}\n"
+        result += f"名称: {prompt['name']}\n"
+        result += f"描述: {prompt['description']}\n\n"
+    
+    return result
+
+# 添加MCP工具：获取提示模板
+@mcp.tool()
+async def get_prompt(prompt_id: str) -> str:
+    """
+    获取指定的提示模板
+    
+    Args:
+        prompt_id: 提示模板的ID
+    
+    Returns:
+        提示模板内容
+    """
+    if prompt_id not in PROMPTS:
+        return f"错误：未找到ID为 {prompt_id} 的提示模板"
+    
+    prompt = PROMPTS[prompt_id]
+    result = f"ID: {prompt['id']}\n"
+    result += f"名称: {prompt['name']}\n"
+    result += f"描述: {prompt['description']}\n"
+    result += f"内容: {prompt['content']}\n"
+    
+    return result
+
+# 添加MCP工具：列出资源
+@mcp.tool()
+async def list_resources() -> str:
+    """
+    列出所有可用的资源
+    
+    Returns:
+        资源列表信息
+    """
+    result = "可用资源：\n\n"
+    for uri, resource in RESOURCES.items():
+        result += f"URI: {resource['uri']}\n"
+    
+    return result
+
+# 添加MCP工具：读取资源
+@mcp.tool()
+async def read_resource(uri: str) -> str:
+    """
+    读取指定的资源
+    
+    Args:
+        uri: 资源的URI
+    
+    Returns:
+        资源内容
+    """
+    if uri not in RESOURCES:
+        return f"错误：未找到URI为 {uri} 的资源"
+    
+    return RESOURCES[uri]['content']
+
+# MCP工具：分析m3u8文件
+@mcp.tool()
+async def analyze_m3u8(m3u8_url: str, sample_segments: int = 10, variant_policy: str = "bandwidth",
+                       max_bandwidth: int = 0) -> str:
+    """
+    分析m3u8文件，获取基本信息
+    
+    总时长按#EXTINF累加；预估大小优先使用字节范围，其次对部分片段并发发送HEAD请求采样，
+    最后按主播放列表中的BANDWIDTH估算。传入主播放列表时列出所有清晰度、备选音频和字幕，
+    并分析按variant_policy和max_bandwidth选中的清晰度（与下载时的选择相同）
+    
+    Args:
+        m3u8_url: m3u8文件的URL地址
+        sample_segments: 估算大小时采样的片段数，默认为10，0表示不采样，不小于片段数时请求全部片段
+        variant_policy: 主播放列表的清晰度选择策略，bandwidth为带宽最高（默认），resolution为分辨率最高
+        max_bandwidth: 只选择带宽不超过该值（bit/s）的清晰度，默认为0（不限）
+    
+    Returns:
+        m3u8文件的基本信息
+    """
+    try:
+        session = http_pool.session()
+        # 下载并解析m3u8内容（使用播放列表缓存，随后的下载任务不需要再次请求和解析）
+        _, playlist = await playlist_cache.get(session, m3u8_url)
+        
+        variant = None
+        info = {}
+        if isinstance(playlist, MasterPlaylist):
+            variant = select_variant(playlist, variant_policy, max_bandwidth)
+            info["清晰度"] = "\n" + "\n".join(f"  {v.describe()}: {v.url}" for v in playlist.variants)
+            for media_type, title in (("AUDIO", "备选音频"), ("SUBTITLES", "字幕")):
+                media = [m for m in playlist.media if m.type == media_type and m.uri]
+                if media:
+                    info[title] = "\n" + "\n".join(f"  [{m.group_id}] {m.describe()}: {m.uri}" for m in media)
+            info["分析的清晰度"] = variant.describe()
+            _, playlist = await playlist_cache.get_media(session, variant.url)
+        
+        segments = playlist.segments
+        keys = playlist.keys
+        duration = playlist.duration
+        estimate = await estimate_size(
+            session, playlist, sample_segments,
+            bandwidth=variant and (variant.average_bandwidth or variant.bandwidth),
+            peak_bandwidth=variant and variant.bandwidth,
+        )
+        
+        info |= {
+            "加密方式": keys[0].method if keys else "无加密",
+            "ts文件数量": len(segments),
+            "总时长": f"{time.strftime('%H:%M:%S', time.gmtime(duration))}（{duration:.1f}秒）",
+            "预估大小(MB)": estimate.describe() if estimate else "未知",
+        }
+        if estimate and duration:
+            info["平均码率"] = f"{estimate.size * 8 / duration / 1000:.0f}kbps"
+        if not playlist.endlist:
+            info["类型"] = "直播（没有ENDLIST，可使用live参数录制）"
+        info |= {
+            "第一个ts文件": segments[0].url,
+            "密钥地址": ", ".join(key.uri for key in keys) if keys else "无"
+        }
+        
+        result = "m3u8文件分析结果:\n"
+        for key, value in info.items():
+            result += f"{key}: {value}\n"
+            
+        return result
+        
+    except Exception as e:
+        return f"分析失败: {str(e)}"
+
+class SegmentPipeline:
+    """
+    片段下载流水线：把片段分组请求、下载解密后交给SegmentWriter按顺序写入
+    
+    片段可以分多批加入（直播录制时每次轮询加入新出现的片段）。分好的请求组先排队，
+    组内最后一个片段进入写入窗口时才创建下载任务，同时存在的任务数不超过窗口大小，与片段总数无关。
+    失败的请求在同一个并发池中
+    退避后重试；重试后仍然失败的片段以SegmentResult记录在failed中，默认中止写入器，
+    skip_failed为True时跳过这些片段继续写入后面的内容。
+    """
+    
+    def __init__(self, session, job, writer, keys, skip_failed=False, desc="下载并解密TS文件"):
+        self.session = session
+        self.job = job
+        self.writer = writer
+        self.keys = keys
+        self.skip_failed = skip_failed
+        # 本流水线的失败结果，同时汇总到任务的failed_segments（一个任务可能同时下载多路媒体）
+        self.failed = []
+        # 已加入流水线的片段数（包括续传复用的片段）
+        self.count = writer.next_index
+        job.segments_total += self.count
+        # 进度条只在终端中显示；客户端通过MCP进度通知或SSE事件获取进度（见ProgressTracker）
+        self.progress = tqdm.tqdm(total=self.count, initial=self.count, desc=desc, disable=None)
+        self._tasks = set()
+        # 等待进入写入窗口的请求组 (起始序号, 片段列表)，以及按窗口逐个启动它们的任务
+        self._queue = deque()
+        self._producer = None
+        # 初始化片段的ident -> 获取其内容的任务，每个初始化片段只请求一次
+        self._init_sections = {}
+    
+    def add(self, segments):
+        """加入一批新片段，编号接在已加入的片段之后"""
+        base = self.count
+        self.count += len(segments)
+        self.job.segments_total += len(segments)
+        self.progress.total = self.count
+        self.progress.refresh()
+        self._queue.extend((base + start, segments[start:end]) for start, end in plan_requests(segments))
+        if self._producer is None:
+            self._producer = self._start(self._produce())
+    
+    def _start(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+    
+    async def _produce(self):
+        """按写入窗口依次为排队的请求组创建下载任务，写入器中止时丢弃其余的组"""
+        try:
+            while self._queue:
+                index, segments = self._queue[0]
+                if not await self.writer.wait_for_slot(index + len(segments) - 1):
+                    self._queue.clear()
+                    break
+                self._queue.popleft()
+                self._start(self._run(index, segments))
+        finally:
+            self._producer = None
+    
+    async def _run(self, index, segments):
+        """下载一组片段（一次请求），失败时按退避时间等待后重试，直到成功或达到最大重试次数"""
+        if not await self.writer.wait_for_slot(index + len(segments) - 1):
+            return
+        job = self.job
+        result = SegmentResult(index, segments[0].url, len(segments))
+        host = urlsplit(result.url).netloc
+        with job.trace_lane() as track:
+            while True:
+                result.attempts += 1
+                try:
+                    inits = [await self._init_section(segment.init, track) if segment.init else None
+                             for segment in segments]
+                    spools, cached = await self._attempt(segments, track)
+                    break
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    result.error = e
+                if result.attempts > job.max_retries:
+                    await self._fail(result)
+                    return
+                # 等待期间不占用请求名额，其他片段（包括其他重试中的片段）照常并发下载
+                job.retries += 1
+                SEGMENT_RETRIES.labels(host, result.error_class).inc()
+                with job.span("重试等待", "segment", track, url=result.url, attempt=result.attempts, error=result.error_class):
+                    await asyncio.sleep(retry_delay(result.attempts))
+        
+        result.status = SEGMENT_CACHED if cached else SEGMENT_OK
+        for i, (spool, init) in enumerate(zip(spools, inits), index):
+            job.bytes_done += spool.tell()
+            await self.writer.write(i, spool, host, init)
+            job.segments_done += 1
+        self.progress.update(len(segments))
+    
+    async def _init_section(self, init, track=None):
+        """初始化片段的 (ident, 内容)，同一初始化片段的各组片段共用一次请求，请求失败时下次重新请求"""
+        task = self._init_sections.get(init.ident)
+        if task is None:
+            async def fetch():
+                with self.job.span("获取初始化片段", "segment", track, url=init.url):
+                    return await fetch_init_section(self.session, init, self.keys)
+            
+            def done(task):
+                if task.cancelled() or task.exception() is not None:
+                    self._init_sections.pop(init.ident, None)
+            
+            task = self._init_sections[init.ident] = asyncio.ensure_future(fetch())
+            task.add_done_callback(done)
+        return init.ident, await asyncio.shield(task)
+    
+    async def _attempt(self, segments, track=None):
+        """请求一次，启用对冲时达到对冲阈值仍未完成则发出对冲请求"""
+        if not HEDGE_PERCENTILE:
+            return await process_one_url(self.session, self.job, segments, self.keys, track=track)
+        return await self._hedged(segments, track)
+    
+    async def _hedged(self, segments, track=None):
+        """
+        先发出原请求，从它占到请求名额、真正发出时开始计时，超过对冲阈值仍未完成时再发出对冲请求，
+        采用先成功的结果并取消另一个。等待期间每隔HEDGE_RECHECK秒按最新的样本重新计算阈值，
+        开始时样本不足的请求在样本足够后也会被对冲
+        """
+        job = self.job
+        issued = asyncio.get_running_loop().create_future()
+        primary = asyncio.create_task(process_one_url(self.session, job, segments, self.keys, track=track, issued=issued))
+        tasks = [primary]
+        winner = None
+        try:
+            while True:
+                delay = job.hedge_delay()
+                if issued.done() and delay is not None:
+                    remaining = issued.result() + delay - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    timeout = min(remaining, HEDGE_RECHECK)
+                else:
+                    timeout = HEDGE_RECHECK
+                done, _ = await asyncio.wait(tasks, timeout=timeout)
+                if done:
+                    winner = primary
+                    return primary.result()
+            
+            job.hedges_fired += 1
+            host = HEDGE_HOSTS.get(urlsplit(segments[0].url).netloc)
+            # 对冲请求与原请求同时进行，记录在单独的轨道上
+            hedge_track = f"{track} 对冲" if track else None
+            tasks.append(asyncio.create_task(process_one_url(self.session, job, segments, self.keys, host, hedge_track)))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in tasks:
+                    if task in done and task.exception() is None:
+                        winner = task
+                        if winner is not primary:
+                            job.hedges_won += 1
+                        return winner.result()
+            # 原请求和对冲请求都失败了，按原请求的错误重试
+            return primary.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # 两个请求几乎同时成功时，释放未采用的结果
+            for task in tasks:
+                if task is not winner and not task.cancelled() and task.exception() is None:
+                    for spool in task.result()[0]:
+                        spool.close()
+    
+    async def _fail(self, result):
+        """处理重试后仍然失败的一组片段"""
+        self.failed.append(result)
+        self.job.failed_segments.append(result)
+        SEGMENT_FAILURES.labels(urlsplit(result.url).netloc, result.error_class).inc()
+        if self.skip_failed:
+            # 直播内容无法重新获取，跳过失败的片段，录制继续
+            result.status = SEGMENT_SKIPPED
+            logger.warning("跳过失败的片段: %s", result.describe())
+            self.job.segments_missed += result.count
+            for i in range(result.index, result.index + result.count):
+                await self.writer.write(i, None)
+            self.progress.update(result.count)
+        else:
+            # 片段重试后仍然失败，输出文件无法完整，停止其余片段
+            result.status = SEGMENT_FAILED
+            await self.writer.abort()
+    
+    async def join(self):
+        """等待所有已加入的片段处理完毕"""
+        while self._tasks:
+            await asyncio.gather(*self._tasks)
+    
+    async def close(self):
+        """取消尚未完成的片段"""
+        tasks = list(self._tasks) + list(self._init_sections.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.progress.close()
+
+# 直播录制：按目标时长轮询播放列表，根据EXT-X-MEDIA-SEQUENCE只把新出现的片段加入流水线，
+# 直到播放列表出现ENDLIST、录制时长达到max_duration、任务被停止或片段下载失败。
+# 同时录制多路媒体时各路分别轮询自己的播放列表，任务的录制时长取其中最长的一路
+async def record_live(session, job, pipeline, playlist, m3u8_url):
+    last_sequence = None
+    recorded = 0.0
+    stop_reason = None
+    while True:
+        new_segments = []
+        for offset, segment in enumerate(playlist.segments):
+            sequence = playlist.media_sequence + offset
+            if last_sequence is not None and sequence <= last_sequence:
+                continue
+            if job.max_duration and recorded >= job.max_duration:
+                break
+            if last_sequence is not None and sequence > last_sequence + 1:
+                # 两次轮询之间窗口滑过了部分片段，这些片段已经无法获取
+                job.segments_missed += sequence - last_sequence - 1
+                logger.warning("直播窗口已滑过 %d 个片段", sequence - last_sequence - 1)
+            last_sequence = sequence
+            new_segments.append(segment)
+            recorded += segment.duration
+        job.recorded_duration = max(job.recorded_duration, recorded)
+        
+        # 密钥轮换时获取新出现的密钥
+        new_keys = [key for key in playlist.keys if key.uri not in pipeline.keys]
+        if new_keys:
+            pipeline.keys.update(await fetch_keys(session, new_keys))
+        if new_segments:
+            pipeline.add(new_segments)
+        
+        if playlist.endlist:
+            stop_reason = "直播已结束"
+        elif job.max_duration and recorded >= job.max_duration:
+            stop_reason = "达到录制时长"
+        if stop_reason:
+            break
+        
+        # 有新片段时等待一个目标时长，否则等待半个目标时长后再刷新
+        interval = (playlist.target_duration or 10) / (1 if new_segments else 2)
+        try:
+            await asyncio.wait_for(job.stop_requested.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+        if job.stop_requested.is_set():
+            stop_reason = "已手动停止"
+            break
+        
+        try:
+            _, playlist = await playlist_cache.get_media(session, m3u8_url, max_age=0)
+        except Exception as e:
+            # 保留已录制的内容，不因为播放列表刷新失败丢弃整个录制
+            stop_reason = f"播放列表刷新失败: {e}"
+            break
+    job.stop_reason = job.stop_reason or stop_reason
+
+class Rendition:
+    """
+    任务要下载的一路媒体，各自输出到单独的文件：视频（媒体播放列表本身或主播放列表中选中的清晰度），
+    以及主播放列表中的备选音频和字幕（输出到 <输出文件名>.<语言或名称>.<扩展名>）
+    """
+    KIND_NAMES = {"VIDEO": "视频", "AUDIO": "音频", "SUBTITLES": "字幕"}
+    
+    def __init__(self, kind, url, output_path, name=None, suffix=None, feed=None):
+        self.kind = kind
+        self.url = url
+        self.output_path = output_path
+        self.name = name
+        self.suffix = suffix
+        # 播放列表仍在接收时为其SegmentFeed，下载从已解析出的片段开始
+        self.feed = feed
+    
+    @property
+    def primary(self):
+        return self.suffix is None
+    
+    @property
+    def title(self):
+        return self.KIND_NAMES.get(self.kind, self.kind) + (f"({self.name})" if self.name else "")
+    
+    def part_path(self, job):
+        """下载中的文件在任务工作目录中的路径"""
+        return os.path.join(job.workspace, os.path.basename(self.output_path) + '.part')
+    
+    def manifest_id(self, job):
+        """断点续传清单的文件名，视频沿用任务ID，以便clean_temp_files按任务ID识别"""
+        return job.job_id if self.primary else f"{job.job_id}.{self.kind.lower()}-{self.suffix}"
+
+class SegmentFeed:
+    """正在接收的媒体播放列表：边接收边解析出的片段按批次排队，fetch为获取整个播放列表的任务"""
+    
+    def __init__(self):
+        self.batches = deque()
+        self.fetch = None
+        self._arrived = asyncio.Event()
+    
+    async def put(self, segments):
+        self.batches.append(segments)
+        self._arrived.set()
+    
+    async def started(self):
+        """等到第一批片段或整个播放列表接收完毕，返回是否仍在接收"""
+        await self._wait()
+        return not self.fetch.done()
+    
+    async def next(self):
+        """下一批片段，播放列表接收完毕且没有剩余片段时返回None，接收失败时抛出异常"""
+        await self._wait()
+        if not self.batches:
+            self.fetch.result()
+            return None
+        return self.batches.popleft()
+    
+    async def _wait(self):
+        if self.batches or self.fetch.done():
+            return
+        self._arrived.clear()
+        arrived = asyncio.ensure_future(self._arrived.wait())
+        try:
+            await asyncio.wait((arrived, self.fetch), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            arrived.cancel()
+
+# 确定任务要下载的各路媒体：媒体播放列表只有视频一路；主播放列表按任务的策略选择清晰度，
+# 再按rendition_mode加上该清晰度所属组中的音频和字幕（预先获取它们的播放列表以确定输出文件的扩展名）。
+# 需要向源站请求的点播媒体播放列表边接收边解析，收到第一批片段即返回，其余片段由下载流水线随到随下
+async def resolve_renditions(session, job):
+    video = Rendition("VIDEO", job.m3u8_url, job.output_path)
+    if not job.live and not job.start and not job.end and not os.path.exists(video.part_path(job)):
+        feed = SegmentFeed()
+        feed.fetch = asyncio.ensure_future(playlist_cache.get(session, job.m3u8_url, on_segments=feed.put))
+        try:
+            streaming = await feed.started()
+        except BaseException:
+            # 任务在等待第一批片段时被取消：播放列表的接收任务没有人再读取，一起取消
+            feed.fetch.cancel()
+            raise
+        if streaming:
+            video.feed = feed
+            return [video]
+        _, playlist = feed.fetch.result()
+    else:
+        _, playlist = await playlist_cache.get(session, job.m3u8_url)
+    if not isinstance(playlist, MasterPlaylist):
+        return [video]
+    
+    job.variant = select_variant(playlist, job.variant_policy, job.max_bandwidth)
+    renditions = [Rendition("VIDEO", job.variant.url, job.output_path)]
+    media = select_media(playlist, job.variant, job.rendition_mode)
+    media_playlists = await asyncio.gather(*(playlist_cache.get_media(session, m.uri) for m in media))
+    
+    base = os.path.splitext(job.output_path)[0]
+    suffixes = set()
+    for m, (_, media_playlist) in zip(media, media_playlists):
+        suffix = re.sub(r'[^\w-]+', '_', m.language or m.name).strip('_') or m.type.lower()
+        while (m.type, suffix) in suffixes:
+            suffix += '_'
+        suffixes.add((m.type, suffix))
+        ext = os.path.splitext(urlsplit(media_playlist.segments[0].url).path)[1].lower()
+        if m.type == "SUBTITLES" and ext in ('', '.vtt', '.webvtt'):
+            ext = '.vtt'
+        renditions.append(Rendition(m.type, m.uri, f"{base}.{suffix}{ext or '.ts'}", m.name, suffix))
+    return renditions
+
+WEBVTT_HEADER_PATTERN = re.compile(r'^WEBVTT[^\n]*\n(?:[^\n]+\n)*', re.MULTILINE)
+
+# WebVTT字幕的每个片段都以自己的WEBVTT文件头开始，拼接后只保留第一个文件头
+def merge_webvtt(path):
+    with open(path, encoding='utf-8', errors='replace') as f:
+        text = f.read().replace('\ufeff', '').replace('\r\n', '\n')
+    headers = WEBVTT_HEADER_PATTERN.finditer(text)
+    first = next(headers, None)
+    if first is None:
+        return
+    text = text[:first.end()] + WEBVTT_HEADER_PATTERN.sub('', text[first.end():])
+    with open(path, mode='w', encoding='utf-8') as f:
+        f.write(text)
+
+# 播放列表仍在接收时，把解析出的每批片段（先获取其中新出现的密钥）加入清单和流水线，
+# 第一批片段到达即开始下载；接收完毕后保存播放列表文本并按完整的播放列表检查磁盘空间
+async def stream_playlist(session, job, rendition, pipeline, manifest):
+    while True:
+        segments = await rendition.feed.next()
+        if segments is None:
+            break
+        new_keys = {uri: key for uri, key in segment_keys(segments).items() if uri not in pipeline.keys}
+        if new_keys:
+            with job.span("获取密钥", "key", rendition.title, count=len(new_keys)):
+                pipeline.keys.update(await fetch_keys(session, list(new_keys.values())))
+        manifest.extend(segments, pipeline.keys)
+        pipeline.add(segments)
+    
+    m3u8_content, playlist = rendition.feed.fetch.result()
+    await asyncio.to_thread(manifest.complete, m3u8_content)
+    logger.info("播放列表接收完毕，共 %d 个ts文件", len(playlist.segments))
+    with job.span("检查磁盘空间", "disk", rendition.title):
+        await check_job_disk_space(session, job, playlist, rendition.part_path(job),
+                                   variant=job.variant if rendition.primary else None)
+
+# 下载任务中的一路媒体：下载、解密并按顺序写入该路的输出文件，成功时返回文件大小，失败时抛出异常
+async def download_rendition(session, job, rendition):
+    part_path = rendition.part_path(job)
+    prefix = "" if rendition.primary else f"[{rendition.title}] "
+    track = rendition.title
+    
+    # 工作目录中有上次未完成的文件和清单时续传（直播内容无法重新获取，不续传）
+    manifest = None
+    if not job.live and os.path.exists(part_path):
+        manifest = SegmentManifest.load(job, rendition)
+    
+    live = job.live
+    if manifest:
+        # 使用清单中保存的播放列表和密钥，保证与已写入的内容一致
+        m3u8_content = manifest.data["playlist"]
+        playlist = parse_m3u8_text(m3u8_content, rendition.url)
+        if job.start or job.end:
+            playlist = playlist.clip(job.start, job.end)
+        keys = manifest.keys
+        with job.span("校验已下载内容", "resume", track):
+            start_index = await asyncio.to_thread(manifest.verify, part_path)
+        
+        # 检查磁盘空间
+        with job.span("检查磁盘空间", "disk", track):
+            await check_job_disk_space(session, job, playlist, part_path,
+                                       variant=job.variant if rendition.primary else None)
+    elif rendition.feed is not None:
+        # 播放列表仍在接收：片段和密钥随解析逐批加入清单，接收完毕后再检查磁盘空间
+        manifest = await asyncio.to_thread(SegmentManifest.create, job, rendition, None, {}, [])
+        playlist = None
+        keys = {}
+        start_index = 0
+    else:
+        # 下载并解析m3u8内容（刚分析过的播放列表直接使用缓存）
+        with job.span("获取媒体播放列表", "playlist", track, url=rendition.url):
+            m3u8_content, playlist = await playlist_cache.get_media(session, rendition.url)
+        
+        # 已经带ENDLIST的播放列表按点播下载
+        if live and playlist.endlist:
+            live = False
+            if rendition.primary:
+                job.live = False
+        
+        # 只保留覆盖指定时间范围的片段，之后的估算、密钥和下载都只针对这些片段
+        if not live and (job.start or job.end):
+            playlist = playlist.clip(job.start, job.end)
+        
+        # 检查磁盘空间
+        with job.span("检查磁盘空间", "disk", track):
+            await check_job_disk_space(session, job, playlist, part_path, live,
+                                       variant=job.variant if rendition.primary else None)
+        
+        # 如果有加密，获取所有密钥（每个密钥只请求一次）
+        with job.span("获取密钥", "key", track, count=len(playlist.keys)):
+            keys = await fetch_keys(session, playlist.keys)
+        
+        if not live:
+            manifest = await asyncio.to_thread(SegmentManifest.create, job, rendition, m3u8_content, keys, playlist.segments)
+        start_index = 0
+    
+    if rendition.primary and (job.start or job.end):
+        job.clip_range = (playlist.time_offset, playlist.time_offset + playlist.duration)
+    
+    # 边下载边按顺序写入输出文件，完成后再移动到输出路径
+    job.segments_done += start_index
+    job.segments_resumed += start_index
+    # 续传时已写入的最后一个片段的初始化片段已经在文件中，之后的片段使用同一个时不再写入
+    init = playlist.segments[start_index - 1].init if start_index else None
+    writer = SegmentWriter(part_path, window=max(job.processes * 2, 16), start_index=start_index,
+                           on_commit=manifest.mark_done if manifest else None,
+                           trace=job.trace, track=f"{track} 写入", init=init.ident if init else None)
+    pipeline = SegmentPipeline(session, job, writer, keys, skip_failed=live,
+                               desc=f"下载并解密{'TS文件' if rendition.primary else rendition.title}")
+    
+    if start_index:
+        logger.info("%s断点续传: 复用已完成的 %d 个片段", prefix, start_index)
+    
+    try:
+        with job.span("下载片段", "download", track) as span:
+            if live:
+                logger.info("%s开始录制直播: %s", prefix, rendition.url)
+                await record_live(session, job, pipeline, playlist, rendition.url)
+            elif rendition.feed is not None:
+                logger.info("%s边接收播放列表边开始下载...", prefix)
+                await stream_playlist(session, job, rendition, pipeline, manifest)
+            else:
+                logger.info("%s开始下载 %d 个ts文件...", prefix, len(playlist.segments) - start_index)
+                pipeline.add(playlist.segments[start_index:])
+            await pipeline.join()
+            span["segments"] = pipeline.count - start_index
+    finally:
+        if rendition.feed is not None:
+            rendition.feed.fetch.cancel()
+        await pipeline.close()
+        writer.close()
+        # 失败或被取消时保留.part文件，保存清单以便续传
+        if manifest:
+            manifest.save(force=True)
+
+    # 重试后仍有失败的文件
+    if pipeline.failed:
+        failed_count = sum(result.count for result in pipeline.failed)
+        raise Exception(f"{prefix}有 {failed_count} 个片段在重试{job.max_retries}次后仍然失败:\n"
+                        + "\n".join(result.describe() for result in pipeline.failed))
+    
+    if rendition.kind == "SUBTITLES":
+        with job.span("合并字幕", "finalize", track):
+            await asyncio.to_thread(merge_webvtt, part_path)
+    else:
+        # 检查文件大小是否合理（字幕文件可能很小，不检查）
+        file_size = os.path.getsize(part_path)
+        if file_size < 1024:  # 至少1KB
+            os.remove(part_path)
+            if manifest:
+                manifest.remove()
+            raise Exception(f"{prefix}合并的文件大小异常: {file_size} 字节")
+    
+    with job.span("移动到输出路径", "finalize", track):
+        await asyncio.to_thread(move_to_output, part_path, rendition.output_path)
+    if manifest:
+        manifest.remove()
+    return os.path.getsize(rendition.output_path)
+
+# 执行下载任务：同时下载视频和选中的音频、字幕，成功时返回结果信息，失败时抛出异常
+async def run_download_job(job):
+    # 创建输出目录（如果不存在）
+    os.makedirs(os.path.dirname(os.path.abspath(job.output_path)), exist_ok=True)
+    os.makedirs(job.workspace, exist_ok=True)
+    
+    session = http_pool.session()
+    with job.span("解析播放列表", "playlist", "任务", url=job.m3u8_url):
+        job.renditions = await resolve_renditions(session, job)
+    if job.variant is not None:
+        logger.info("选择清晰度: %s，同时下载 %d 路媒体", job.variant.describe(), len(job.renditions))
+    
+    # 各路媒体同时下载，片段请求共用任务和调度器的并发名额，总耗时接近最长的一路；
+    # 任意一路失败时取消其余各路
+    tasks = [asyncio.create_task(download_rendition(session, job, rendition)) for rendition in job.renditions]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        whole_files = list(job.whole_files.values())
+        for task in whole_files:
+            task.cancel()
+        await asyncio.gather(*whole_files, return_exceptions=True)
+    for task in tasks:
+        if not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+    sizes = [task.result() for task in tasks]
+    
+    # 计算处理时间
+    elapsed_time = time.time() - job.started_at
+    
+    result = f"视频已成功下载并保存到: {job.output_path}\n" \
+             f"文件大小: {sizes[0] / (1024 * 1024):.2f}MB\n"
+    if job.variant is not None:
+        result += f"清晰度: {job.variant.describe()}\n"
+    if job.clip_range is not None:
+        result += f"时间范围: {job.clip_range[0]:.1f} - {job.clip_range[1]:.1f}秒\n"
+    for rendition, size in zip(job.renditions[1:], sizes[1:]):
+        result += f"{rendition.title}: {rendition.output_path}（{size / (1024 * 1024):.2f}MB）\n"
+    if job.segments_resumed:
+        result += f"断点续传: 复用了已完成的 {job.segments_resumed} 个片段\n"
+    if job.live:
+        result += f"录制时长: {job.recorded_duration:.1f}秒（{job.segments_done} 个片段）\n" \
+                  f"停止原因: {job.stop_reason}\n"
+        if job.segments_missed:
+            result += f"丢失片段: {job.segments_missed} 个\n"
+    result += f"处理时间: {elapsed_time:.2f}秒\n" \
+              f"下载速度: {job.bytes_done / (1024 * 1024) / elapsed_time:.2f}MB/s\n" \
+              f"平均并发请求数: {job.average_concurrency():.1f}"
+    if job.retries:
+        result += f"\n重试次数: {job.retries}"
+    if job.segment_times:
+        result += f"\n片段耗时: {job.latency_report()}"
+    for host, text in job.concurrency_report().items():
+        result += f"\n并发上限变化({host}): {text}"
+    return result
+
+# 检查下载的时间范围参数，有误时返回错误信息
+def check_clip(start, end, live=False):
+    if not isinstance(start, (int, float)) or not isinstance(end, (int, float)):
+        return "start和end必须是秒数"
+    if start < 0 or end < 0:
+        return "start和end不能为负数"
+    if end and end <= start:
+        return f"结束时间 {end:g} 秒必须晚于开始时间 {start:g} 秒"
+    if live and (start or end):
+        return "直播录制不支持start/end，请使用max_duration限制录制时长"
+    return None
+
+# MCP工具：下载并处理m3u8视频
+@mcp.tool()
+async def download_m3u8_video(m3u8_url: str, output_path: str, processes: int = 0, max_retries: int = 3, wait: bool = False,
+                             live: bool = False, max_duration: float = 0, variant_policy: str = "bandwidth",
+                             max_bandwidth: int = 0, renditions: str = "default", start: float = 0, end: float = 0,
+                             trace: bool = False, ctx: Context = None) -> str:
+    """
+    提交下载任务：从m3u8链接下载视频，解密并合并为mp4文件
+    
+    任务在后台执行，默认立即返回任务ID，可通过check_download_status查询进度、cancel_download取消任务。
+    live为True时录制直播：按目标时长轮询播放列表，持续下载新片段，直到直播结束、达到max_duration
+    或调用cancel_download停止，停止后保存已录制的内容。
+    传入主播放列表时按variant_policy和max_bandwidth选择清晰度，并按renditions同时下载备选音频和字幕，
+    分别保存为 <输出文件名>.<语言>.<扩展名>。
+    指定start/end时只下载覆盖该时间范围的片段（按片段边界，不做精确剪切）。
+    wait为True时通过MCP进度通知报告进度，也可以随时订阅 /jobs/<任务ID>/events 的SSE进度事件。
+    trace为True时记录各阶段和每组片段的耗时，任务结束后导出Chrome trace文件，可用get_job_trace查看最慢的区间
+    
+    Args:
+        m3u8_url: m3u8文件的URL地址
+        output_path: 输出mp4文件的本地保存路径
+        processes: 单个任务同时进行的片段请求数上限，默认为0（自动，由各源站的自适应并发控制决定）
+        max_retries: 失败片段的最大重试次数，默认为3
+        wait: 是否等待任务完成后再返回，默认为False
+        live: 是否按直播录制，默认为False
+        max_duration: 直播录制的最长时长（秒），默认为0（不限，直到直播结束或手动停止）
+        variant_policy: 主播放列表的清晰度选择策略，bandwidth为带宽最高（默认），resolution为分辨率最高
+        max_bandwidth: 只选择带宽不超过该值（bit/s）的清晰度，默认为0（不限），都超过时选择带宽最低的
+        renditions: 同时下载的备选媒体，default为默认音频和默认字幕（默认），all为全部音频和字幕，video为只下载视频
+        start: 片段起始时间（秒），默认为0（从头开始）
+        end: 片段结束时间（秒），默认为0（到结尾）
+        trace: 是否记录性能追踪，默认为False
+    
+    Returns:
+        任务ID；wait为True时返回下载结果
+    """
+    error = check_clip(start, end, live)
+    if error:
+        return f"错误：{error}"
+    if variant_policy not in VARIANT_POLICIES:
+        return f"错误：不支持的清晰度选择策略 {variant_policy}，可选: {', '.join(VARIANT_POLICIES)}"
+    if renditions not in RENDITION_MODES:
+        return f"错误：不支持的媒体选择方式 {renditions}，可选: {', '.join(RENDITION_MODES)}"
+    existing = scheduler.find_active_output(output_path)
+    if existing is not None:
+        return f"错误：任务 {existing.job_id} 正在写入 {output_path}，请等待其完成或先取消"
+    
+    job = scheduler.submit(DownloadJob(m3u8_url, output_path, processes, max_retries, live, max_duration,
+                                       variant_policy, max_bandwidth, renditions, start, end, trace))
+    if not wait:
+        return f"下载任务已提交\n任务ID: {job.job_id}\n使用check_download_status查询进度"
+    
+    await wait_with_progress(job, ctx)
+    result = job.result if job.status == JOB_COMPLETED else f"处理失败: {job.result}"
+    if job.trace_path:
+        result += f"\n性能追踪文件: {job.trace_path}"
+    return result
+
+# MCP工具：批量下载m3u8视频
+@mcp.tool()
+async def download_m3u8_batch(items: list[dict], processes: int = 0, max_retries: int = 3, wait: bool = False,
+                              variant_policy: str = "bandwidth", max_bandwidth: int = 0, renditions: str = "default",
+                              trace: bool = False, ctx: Context = None) -> str:
+    """
+    批量提交下载任务：一次提交多个m3u8链接，所有任务由同一个调度器执行
+    
+    同时运行的任务数、全局和单源站的请求并发数由服务器统一限制，名额在各任务之间轮流分配，
+    大视频不会让小视频一直排队。可通过check_download_status查询批量任务的汇总进度、cancel_download取消全部任务。
+    wait为True时通过MCP进度通知报告所有任务合计的进度
+    
+    Args:
+        items: 下载项列表，每项为 {"m3u8_url": m3u8文件的URL地址, "output_path": 输出mp4文件的本地保存路径}，
+            可选 "start"/"end" 指定只下载的时间范围（秒）
+        processes: 单个任务同时进行的片段请求数上限，默认为0（自动）
+        max_retries: 失败片段的最大重试次数，默认为3
+        wait: 是否等待所有任务完成后再返回，默认为False
+        variant_policy: 主播放列表的清晰度选择策略，bandwidth为带宽最高（默认），resolution为分辨率最高
+        max_bandwidth: 只选择带宽不超过该值（bit/s）的清晰度，默认为0（不限）
+        renditions: 同时下载的备选媒体，default为默认音频和默认字幕（默认），all为全部音频和字幕，video为只下载视频
+        trace: 是否为每个任务记录性能追踪，默认为False
+    
+    Returns:
+        批量任务ID；wait为True时返回汇总结果和每个任务的结果
+    """
+    if not items:
+        return "错误：下载项列表为空"
+    if variant_policy not in VARIANT_POLICIES:
+        return f"错误：不支持的清晰度选择策略 {variant_policy}，可选: {', '.join(VARIANT_POLICIES)}"
+    if renditions not in RENDITION_MODES:
+        return f"错误：不支持的媒体选择方式 {renditions}，可选: {', '.join(RENDITION_MODES)}"
+    
+    jobs = []
+    rejected = []
+    outputs = set()
+    for item in items:
+        m3u8_url = item.get("m3u8_url") or item.get("url")
+        output_path = item.get("output_path")
+        if not m3u8_url or not output_path:
+            rejected.append((m3u8_url, output_path, "缺少m3u8_url或output_path"))
+            continue
+        start, end = item.get("start", 0), item.get("end", 0)
+        output = os.path.abspath(output_path)
+        existing = scheduler.find_active_output(output_path)
+        clip_error = check_clip(start, end)
+        if clip_error:
+            rejected.append((m3u8_url, output_path, clip_error))
+        elif output in outputs:
+            rejected.append((m3u8_url, output_path, "与本批次的其他下载项输出到同一文件"))
+        elif existing is not None:
+            rejected.append((m3u8_url, output_path, f"任务 {existing.job_id} 正在写入该文件"))
+        else:
+            outputs.add(output)
+            jobs.append(scheduler.submit(DownloadJob(m3u8_url, output_path, processes, max_retries,
+                                                     variant_policy=variant_policy, max_bandwidth=max_bandwidth,
+                                                     renditions=renditions, start=start, end=end, trace=trace)))
+    
+    batch = scheduler.submit_batch(DownloadBatch(jobs, rejected))
+    if not wait:
+        result = f"批量下载任务已提交\n批量任务ID: {batch.batch_id}\n已提交 {len(jobs)} 个任务"
+        if rejected:
+            result += f"，{len(rejected)} 个下载项未提交"
+        return result + "\n使用check_download_status查询进度"
+    
+    await wait_with_progress(batch, ctx)
+    return batch.describe()
+
+# MCP工具：检查视频下载状态
+@mcp.tool()
+async def check_download_status(job_id: str = "") -> str:
+    """
+    检查下载任务状态
+    
+    Args:
+        job_id: 任务ID或批量任务ID，为空时列出所有任务
+    
+    Returns:
+        任务的进度、速度和预计剩余时间；批量任务的汇总进度；或所有任务的概要
+    """
+    try:
+        if job_id in scheduler.batches:
+            return scheduler.batches[job_id].describe()
+        if job_id:
+            job = scheduler.get(job_id)
+            if job is None:
+                return f"错误：未找到ID为 {job_id} 的下载任务"
+            return job.describe()
+        
+        if not scheduler.jobs:
+            return "当前没有下载任务"
+        
+        active = scheduler.active_jobs()
+        result = f"共 {len(scheduler.jobs)} 个任务，其中 {len(active)} 个未结束:\n"
+        for job in scheduler.jobs.values():
+            result += job.summary() + "\n"
+        return result
+    
+    except Exception as e:
+        return f"检查状态失败: {str(e)}"
+
+# MCP工具：取消下载任务
+@mcp.tool()
+async def cancel_download(job_id: str) -> str:
+    """
+    取消排队中或下载中的任务；正在录制的直播任务会停止录制并保存已录制的内容
+    
+    Args:
+        job_id: 任务ID，或批量任务ID（取消其中所有未结束的任务）
+    
+    Returns:
+        取消结果信息
+    """
+    batch = scheduler.batches.get(job_id)
+    if batch is not None:
+        cancelled = sum(scheduler.cancel(job.job_id) for job in batch.jobs)
+        return f"已取消批量任务 {job_id} 中的 {cancelled} 个未结束任务"
+    
+    job = scheduler.get(job_id)
+    if job is None:
+        return f"错误：未找到ID为 {job_id} 的下载任务"
+    if not scheduler.cancel(job_id):
+        return f"任务 {job_id} 已结束，状态: {JOB_STATUS_NAMES[job.status]}"
+    if job.stop_requested.is_set():
+        return f"已停止录制任务 {job_id}，正在保存已录制的内容"
+    return f"已取消任务 {job_id}"
+
+# MCP工具：查看任务的性能追踪
+@mcp.tool()
+async def get_job_trace(job_id: str, top: int = 10, category: str = "") -> str:
+    """
+    查看开启了trace的下载任务的性能追踪摘要：各阶段（播放列表、密钥、排队、下载、写入等）的次数和耗时，
+    以及最慢的区间。任务仍在运行时返回目前为止的数据；任务结束后完整的追踪数据保存为Chrome trace文件，
+    可以在chrome://tracing或Perfetto中打开
+    
+    Args:
+        job_id: 任务ID
+        top: 列出的最慢区间数，默认为10
+        category: 只列出该类别的最慢区间，如segment（片段排队和下载）、write（写入）、playlist、key，默认为空（全部）
+    
+    Returns:
+        性能追踪摘要
+    """
+    if not JOB_ID_PATTERN.fullmatch(job_id):
+        return f"错误：无效的任务ID {job_id}"
+    job = scheduler.get(job_id)
+    if job is not None and job.trace is not None:
+        data = job.trace.to_chrome_trace(job)
+        path = job.trace_path
+    else:
+        path = os.path.join(TRACE_DIR, f"{job_id}.json")
+        if not os.path.exists(path):
+            return f"错误：任务 {job_id} 没有性能追踪数据，请在提交任务时设置trace为True"
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            return f"读取性能追踪文件失败: {e}"
+    
+    try:
+        result = summarize_trace(data, max(top, 1), category)
+    except (KeyError, TypeError, AttributeError, ValueError) as e:
+        return f"性能追踪文件格式不正确: {path}（{type(e).__name__}: {e}）"
+    if path:
+        result += f"\n追踪文件: {path}"
+    return result
+
+# MCP工具：查看服务器统计信息
+@mcp.tool()
+async def get_server_stats() -> str:
+    """
+    查看服务器统计信息，包括下载任务、HTTP连接池、播放列表缓存和片段缓存
+    
+    Returns:
+        统计信息
+    """
+    sections = {
+        "下载任务": {
+            "总数": len(scheduler.jobs),
+            "未结束": len(scheduler.active_jobs()),
+            "批量任务": len(scheduler.batches),
+            "等待全局名额的片段请求": scheduler.waiting_requests,
+        },
+        "HTTP连接池": http_pool.stats(),
+        "播放列表缓存": playlist_cache.stats(),
+        "片段缓存": segment_cache.stats(),
+        "源站并发控制": {
+            host: f"上限 {limiter.limit}，进行中 {limiter.in_flight}，排队 {limiter.waiting}"
+            for host, limiter in scheduler.host_limiters.items()
+        } or {"状态": "暂无请求"},
+    }
+    result = ""
+    for title, info in sections.items():
+        result += f"{title}:\n"
+        for key, value in info.items():
+            result += f"  {key}: {value}\n"
+    return result
+
+# MCP工具：清理临时文件
+@mcp.tool()
+async def clean_temp_files() -> str:
+    """
+    清理下载过程中产生的临时文件和断点续传清单，正在运行的任务的工作目录会被跳过
+    
+    Returns:
+        清理结果信息
+    """
+    try:
+        count = 0
+        total_size_mb = 0
+        active_ids = {job.job_id for job in scheduler.active_jobs()}
+        skipped = 0
+        
+        if os.path.exists(TEMP_DIR):
+            for name in os.listdir(TEMP_DIR):
+                if name in active_ids:
+                    skipped += 1
+                    continue
+                path = os.path.join(TEMP_DIR, name)
+                # 已结束或残留任务的工作目录整体删除
+                if os.path.isdir(path):
+                    files = [os.path.join(root, f) for root, _, fs in os.walk(path) for f in fs]
+                else:
+                    files = [path]
+                for file_path in files:
+                    try:
+                        size_mb = os.path.getsize(file_path) / (1024 * 1024)
+                        os.remove(file_path)
+                        total_size_mb += size_mb
+                        count += 1
+                    except:
+                        pass
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+        
+        # 工作目录已删除的任务无法再续传，一并删除其清单
+        if os.path.exists(MANIFEST_DIR):
+            for name in os.listdir(MANIFEST_DIR):
+                if name.split('.')[0] not in active_ids:
+                    try:
+                        os.remove(os.path.join(MANIFEST_DIR, name))
+                    except:
+                        pass
+        
+        result = f"已清理 {count} 个临时文件，释放了 {total_size_mb:.2f}MB 磁盘空间"
+        if skipped:
+            result += f"\n跳过了 {skipped} 个正在运行的任务的工作目录"
+        return result
+    
+    except Exception as e:
+        return f"清理失败: {str(e)}"
@@ -1,29 +1,45 @@
 #!/usr/bin/env python
 """
-MCP M3U8视频下载服务器启动脚本
+MCP M3U8视频下载服务器启动脚本（stdio）
+
+只导入下载引擎和工具定义（m3u8_core），不加载FastAPI和mcp_server.py中的HTTP/SSE服务
+（MCP SDK本身仍会导入uvicorn、starlette等）；需要通过SSE提供服务时运行mcp_server.py
 """
 
+import io
 import sys
-from mcp_server import mcp, server_name, server_description
-from mcp import stdio_server
+import anyio
+from mcp.server.stdio import stdio_server
+from m3u8_core import mcp, server_name, server_description, http_pool
+
+async def serve(stdout):
+    try:
+        async with stdio_server(stdout=stdout) as (read_stream, write_stream):
+            await mcp._mcp_server.run(
+                read_stream, write_stream, mcp._mcp_server.create_initialization_options()
+            )
+    finally:
+        await http_pool.close()
 
 def main():
-    print(f"启动 MCP M3U8 视频下载服务器...")
+    # stdout是MCP协议的通道，启动信息、下载日志和进度条都输出到stderr
+    stdout = anyio.wrap_file(io.TextIOWrapper(sys.stdout.buffer, encoding="utf-8"))
+    sys.stdout = sys.stderr
+
+    print("启动 MCP M3U8 视频下载服务器...")
     print(f"服务器名称: {server_name}")
     print(f"服务器说明: {server_description}")
     print("可用工具:")
-    print(" - analyze_m3u8: 分析m3u8文件，获取基本信息")
-    print(" - download_m3u8_video: 从m3u8链接下载视频，解密并合并为mp4文件")
-    print(" - check_download_status: 检查当前下载状态和临时文件夹信息")
-    print(" - clean_temp_files: 清理下载过程中产生的临时文件")
+    for tool in mcp._tool_manager.list_tools():
+        print(f" - {tool.name}: {tool.description.strip().splitlines()[0]}")
     print("\n使用Claude Desktop或其他MCP客户端连接到此服务器")
-    
+
     # 使用stdio作为通信通道启动服务器
     try:
-        stdio_server(mcp)
+        anyio.run(serve, stdout)
     except KeyboardInterrupt:
         print("\n服务器已停止")
         sys.exit(0)
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
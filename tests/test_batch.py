@@ -0,0 +1,32 @@
+from types import SimpleNamespace
+
+import pytest
+
+from m3u8_core import (
+    BATCH_PARTIAL, JOB_CANCELLED, JOB_COMPLETED, JOB_FAILED, JOB_QUEUED, JOB_RUNNING, DownloadBatch,
+)
+
+FINISHED = (JOB_COMPLETED, JOB_FAILED, JOB_CANCELLED)
+
+def batch(statuses, rejected=()):
+    jobs = [SimpleNamespace(status=status, finished=status in FINISHED, segments_done=0, segments_total=0,
+                            bytes_done=0, retries=0) for status in statuses]
+    return DownloadBatch(jobs, list(rejected))
+
+@pytest.mark.parametrize("statuses, rejected, expected", [
+    ([JOB_COMPLETED, JOB_RUNNING], (), JOB_RUNNING),
+    ([JOB_COMPLETED, JOB_QUEUED], (), JOB_RUNNING),
+    ([JOB_COMPLETED, JOB_COMPLETED], (), JOB_COMPLETED),
+    ([JOB_FAILED, JOB_FAILED], (), JOB_FAILED),
+    ([JOB_FAILED, JOB_CANCELLED], (), JOB_FAILED),
+    ([JOB_CANCELLED, JOB_CANCELLED], (), JOB_CANCELLED),
+    ([JOB_COMPLETED, JOB_FAILED], (), BATCH_PARTIAL),
+    ([JOB_COMPLETED, JOB_CANCELLED], (), BATCH_PARTIAL),
+    # 有未能提交的下载项时不算全部成功
+    ([JOB_COMPLETED], [("http://example.com/a.m3u8", "a.mp4", "输出路径重复")], BATCH_PARTIAL),
+    ([], [("http://example.com/a.m3u8", "a.mp4", "输出路径重复")], JOB_FAILED),
+])
+def test_batch_status(statuses, rejected, expected):
+    source = batch(statuses, rejected)
+    assert source.status == expected
+    assert source.progress()["status"] == expected
@@ -0,0 +1,61 @@
+import os
+
+import pytest
+from Crypto.Cipher import AES
+
+from m3u8_core import SegmentDecryptor
+
+KEY = bytes(range(16))
+IV = (42).to_bytes(16, 'big')
+
+def encrypt(plain):
+    padding = 16 - len(plain) % 16
+    return AES.new(KEY, AES.MODE_CBC, iv=IV).encrypt(plain + bytes([padding]) * padding)
+
+def decrypt_in_chunks(ciphertext, sizes):
+    """按sizes循环切分密文送入解密器"""
+    decryptor = SegmentDecryptor(KEY, IV)
+    output = []
+    offset = 0
+    i = 0
+    while offset < len(ciphertext):
+        size = sizes[i % len(sizes)]
+        output.append(decryptor.feed(ciphertext[offset:offset + size]))
+        offset += size
+        i += 1
+    output.append(decryptor.finish())
+    return b''.join(output)
+
+# 明文长度覆盖：不足一个块、正好一个块（填充为整个块）、多个块加零头
+@pytest.mark.parametrize("length", [0, 1, 15, 16, 17, 31, 32, 1000, 4096])
+# 切分方式覆盖：逐字节、块内、正好在块边界、跨块边界、一次全部
+@pytest.mark.parametrize("sizes", [[1], [5], [16], [17], [15, 1, 33], [10 ** 6]])
+def test_pkcs7_stripped_across_chunk_boundaries(length, sizes):
+    plain = os.urandom(length)
+    assert decrypt_in_chunks(encrypt(plain), sizes) == plain
+
+def test_last_block_held_back_until_finish():
+    plain = b'x' * 32
+    ciphertext = encrypt(plain)
+    decryptor = SegmentDecryptor(KEY, IV)
+    # 48字节密文：最后一个块可能包含填充，feed时不输出
+    assert decryptor.feed(ciphertext) == plain
+    assert decryptor.finish() == b''
+
+def test_unencrypted_passthrough():
+    decryptor = SegmentDecryptor(None, None)
+    assert decryptor.feed(b'abc') == b'abc'
+    assert decryptor.feed(b'') == b''
+    assert decryptor.finish() == b''
+
+def test_truncated_ciphertext_rejected():
+    decryptor = SegmentDecryptor(KEY, IV)
+    decryptor.feed(encrypt(b'hello')[:-3])
+    with pytest.raises(Exception, match="16字节"):
+        decryptor.finish()
+
+def test_invalid_padding_kept():
+    # 没有合法PKCS7填充的数据原样保留
+    plain = b'a' * 15 + b'\x00'
+    ciphertext = AES.new(KEY, AES.MODE_CBC, iv=IV).encrypt(plain)
+    assert decrypt_in_chunks(ciphertext, [7]) == plain
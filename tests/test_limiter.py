@@ -0,0 +1,148 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+from m3u8_core import AdaptiveLimiter, JobScheduler, RequestSample
+
+def http_error(status):
+    return aiohttp.ClientResponseError(None, (), status=status)
+
+def run_period(limiter, latency=0.05, nbytes=1000, errors=(), saturated=True):
+    """
+    模拟一个评估周期：limit个请求同时进行后依次结束，前len(errors)个以errors中的异常失败。
+    评估周期的开始时间提前1秒，满足最短间隔，吞吐量约为 limit × nbytes 字节/秒
+    """
+    limiter._period_start -= 1
+    count = limiter.limit
+    limiter.in_flight = count
+    limiter._saturated = saturated
+    for i in range(count):
+        error = errors[i] if i < len(errors) else None
+        limiter.release(latency if error is None else None, nbytes if error is None else 0, error)
+    assert limiter.in_flight == 0
+    return limiter.limit
+
+def test_slow_start_doubles_up_to_maximum():
+    limiter = AdaptiveLimiter(4, 1, 20)
+    assert [run_period(limiter) for _ in range(4)] == [8, 16, 20, 20]
+
+def test_not_saturated_keeps_limit():
+    limiter = AdaptiveLimiter(4, 1, 32)
+    assert run_period(limiter, saturated=False) == 4
+
+def test_throttling_halves_then_additive_increase():
+    limiter = AdaptiveLimiter(16, 1, 32)
+    assert run_period(limiter, errors=[http_error(429)]) == 8
+    # 首次降低后退出慢启动，之后每次加1
+    assert run_period(limiter, nbytes=2000) == 9
+    assert run_period(limiter, nbytes=3000) == 10
+
+def test_timeouts_count_as_congestion():
+    limiter = AdaptiveLimiter(8, 1, 32)
+    assert run_period(limiter, errors=[asyncio.TimeoutError()]) == 4
+
+@pytest.mark.parametrize("error", [http_error(500), http_error(502), http_error(504),
+                                   aiohttp.ServerDisconnectedError(), ConnectionResetError()])
+def test_server_errors_back_off(error):
+    limiter = AdaptiveLimiter(8, 1, 32)
+    # 8个请求中2个出错（超过10%）：并发上限降为3/4
+    assert run_period(limiter, errors=[error, error]) == 6
+
+def test_rare_server_errors_ignored():
+    limiter = AdaptiveLimiter(16, 1, 32)
+    assert run_period(limiter, errors=[http_error(502)]) == 32
+
+def test_client_errors_do_not_back_off():
+    limiter = AdaptiveLimiter(8, 1, 32)
+    assert run_period(limiter, errors=[http_error(404)] * 4) == 16
+
+def test_latency_inflation_backs_off():
+    limiter = AdaptiveLimiter(8, 1, 32)
+    assert run_period(limiter, latency=0.05) == 16
+    assert run_period(limiter, latency=0.2) == 12
+
+def test_minimum_limit():
+    limiter = AdaptiveLimiter(2, 1, 32)
+    assert run_period(limiter, errors=[http_error(503)] * 2) == 1
+    assert run_period(limiter, errors=[http_error(503)]) == 1
+
+def test_plateau_holds_increase():
+    limiter = AdaptiveLimiter(4, 1, 32)
+    assert run_period(limiter, errors=[http_error(503)]) == 2
+    assert run_period(limiter, nbytes=1000) == 3
+    # 增加并发后吞吐量（3 × 600 < 2 × 1000）没有提升：本周期和之后的HOLD_PERIODS个周期保持不变
+    held = [run_period(limiter, nbytes=600) for _ in range(AdaptiveLimiter.HOLD_PERIODS + 2)]
+    assert held == [3] * (AdaptiveLimiter.HOLD_PERIODS + 1) + [4]
+
+def test_history_records_changes():
+    limiter = AdaptiveLimiter(4, 1, 32)
+    run_period(limiter)
+    run_period(limiter, saturated=False)
+    assert [limit for _, limit in limiter.history] == [4, 8]
+
+def test_cancelled_release_not_counted():
+    limiter = AdaptiveLimiter(4, 1, 32)
+    limiter._period_start -= 1
+    limiter.in_flight = 4
+    for _ in range(4):
+        limiter.release(0.05, 0, cancelled=True)
+    assert limiter.in_flight == 0
+    assert limiter._completed == 0 and limiter._bytes == 0 and limiter._latencies == []
+    assert limiter.limit == 4
+
+def test_request_slot_cancelled_not_recorded():
+    async def main():
+        scheduler = JobScheduler(max_jobs=1, max_requests=8, max_requests_per_host=8)
+        entered = asyncio.Event()
+
+        async def request():
+            async with scheduler.request_slot("http://example.com/a.ts") as sample:
+                sample.latency = 0.01
+                entered.set()
+                await asyncio.sleep(10)
+
+        task = asyncio.create_task(request())
+        await entered.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        limiter = scheduler.host_limiters["example.com"]
+        assert limiter.in_flight == 0
+        assert limiter._completed == 0 and limiter._latencies == []
+        assert scheduler._request_slots.in_flight == 0
+
+        async with scheduler.request_slot("http://example.com/a.ts") as sample:
+            sample.latency = 0.01
+            sample.nbytes = 100
+        assert limiter._completed == 1 and limiter._bytes == 100
+
+    asyncio.run(main())
+
+def test_try_request_slot_respects_limits_and_waiters():
+    async def main():
+        scheduler = JobScheduler(max_jobs=1, max_requests=3, max_requests_per_host=8, initial_requests_per_host=2)
+        url = "http://example.com/a.ts"
+        limiter = scheduler.host_limiter(url)
+        assert scheduler.try_request_slot(url)
+        assert scheduler.try_request_slot(url)
+        # 源站上限已满
+        assert not scheduler.try_request_slot(url)
+        assert limiter.in_flight == 2
+
+        # 全局上限已满时不占用源站名额
+        other = "http://other.example.com/a.ts"
+        assert scheduler.try_request_slot(other)
+        assert not scheduler.try_request_slot(other)
+        assert scheduler.host_limiters["other.example.com"].in_flight == 1
+        assert scheduler._request_slots.in_flight == 3
+
+        # 归还后可以再次占用，测量数据反馈给源站的并发控制器
+        sample = RequestSample()
+        sample.latency = 0.01
+        scheduler.release_request_slot(url, sample)
+        assert limiter.in_flight == 1 and limiter._completed == 1
+        assert scheduler.try_request_slot(url)
+        assert limiter.in_flight == 2
+
+    asyncio.run(main())
@@ -0,0 +1,83 @@
+import asyncio
+import io
+import random
+
+import m3u8_core
+from m3u8_core import DownloadJob, Segment, SegmentPipeline, SegmentWriter
+
+def run_pipeline(tmp_path, monkeypatch, batches, window=16, fail=()):
+    """
+    用替代的process_one_url（随机短暂延迟后返回片段URL作为内容）运行流水线，
+    返回 (输出内容, 同时存在的最多任务数, 流水线)
+    """
+    async def fake_process(session, job, segments, keys, host=None, track=None, issued=None):
+        await asyncio.sleep(random.random() * 0.0005)
+        if segments[0].url in fail:
+            raise Exception("请求失败")
+        return [io.BytesIO(f"{s.url}\n".encode()) for s in segments], False
+
+    monkeypatch.setattr(m3u8_core, "process_one_url", fake_process)
+    monkeypatch.setattr(m3u8_core, "retry_delay", lambda attempt: 0)
+
+    async def main():
+        job = DownloadJob("http://example.com/index.m3u8", str(tmp_path / "out.ts"), 8, max_retries=1)
+        writer = SegmentWriter(str(tmp_path / "out.part"), window=window)
+        pipeline = SegmentPipeline(None, job, writer, {})
+        peak = 0
+        try:
+            for batch in batches:
+                pipeline.add(batch)
+                await asyncio.sleep(0)
+            joined = asyncio.ensure_future(pipeline.join())
+            while not joined.done():
+                peak = max(peak, len(pipeline._tasks))
+                await asyncio.sleep(0)
+            await joined
+        finally:
+            await pipeline.close()
+            writer.close()
+        return peak, pipeline
+
+    peak, pipeline = asyncio.run(main())
+    return (tmp_path / "out.part").read_text(), peak, pipeline
+
+def segments(start, count):
+    return [Segment(f"http://example.com/{i}.ts", 4.0) for i in range(start, start + count)]
+
+def test_long_playlist_bounded_tasks(tmp_path, monkeypatch):
+    count = 10000
+    batches = [segments(i, 1000) for i in range(0, count, 1000)]
+    output, peak, pipeline = run_pipeline(tmp_path, monkeypatch, batches, window=16)
+    assert output.split() == [f"http://example.com/{i}.ts" for i in range(count)]
+    # 窗口内的下载任务，另加启动任务和正在写入（序号已在窗口之前）的任务
+    assert peak <= 16 + 2
+    assert not pipeline._queue and pipeline._producer is None
+
+def test_batches_added_after_producer_finished(tmp_path, monkeypatch):
+    async def main():
+        monkeypatch.setattr(m3u8_core, "process_one_url", fake)
+        job = DownloadJob("http://example.com/index.m3u8", str(tmp_path / "out.ts"), 8, max_retries=0)
+        writer = SegmentWriter(str(tmp_path / "out.part"), window=4)
+        pipeline = SegmentPipeline(None, job, writer, {})
+        pipeline.add(segments(0, 10))
+        await pipeline.join()
+        pipeline.add(segments(10, 10))
+        await pipeline.join()
+        await pipeline.close()
+        writer.close()
+
+    async def fake(session, job, segs, keys, host=None, track=None, issued=None):
+        return [io.BytesIO(f"{s.url}\n".encode()) for s in segs], False
+
+    asyncio.run(main())
+    assert (tmp_path / "out.part").read_text().split() == [f"http://example.com/{i}.ts" for i in range(20)]
+
+def test_failure_drops_queued_groups(tmp_path, monkeypatch):
+    output, _, pipeline = run_pipeline(tmp_path, monkeypatch, [segments(0, 5000)], window=8,
+                                       fail={"http://example.com/100.ts"})
+    # 写入器在失败的片段处中止（之前已下载但尚未写入的片段也不再写入），排队中的组不再启动
+    written = output.split()
+    assert len(written) <= 100
+    assert written == [f"http://example.com/{i}.ts" for i in range(len(written))]
+    assert [result.index for result in pipeline.failed] == [100]
+    assert not pipeline._queue
@@ -0,0 +1,317 @@
+import asyncio
+
+import pytest
+
+from m3u8_core import (
+    COALESCE_MAX_SEGMENTS, MediaPlaylist, MediaPlaylistParser, PlaylistCache, Segment, parse_m3u8_text,
+    plan_requests,
+)
+
+BASE_URL = "http://example.com/video/index.m3u8"
+
+PLAYLIST = """#EXTM3U
+#EXT-X-TARGETDURATION:10
+#EXT-X-MEDIA-SEQUENCE:7
+#EXTINF:9.5,
+a.ts
+#EXT-X-KEY:METHOD=AES-128,URI="key1.bin"
+#EXTINF:10,
+b.ts
+#EXTINF:10,
+c.ts
+#EXT-X-KEY:METHOD=AES-128,URI="https://keys.example.com/key2.bin",IV=0x1f
+#EXTINF:8,
+d.ts
+#EXT-X-KEY:METHOD=NONE
+#EXTINF:4.25,
+/abs/e.ts
+#EXT-X-ENDLIST
+"""
+
+class FakeContent:
+    def __init__(self, chunks):
+        self._chunks = chunks
+
+    async def iter_any(self):
+        for chunk in self._chunks:
+            yield chunk
+
+class FakeResponse:
+    def __init__(self, chunks):
+        self.content = FakeContent(chunks)
+
+def receive(text, chunk_size):
+    """按chunk_size字节切分后交给增量解析，返回 (播放列表, 每批片段数)"""
+    data = text.encode('utf-8')
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+    batches = []
+
+    async def on_segments(segments):
+        batches.append(len(segments))
+
+    _, playlist = asyncio.run(PlaylistCache._receive(FakeResponse(chunks), BASE_URL, on_segments))
+    return playlist, batches
+
+def test_segments_urls_and_durations():
+    playlist = parse_m3u8_text(PLAYLIST, BASE_URL)
+    assert [s.url for s in playlist.segments] == [
+        "http://example.com/video/a.ts",
+        "http://example.com/video/b.ts",
+        "http://example.com/video/c.ts",
+        "http://example.com/video/d.ts",
+        "http://example.com/abs/e.ts",
+    ]
+    assert [s.duration for s in playlist.segments] == [9.5, 10.0, 10.0, 8.0, 4.25]
+    assert playlist.media_sequence == 7
+    assert playlist.target_duration == 10
+    assert playlist.endlist
+
+def test_key_inheritance_and_iv():
+    segments = parse_m3u8_text(PLAYLIST, BASE_URL).segments
+    assert segments[0].key is None and segments[0].iv is None
+    # 密钥对之后的片段一直有效，直到下一个 #EXT-X-KEY
+    assert segments[1].key is segments[2].key
+    assert segments[1].key.uri == "http://example.com/video/key1.bin"
+    # 没有显式IV时使用片段的媒体序列号
+    assert segments[1].iv == (7 + 1).to_bytes(16, 'big')
+    assert segments[2].iv == (7 + 2).to_bytes(16, 'big')
+    # 显式IV不足32位十六进制时左侧补0
+    assert segments[3].key.uri == "https://keys.example.com/key2.bin"
+    assert segments[3].iv == (0x1f).to_bytes(16, 'big')
+    # METHOD=NONE之后不再加密
+    assert segments[4].key is None and segments[4].iv is None
+
+def test_keys_deduplicated_in_order():
+    playlist = parse_m3u8_text(PLAYLIST, BASE_URL)
+    assert [key.uri for key in playlist.keys] == [
+        "http://example.com/video/key1.bin", "https://keys.example.com/key2.bin"]
+
+def test_crlf_same_as_lf():
+    lf = parse_m3u8_text(PLAYLIST, BASE_URL)
+    crlf = parse_m3u8_text(PLAYLIST.replace('\n', '\r\n'), BASE_URL)
+    assert [(s.url, s.duration, s.iv) for s in crlf.segments] == [(s.url, s.duration, s.iv) for s in lf.segments]
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 4096])
+@pytest.mark.parametrize("newline", ['\n', '\r\n'])
+def test_incremental_parse_matches_full_parse(chunk_size, newline):
+    text = PLAYLIST.replace('\n', newline)
+    expected = parse_m3u8_text(text, BASE_URL)
+    playlist, batches = receive(text, chunk_size)
+    assert [(s.url, s.duration, s.iv) for s in playlist.segments] == \
+           [(s.url, s.duration, s.iv) for s in expected.segments]
+    assert sum(batches) == len(expected.segments)
+    assert playlist.endlist
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 4096])
+def test_missing_trailing_newline(chunk_size):
+    text = "#EXTM3U\r\n#EXTINF:5,\r\nfirst.ts\r\n#EXTINF:6,\r\nlast.ts"
+    playlist, batches = receive(text, chunk_size)
+    assert [s.url for s in playlist.segments] == [
+        "http://example.com/video/first.ts", "http://example.com/video/last.ts"]
+    assert playlist.segments[-1].duration == 6.0
+    assert sum(batches) == 2
+    assert [s.url for s in parse_m3u8_text(text, BASE_URL).segments] == [s.url for s in playlist.segments]
+
+def test_byterange_offsets():
+    text = "\n".join([
+        "#EXTM3U",
+        "#EXTINF:4,", "#EXT-X-BYTERANGE:100@0", "all.ts",
+        # 省略@offset时接在同一资源的上一个范围之后
+        "#EXTINF:4,", "#EXT-X-BYTERANGE:50", "all.ts",
+        "#EXTINF:4,", "#EXT-X-BYTERANGE:30", "other.ts",
+        "#EXTINF:4,", "#EXT-X-BYTERANGE:20", "all.ts",
+    ])
+    segments = parse_m3u8_text(text, BASE_URL).segments
+    assert [s.byterange for s in segments] == [(0, 100), (100, 50), (0, 30), (150, 20)]
+
+def test_master_playlist_rejected():
+    parser = MediaPlaylistParser(BASE_URL)
+    with pytest.raises(Exception, match="主播放列表"):
+        parser.feed('#EXT-X-STREAM-INF:BANDWIDTH=1000')
+
+def test_empty_playlist_rejected():
+    with pytest.raises(Exception, match="未找到任何ts文件链接"):
+        parse_m3u8_text("#EXTM3U\n#EXT-X-ENDLIST\n", BASE_URL)
+
+def ranged(url, offset, length):
+    return Segment(url, 4.0, (offset, length))
+
+def test_plan_requests_plain_segments_one_request_each():
+    segments = [Segment(f"http://example.com/{i}.ts", 4.0) for i in range(3)]
+    assert plan_requests(segments) == [(0, 1), (1, 2), (2, 3)]
+
+def test_plan_requests_coalesces_contiguous_byteranges():
+    segments = [ranged("http://example.com/all.ts", i * 100, 100) for i in range(5)]
+    assert plan_requests(segments) == [(0, 5)]
+    assert plan_requests(segments, start_index=2) == [(2, 5)]
+
+def test_plan_requests_breaks_on_gap_and_url_change():
+    segments = [
+        ranged("http://example.com/all.ts", 0, 100),
+        ranged("http://example.com/all.ts", 100, 100),
+        # 与上一个范围不相接
+        ranged("http://example.com/all.ts", 300, 100),
+        ranged("http://example.com/other.ts", 400, 100),
+        Segment("http://example.com/plain.ts", 4.0),
+        ranged("http://example.com/all.ts", 500, 100),
+    ]
+    assert plan_requests(segments) == [(0, 2), (2, 3), (3, 4), (4, 5), (5, 6)]
+
+def test_plan_requests_limits_segments_per_request():
+    segments = [ranged("http://example.com/all.ts", i * 10, 10) for i in range(COALESCE_MAX_SEGMENTS * 2 + 1)]
+    groups = plan_requests(segments)
+    assert groups == [(0, COALESCE_MAX_SEGMENTS), (COALESCE_MAX_SEGMENTS, COALESCE_MAX_SEGMENTS * 2),
+                      (COALESCE_MAX_SEGMENTS * 2, COALESCE_MAX_SEGMENTS * 2 + 1)]
+
+def test_plan_requests_limits_bytes_per_request(monkeypatch):
+    monkeypatch.setattr("m3u8_core.COALESCE_MAX_BYTES", 250)
+    segments = [ranged("http://example.com/all.ts", i * 100, 100) for i in range(5)]
+    assert plan_requests(segments) == [(0, 2), (2, 4), (4, 5)]
+
+def media_playlist(durations, media_sequence=100):
+    playlist = MediaPlaylist()
+    playlist.segments = [Segment(f"http://example.com/{i}.ts", d) for i, d in enumerate(durations)]
+    playlist.media_sequence = media_sequence
+    return playlist
+
+# 片段开始时间为 0, 10, 20，总时长30秒
+@pytest.mark.parametrize("start, end, expected", [
+    (0, 0, (0, 3)),
+    # start正好在片段边界上时从该片段开始，稍早一点则包含上一个片段
+    (10, 0, (1, 3)),
+    (9.99, 0, (0, 3)),
+    (10.01, 0, (1, 3)),
+    # end正好在片段边界上时不包含从end开始的片段
+    (0, 10, (0, 1)),
+    (0, 10.01, (0, 2)),
+    (0, 0.5, (0, 1)),
+    (5, 25, (0, 3)),
+    (10, 20, (1, 2)),
+    # 超出总时长
+    (0, 1000, (0, 3)),
+    (30, 0, (3, 3)),
+    (100, 0, (3, 3)),
+    (100, 200, (3, 3)),
+])
+def test_segment_range_boundaries(start, end, expected):
+    assert media_playlist([10, 10, 10]).segment_range(start, end) == expected
+
+def test_segment_range_fractional_durations():
+    # 前缀和的浮点误差不影响边界：0.1 + 0.2 != 0.3
+    playlist = media_playlist([0.1, 0.2, 0.3])
+    assert playlist.duration == pytest.approx(0.6)
+    assert playlist.segment_range(0.1, 0) == (1, 3)
+    assert playlist.segment_range(0, 0.1) == (0, 1)
+
+def test_offsets_follow_appended_segments():
+    playlist = media_playlist([10, 10])
+    assert playlist.duration == 20
+    playlist.segments.append(Segment("http://example.com/2.ts", 5))
+    assert playlist.offsets == [0, 10, 20, 25]
+    assert playlist.segment_range(21, 0) == (2, 3)
+
+def test_clip_keeps_sequence_and_time_offset():
+    playlist = media_playlist([10, 10, 10, 10])
+    playlist.target_duration = 10
+    playlist.endlist = True
+    clipped = playlist.clip(15, 25)
+    assert [s.url for s in clipped.segments] == ["http://example.com/1.ts", "http://example.com/2.ts"]
+    assert clipped.media_sequence == 101
+    assert clipped.time_offset == 10
+    assert clipped.duration == 20
+    assert clipped.target_duration == 10 and clipped.endlist
+    # 再次截取时的时间相对于截取后的播放列表，time_offset累加
+    again = clipped.clip(10, 0)
+    assert [s.url for s in again.segments] == ["http://example.com/2.ts"]
+    assert again.media_sequence == 102
+    assert again.time_offset == 20
+
+def test_clip_key_iv_unchanged():
+    # 截取不改变片段的IV：没有显式IV时按截取前的媒体序列号计算
+    clipped = parse_m3u8_text(PLAYLIST, BASE_URL).clip(10, 0)
+    assert clipped.segments[0].url == "http://example.com/video/b.ts"
+    assert clipped.segments[0].iv == (7 + 1).to_bytes(16, 'big')
+
+@pytest.mark.parametrize("start, end, message", [
+    (30, 0, "30 秒之后没有片段"),
+    (40, 50, "40-50 秒内没有片段"),
+])
+def test_clip_outside_playlist_rejected(start, end, message):
+    with pytest.raises(Exception, match=message):
+        media_playlist([10, 10, 10]).clip(start, end)
+
+FMP4_PLAYLIST = """#EXTM3U
+#EXT-X-VERSION:7
+#EXT-X-TARGETDURATION:4
+#EXT-X-MEDIA-SEQUENCE:20
+#EXT-X-MAP:URI="init.mp4"
+#EXTINF:4,
+seg1.m4s
+#EXTINF:4,
+seg2.m4s
+#EXT-X-KEY:METHOD=AES-128,URI="key.bin"
+#EXT-X-MAP:URI="https://cdn.example.com/init2.mp4",BYTERANGE="720@100"
+#EXTINF:4,
+seg3.m4s
+#EXT-X-MAP:URI="init3.mp4",BYTERANGE="500"
+#EXTINF:4,
+seg4.m4s
+#EXT-X-ENDLIST
+"""
+
+def test_map_applies_until_next_map():
+    segments = parse_m3u8_text(FMP4_PLAYLIST, BASE_URL).segments
+    first = segments[0].init
+    assert first.url == "http://example.com/video/init.mp4"
+    assert first.byterange is None and first.key is None and first.iv is None
+    # 同一个#EXT-X-MAP的片段共用同一个初始化片段
+    assert segments[1].init is first
+    second = segments[2].init
+    assert second.url == "https://cdn.example.com/init2.mp4"
+    assert second.byterange == (100, 720)
+    # 省略偏移时从0开始
+    assert segments[3].init.byterange == (0, 500)
+    assert segments[3].init.ident == ("http://example.com/video/init3.mp4", (0, 500))
+
+def test_map_uses_active_key():
+    playlist = parse_m3u8_text(FMP4_PLAYLIST, BASE_URL)
+    init = playlist.segments[2].init
+    assert init.key is playlist.segments[2].key
+    # 没有显式IV时使用其后第一个片段的媒体序列号
+    assert init.iv == (20 + 2).to_bytes(16, 'big')
+    assert [key.uri for key in playlist.keys] == ["http://example.com/video/key.bin"]
+
+def test_map_key_included_in_keys():
+    text = "\n".join([
+        "#EXTM3U",
+        '#EXT-X-KEY:METHOD=AES-128,URI="init-key.bin",IV=0x01',
+        '#EXT-X-MAP:URI="init.mp4"',
+        "#EXT-X-KEY:METHOD=NONE",
+        "#EXTINF:4,", "seg1.m4s",
+    ])
+    playlist = parse_m3u8_text(text, BASE_URL)
+    assert playlist.segments[0].key is None
+    assert playlist.segments[0].init.iv == (1).to_bytes(16, 'big')
+    assert [key.uri for key in playlist.keys] == ["http://example.com/video/init-key.bin"]
+
+def test_map_without_uri_rejected():
+    with pytest.raises(Exception, match="EXT-X-MAP"):
+        parse_m3u8_text('#EXTM3U\n#EXT-X-MAP:BYTERANGE="10@0"\n#EXTINF:4,\na.m4s\n', BASE_URL)
+
+@pytest.mark.parametrize("chunk_size", [1, 9, 4096])
+def test_incremental_parse_keeps_map(chunk_size):
+    playlist, _ = receive(FMP4_PLAYLIST, chunk_size)
+    assert [s.init.ident for s in playlist.segments] == \
+           [s.init.ident for s in parse_m3u8_text(FMP4_PLAYLIST, BASE_URL).segments]
+
+@pytest.mark.parametrize("extinf, duration", [
+    ('#EXTINF:-1 tvg-id="cctv1" tvg-name="CCTV-1" group-title="央视",CCTV-1 综合', 0.0),
+    ('#EXTINF:10 tvg-id="a",标题', 10.0),
+    ('#EXTINF:9.009,', 9.009),
+    ('#EXTINF:6', 6.0),
+    ('#EXTINF:,无时长', 0.0),
+    ('#EXTINF:', 0.0),
+])
+def test_extinf_duration(extinf, duration):
+    playlist = parse_m3u8_text(f"#EXTM3U\n{extinf}\nhttp://example.com/live/1.ts\n", BASE_URL)
+    assert playlist.segments[0].duration == duration
@@ -0,0 +1,153 @@
+import asyncio
+import gc
+import time
+
+import aiohttp
+from aiohttp import web
+
+from m3u8_core import MediaPlaylist, PlaylistCache
+
+PLAYLIST = "#EXTM3U\n#EXT-X-TARGETDURATION:4\n#EXTINF:4,\na.ts\n#EXTINF:4,\nb.ts\n#EXT-X-ENDLIST\n"
+ETAG = '"v1"'
+LAST_MODIFIED = "Sat, 17 Oct 2026 00:00:00 GMT"
+
+class Origin:
+    """只提供一个播放列表的源站，记录收到的请求头，If-None-Match匹配时返回304"""
+
+    def __init__(self, status=200, delay=0):
+        self.status = status
+        self.delay = delay
+        self.requests = []
+
+    async def handle(self, request):
+        self.requests.append(dict(request.headers))
+        await asyncio.sleep(self.delay)
+        if self.status != 200:
+            return web.Response(status=self.status)
+        if request.headers.get('If-None-Match') == ETAG:
+            return web.Response(status=304, headers={'ETag': ETAG})
+        return web.Response(text=PLAYLIST, headers={'ETag': ETAG, 'Last-Modified': LAST_MODIFIED})
+
+async def serve(origin):
+    app = web.Application()
+    app.router.add_get('/index.m3u8', origin.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://127.0.0.1:{port}/index.m3u8"
+
+def run_with_origin(origin, body):
+    async def main():
+        runner, url = await serve(origin)
+        try:
+            async with aiohttp.ClientSession() as session:
+                await body(session, url)
+        finally:
+            await runner.cleanup()
+    asyncio.run(main())
+
+def test_fresh_entry_served_from_cache():
+    origin = Origin()
+    cache = PlaylistCache(ttl=300)
+
+    async def body(session, url):
+        text, playlist = await cache.get(session, url)
+        again, same = await cache.get(session, url)
+        assert text == again == PLAYLIST
+        assert same is playlist
+        assert isinstance(playlist, MediaPlaylist) and len(playlist.segments) == 2
+
+    run_with_origin(origin, body)
+    assert len(origin.requests) == 1
+    assert (cache.hits, cache.revalidated, cache.misses) == (1, 0, 1)
+
+def test_expired_entry_revalidated_with_304():
+    origin = Origin()
+    cache = PlaylistCache(ttl=300)
+    received = []
+
+    async def on_segments(segments):
+        received.extend(segments)
+
+    async def body(session, url):
+        _, playlist = await cache.get(session, url)
+        cache._entries[url]["expires"] = time.monotonic() - 1
+        text, revalidated = await cache.get(session, url, on_segments=on_segments)
+        # 304时继续使用已解析的结果，不重新解析，也不调用on_segments
+        assert revalidated is playlist
+        assert text == PLAYLIST
+        assert received == []
+        # 重新验证后有效期延长
+        assert cache._entries[url]["expires"] > time.monotonic()
+
+    run_with_origin(origin, body)
+    assert len(origin.requests) == 2
+    assert 'If-None-Match' not in origin.requests[0]
+    assert origin.requests[1]['If-None-Match'] == ETAG
+    assert origin.requests[1]['If-Modified-Since'] == LAST_MODIFIED
+    assert (cache.hits, cache.revalidated, cache.misses) == (0, 1, 1)
+
+def test_max_age_zero_always_revalidates():
+    origin = Origin()
+    cache = PlaylistCache(ttl=300)
+
+    async def body(session, url):
+        await cache.get(session, url)
+        await cache.get(session, url, max_age=0)
+
+    run_with_origin(origin, body)
+    assert len(origin.requests) == 2
+    assert cache.revalidated == 1
+
+def test_concurrent_requests_coalesced():
+    origin = Origin(delay=0.1)
+    cache = PlaylistCache(ttl=300)
+
+    async def body(session, url):
+        results = await asyncio.gather(*(cache.get(session, url) for _ in range(5)))
+        assert len({id(playlist) for _, playlist in results}) == 1
+
+    run_with_origin(origin, body)
+    assert len(origin.requests) == 1
+
+def test_fetch_cancelled_with_last_caller():
+    origin = Origin(delay=1)
+    cache = PlaylistCache(ttl=300)
+    unretrieved = []
+
+    async def body(session, url):
+        loop = asyncio.get_running_loop()
+        loop.set_exception_handler(lambda _, context: unretrieved.append(context))
+        callers = [asyncio.ensure_future(cache.get(session, url)) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        pending = cache._pending[url]
+        # 还有调用方在等待时请求继续进行
+        callers[0].cancel()
+        await asyncio.sleep(0.02)
+        assert not pending.done()
+        # 最后一个调用方被取消后请求随之取消
+        callers[1].cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.sleep(0)
+        assert pending.cancelled()
+        assert not cache._pending and not cache._waiters
+        gc.collect()
+        await asyncio.sleep(0)
+
+    run_with_origin(origin, body)
+    assert unretrieved == []
+    assert not cache._entries
+
+def test_failed_fetch_raised_to_every_caller():
+    origin = Origin(status=404, delay=0.05)
+    cache = PlaylistCache(ttl=300)
+
+    async def body(session, url):
+        results = await asyncio.gather(*(cache.get(session, url) for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(r, aiohttp.ClientResponseError) and r.status == 404 for r in results)
+        assert not cache._pending and not cache._waiters
+
+    run_with_origin(origin, body)
+    assert len(origin.requests) == 1
@@ -0,0 +1,58 @@
+import asyncio
+import json
+
+import pytest
+
+from m3u8_core import get_job_trace, make_job_id
+
+JOB_ID = make_job_id("http://example.com/index.m3u8", "out.mp4")
+
+TRACE = {
+    "traceEvents": [
+        {"ph": "M", "name": "thread_name", "pid": 1, "tid": 1, "args": {"name": "任务"}},
+        {"ph": "X", "name": "解析播放列表", "cat": "playlist", "pid": 1, "tid": 1, "ts": 0, "dur": 1500, "args": {}},
+        {"ph": "X", "name": "下载", "cat": "segment", "pid": 1, "tid": 1, "ts": 2000, "dur": 30000,
+         "args": {"bytes": 1024}},
+    ],
+    "otherData": {"job_id": JOB_ID, "status": "completed"},
+}
+
+@pytest.fixture
+def trace_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr("m3u8_core.TRACE_DIR", str(tmp_path))
+    return tmp_path
+
+def write_trace(trace_dir, content):
+    path = trace_dir / f"{JOB_ID}.json"
+    path.write_text(content if isinstance(content, str) else json.dumps(content), encoding='utf-8')
+    return path
+
+def test_summary_from_exported_file(trace_dir):
+    path = write_trace(trace_dir, TRACE)
+    result = asyncio.run(get_job_trace(JOB_ID))
+    assert f"任务ID: {JOB_ID}" in result
+    assert "segment/下载: 1 次" in result
+    assert "30.0ms segment/下载 [任务]" in result
+    assert result.endswith(f"追踪文件: {path}")
+
+@pytest.mark.parametrize("job_id", [
+    "../../etc/passwd", "../" + JOB_ID, JOB_ID + "/..", JOB_ID.upper(), JOB_ID[:-1], JOB_ID + "0", "", "/tmp/x",
+])
+def test_invalid_job_id_rejected(trace_dir, job_id):
+    assert asyncio.run(get_job_trace(job_id)).startswith("错误：无效的任务ID")
+
+def test_missing_trace(trace_dir):
+    assert "没有性能追踪数据" in asyncio.run(get_job_trace(JOB_ID))
+
+@pytest.mark.parametrize("content", [
+    "{not json",
+    [],
+    {"otherData": {}},
+    {"traceEvents": [{"ph": "X"}]},
+    {"traceEvents": "x"},
+    {"traceEvents": [{"ph": "X", "name": "下载", "cat": "segment", "tid": 1, "ts": 0, "dur": 1, "args": "x"}]},
+])
+def test_malformed_trace_file_reported(trace_dir, content):
+    write_trace(trace_dir, content)
+    result = asyncio.run(get_job_trace(JOB_ID))
+    assert result.startswith("读取性能追踪文件失败") or result.startswith("性能追踪文件格式不正确")
@@ -0,0 +1,112 @@
+import asyncio
+import io
+import random
+
+from m3u8_core import SegmentWriter
+
+def run_segments(path, count, window=16, order=None):
+    """count个片段各由一个任务等待写入窗口后提交，返回写入器"""
+    async def main():
+        writer = SegmentWriter(str(path), window=window)
+        started = []
+
+        async def segment(index):
+            if not await writer.wait_for_slot(index):
+                return
+            started.append((index, writer.next_index))
+            # 模拟下载耗时，使片段乱序完成
+            await asyncio.sleep(random.random() * 0.001)
+            await writer.write(index, io.BytesIO(f"{index:06d}\n".encode()))
+
+        indexes = order if order is not None else range(count)
+        tasks = [asyncio.create_task(segment(i)) for i in indexes]
+        await asyncio.wait_for(asyncio.gather(*tasks), 30)
+        writer.close()
+        return writer, started
+
+    return asyncio.run(main())
+
+def test_segments_written_in_order(tmp_path):
+    path = tmp_path / "out.ts"
+    order = list(range(500))
+    random.Random(1).shuffle(order)
+    writer, _ = run_segments(path, 500, window=8, order=order)
+    assert writer.next_index == 500
+    assert path.read_text().split() == [f"{i:06d}" for i in range(500)]
+
+def test_window_limits_started_segments(tmp_path):
+    writer, started = run_segments(tmp_path / "out.ts", 200, window=8)
+    # 片段开始下载时序号在 [next_index, next_index + window) 内
+    assert sorted(index for index, _ in started) == list(range(200))
+    assert all(index < next_index + 8 for index, next_index in started)
+
+def test_thousands_of_waiting_segments(tmp_path):
+    # 每写入一个片段只唤醒刚进入窗口的那个片段；全部唤醒时这里需要数分钟
+    path = tmp_path / "out.ts"
+    writer, _ = run_segments(path, 10000, window=16)
+    assert writer.next_index == 10000
+    assert writer.bytes_written == 10000 * 7
+
+def test_abort_wakes_waiters(tmp_path):
+    async def main():
+        writer = SegmentWriter(str(tmp_path / "out.ts"), window=4)
+        waiters = [asyncio.create_task(writer.wait_for_slot(i)) for i in range(4, 100)]
+        await asyncio.sleep(0)
+        assert not any(w.done() for w in waiters)
+        await writer.abort()
+        results = await asyncio.wait_for(asyncio.gather(*waiters), 5)
+        writer.close()
+        return results
+
+    assert asyncio.run(main()) == [False] * 96
+
+def test_cancelled_waiter_does_not_affect_others(tmp_path):
+    async def main():
+        writer = SegmentWriter(str(tmp_path / "out.ts"), window=1)
+        first = asyncio.create_task(writer.wait_for_slot(1))
+        second = asyncio.create_task(writer.wait_for_slot(1))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        await writer.write(0, io.BytesIO(b"x"))
+        result = await asyncio.wait_for(second, 5)
+        writer.close()
+        return first.cancelled(), result
+
+    assert asyncio.run(main()) == (True, True)
+
+def test_init_section_written_before_first_use_and_on_change(tmp_path):
+    path = tmp_path / "out.mp4"
+
+    async def main():
+        writer = SegmentWriter(str(path), window=8)
+        a = (("http://example.com/a.mp4", None), b"[A]")
+        b = (("http://example.com/b.mp4", None), b"[B]")
+        inits = [a, a, b, b, a]
+        # 乱序提交，按序号写入时才决定是否写入初始化片段
+        for index in (4, 2, 0, 3, 1):
+            await writer.write(index, io.BytesIO(f"{index}".encode()), init=inits[index])
+        writer.close()
+        return writer
+
+    writer = asyncio.run(main())
+    assert path.read_bytes() == b"[A]01[B]23[A]4"
+    assert writer.bytes_written == len(b"[A]01[B]23[A]4")
+
+def test_init_section_not_repeated_after_resume(tmp_path):
+    path = tmp_path / "out.mp4"
+    path.write_bytes(b"[A]0")
+    init = ("http://example.com/a.mp4", None)
+    committed = []
+
+    async def main():
+        writer = SegmentWriter(str(path), window=8, start_index=1, init=init,
+                               on_commit=lambda index, size, sha1: committed.append((index, size)))
+        await writer.write(1, io.BytesIO(b"1"), init=(init, b"[A]"))
+        await writer.write(2, io.BytesIO(b"2"), init=(("http://example.com/b.mp4", None), b"[B]"))
+        writer.close()
+
+    asyncio.run(main())
+    assert path.read_bytes() == b"[A]01[B]2"
+    # 初始化片段计入使用它的片段的大小，续传校验时与文件内容一致
+    assert committed == [(1, 1), (2, 4)]